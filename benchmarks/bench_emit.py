@@ -0,0 +1,68 @@
+"""Benchmark shape emission into a py-lmd Collection: per-row lists vs flat coordinate buffer.
+
+Usage:
+   python benchmarks/bench_emit.py --shapes 50000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import geopandas
+import numpy
+import shapely
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from lmd.lib import Collection
+from loguru import logger
+
+import qupath_to_lmd.shapes as shapes
+import qupath_to_lmd.utils as utils
+
+logger.remove()
+
+
+def synthetic_cells(n: int, seed: int = 0) -> geopandas.GeoDataFrame:
+   """Round cells of 4 to 12 px radius spread over a 20000 px slide, each in one of three wells."""
+   rng = numpy.random.default_rng(seed)
+   centers = rng.uniform(0, 20000, (n, 2))
+   cells = shapely.buffer(shapely.points(centers), rng.uniform(4, 12, n), quad_segs=8)
+   return geopandas.GeoDataFrame({"well": rng.choice(["C3", "C5", "C7"], n)}, geometry=cells)
+
+
+def per_row(df: geopandas.GeoDataFrame) -> Collection:
+   """The previous create_collection loop."""
+   collection = Collection(calibration_points=numpy.array([[0, 0], [20000, 0], [0, 20000]]))
+   collection.orientation_transform = numpy.array([[1, 0], [0, -1]])
+   df = df.copy()
+   df["coords"] = df.geometry.apply(utils.extract_coordinates)
+   for i in df.index:
+      collection.new_shape(df.at[i, "coords"], well=df.at[i, "well"])
+   return collection
+
+
+def flat(df: geopandas.GeoDataFrame) -> Collection:
+   """Collection built from one flat coordinate buffer, as the pipeline does."""
+   collection = Collection(calibration_points=numpy.array([[0, 0], [20000, 0], [0, 20000]]))
+   collection.orientation_transform = numpy.array([[1, 0], [0, -1]])
+   coords, offsets = shapes.flat_coordinates(df.geometry)
+   return shapes.emit_shapes(collection, coords, offsets, df["well"])
+
+
+def main():
+   """Times building the collection shape by shape and from one flat buffer."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--shapes", type=int, default=50000)
+   args = parser.parse_args()
+
+   df = synthetic_cells(args.shapes)
+   df["geometry"] = df.geometry.simplify(1)
+   for name, func in (("per-row", per_row), ("flat", flat)):
+      start = time.perf_counter()
+      collection = func(df)
+      elapsed = time.perf_counter() - start
+      print(f"{name:>8}: {elapsed:6.2f} s  {len(collection.shapes) / elapsed:12,.0f} shapes/s")
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,74 @@
+"""Compare GeoJSON, GeoParquet and FlatGeobuf for loading a slide and exporting the processed shapes.
+
+Usage:
+   python benchmarks/bench_formats.py --sizes 100000 500000
+
+For every size a synthetic slide (see `synthetic.py`) is written as GeoJSON and converted to
+GeoParquet (with a bbox covering column) and FlatGeobuf (with a spatial index). Every file is
+read and QC'ed like an upload (`ingest.read_shapes`), once whole and once for a region of a
+tenth of the slide, and the cleaned shapes are exported in every format.
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import geopandas
+import pandas
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+import synthetic
+from loguru import logger
+
+import qupath_to_lmd.ingest as ingest
+import qupath_to_lmd.utils as utils
+
+logger.remove()
+
+
+def timed(func, *args, **kwargs) -> tuple[float, object]:
+   """Wall time of `func(*args, **kwargs)` in seconds and its result."""
+   start = time.perf_counter()
+   result = func(*args, **kwargs)
+   return time.perf_counter() - start, result
+
+
+def main():
+   """Writes every size in all three formats and times loading, region loading and export."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 500000])
+   args = parser.parse_args()
+
+   rows = []
+   with tempfile.TemporaryDirectory() as tmp:
+      for size in args.sizes:
+         inputs = {"geojson": Path(tmp) / f"slide_{size}.geojson", "geoparquet": Path(tmp) / f"slide_{size}.parquet",
+                   "flatgeobuf": Path(tmp) / f"slide_{size}.fgb"}
+         synthetic.write_feature_collection(inputs["geojson"], size)
+         raw = geopandas.read_file(inputs["geojson"], use_arrow=True)
+         raw.to_parquet(inputs["geoparquet"], write_covering_bbox=True)
+         raw.assign(**{utils.FEATURE_ORDER_COLUMN: range(len(raw))}).to_file(inputs["flatgeobuf"], driver="FlatGeobuf")
+         side = synthetic.slide_side(size)
+         region = (0.0, 0.0, side * 0.1 ** 0.5, side * 0.1 ** 0.5)
+         del raw
+
+         for file_format, path in inputs.items():
+            load_s, (gdf, _, _) = timed(ingest.read_shapes, path)
+            region_s, region_shapes = None, None
+            if file_format != "geojson":
+               region_s, (region_gdf, _, _) = timed(ingest.read_shapes, path, bbox=region)
+               region_shapes = len(region_gdf)
+            output = Path(tmp) / f"processed{utils.PROCESSED_FORMATS[file_format]}"
+            with open(output, "wb") as f:
+               export_s, _ = timed(utils.write_processed, gdf, f, file_format)
+            rows.append({"shapes": len(gdf), "format": file_format,
+                         "file_mb": round(path.stat().st_size / 2**20, 1), "load_s": round(load_s, 2),
+                         "region_load_s": region_s and round(region_s, 2), "region_shapes": region_shapes,
+                         "export_s": round(export_s, 2), "export_mb": round(output.stat().st_size / 2**20, 1)})
+            output.unlink()
+   print(pandas.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,66 @@
+"""Import times of the package and its headless modules, checked against a budget.
+
+Usage:
+   python benchmarks/bench_imports.py --budget-ms 1000
+
+Every module is imported in a fresh interpreter with `python -X importtime`, the best of
+`--repeats` runs counts. The entry points of the headless use, `qupath_to_lmd.pipeline` and
+`qupath_to_lmd.cli`, must stay within `--budget-ms`, and the headless modules (everything the CLI
+and scripts use) must not load the webapp or the dependencies that only single stages need:
+streamlit, py-lmd, matplotlib and scipy. Exits with 1 if either fails. tests/test_imports.py runs
+the same checks.
+"""
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pandas
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+HEADLESS = ["qupath_to_lmd.cli", "qupath_to_lmd.pipeline", "qupath_to_lmd.sharding", "qupath_to_lmd.ingest",
+            "qupath_to_lmd.stage", "qupath_to_lmd.utils"]
+DEFERRED = ["streamlit", "lmd", "matplotlib", "scipy"]
+BUDGETED = ["qupath_to_lmd.pipeline", "qupath_to_lmd.cli"]
+
+
+def import_time(module: str) -> tuple[float, list]:
+   """Cumulative import time of `module` in ms and which of the deferred packages it loaded."""
+   check = f"import sys, {module}; print(','.join(m for m in {DEFERRED!r} if m in sys.modules))"
+   result = subprocess.run([sys.executable, "-X", "importtime", "-c", check], capture_output=True, text=True,
+                           check=True, env={**os.environ, "PYTHONPATH": str(SRC)})
+   # the line of the module itself holds the cumulative time of everything it imported
+   line = next(line for line in result.stderr.splitlines() if line.rstrip().endswith(f"| {module}"))
+   return int(line.split("|")[1]) / 1000, [name for name in result.stdout.strip().split(",") if name]
+
+
+def main():
+   """Prints the import time table and exits with 1 if a budget or deferred import check fails."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--budget-ms", type=float, default=1000.0, help="import budget of the headless entry points")
+   parser.add_argument("--repeats", type=int, default=3)
+   args = parser.parse_args()
+
+   rows = []
+   for module in ["qupath_to_lmd", *HEADLESS, "qupath_to_lmd.core"]:
+      runs = [import_time(module) for _ in range(args.repeats)]
+      rows.append({"module": module, "import_ms": round(min(ms for ms, _ in runs), 1),
+                   "deferred_loaded": ", ".join(runs[0][1])})
+   table = pandas.DataFrame(rows)
+   print(table.to_string(index=False))
+
+   failures = []
+   for row in table[table["module"].isin(BUDGETED)].itertuples():
+      if row.import_ms > args.budget_ms:
+         failures.append(f"import {row.module} took {row.import_ms} ms, budget {args.budget_ms} ms")
+   for row in table[table["module"].isin(HEADLESS)].itertuples():
+      if row.deferred_loaded:
+         failures.append(f"{row.module} loads {row.deferred_loaded} at import")
+   for failure in failures:
+      print(f"FAIL: {failure}")
+   sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+   main()
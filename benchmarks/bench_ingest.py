@@ -0,0 +1,94 @@
+"""Benchmark eager vs streaming vs cached GeoJSON ingest on a synthetically scaled-up QuPath export.
+
+Usage:
+   python benchmarks/bench_ingest.py --scale 100
+
+The demo `Single_cells.geojson` is tiled `scale` times (shifted copies of every shape, calibration
+points kept once). Each ingest mode runs in a fresh subprocess so peak RSS is measured independently.
+The `cached` run repeats the streaming upload against the on-disk cache the earlier runs filled.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+DEMO = REPO / "demo_Qupath_project" / "Single_cells.geojson"
+
+
+def _shift(coords, dx):
+   if isinstance(coords[0], (int, float)):
+      return [coords[0] + dx, *coords[1:]]
+   return [_shift(c, dx) for c in coords]
+
+
+def write_scaled_geojson(path: Path, scale: int):
+   """Writes the demo file tiled `scale` times along x, one feature at a time."""
+   features = json.loads(DEMO.read_text())["features"]
+   shapes = [f for f in features if f["geometry"]["type"] != "Point"]
+   points = [f for f in features if f["geometry"]["type"] == "Point"]
+   with open(path, "w") as f:
+      f.write('{"type": "FeatureCollection", "features": [\n')
+      f.write(",\n".join(json.dumps(feature) for feature in points))
+      for i in range(scale):
+         for feature in shapes:
+            geometry = dict(feature["geometry"], coordinates=_shift(feature["geometry"]["coordinates"], i * 1000))
+            f.write(",\n" + json.dumps(dict(feature, geometry=geometry)))
+      f.write("\n]}\n")
+
+
+def run_mode(path: str, mode: str) -> dict:
+   """Loads `path` in one mode, meant to run in its own process so that its peak RSS counts alone."""
+   sys.path.insert(0, str(REPO / "src"))
+   from loguru import logger
+
+   logger.remove()
+   import contextlib
+   import io
+
+   from qupath_to_lmd.mock_streamlit import patch_streamlit
+
+   with contextlib.redirect_stdout(io.StringIO()):
+      patch_streamlit()
+      import qupath_to_lmd.core as core
+
+      start = time.perf_counter()
+      df, _ = core.load_and_QC_geojson_file(path, streaming=(mode != "eager"))
+      elapsed = time.perf_counter() - start
+   return {"mode": mode, "seconds": elapsed, "shapes": len(df),
+           "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def main():
+   """Tiles the demo file and compares time and peak memory of every ingest mode."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--scale", type=int, default=100, help="number of tiled copies of the demo file")
+   parser.add_argument("--mode", choices=["eager", "streaming", "cached"], help=argparse.SUPPRESS)
+   parser.add_argument("--path", help=argparse.SUPPRESS)
+   args = parser.parse_args()
+
+   if args.mode:
+      print(json.dumps(run_mode(args.path, args.mode)))
+      return
+
+   with tempfile.TemporaryDirectory() as tmp:
+      path = Path(tmp) / f"Single_cells_x{args.scale}.geojson"
+      write_scaled_geojson(path, args.scale)
+      size_mb = path.stat().st_size / 1e6
+      print(f"Synthetic file: {size_mb:.1f} MB")
+      env = dict(os.environ, QUPATH_TO_LMD_CACHE_DIR=str(Path(tmp) / "cache"))
+      for mode in ("eager", "streaming", "cached"):
+         out = subprocess.run([sys.executable, __file__, "--mode", mode, "--path", str(path)],
+                              check=True, capture_output=True, text=True, env=env).stdout
+         result = json.loads(out.strip().splitlines()[-1])
+         print(f"{mode:>10}: {result['seconds']:7.2f} s  peak RSS {result['peak_rss_mb']:8.1f} MB  "
+               f"({result['shapes']} shapes)")
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,76 @@
+"""Benchmark splitting classes into numbered replicates: row-wise loop vs grouped numbering.
+
+Usage:
+   python benchmarks/bench_make_unique.py --shapes 1000 10000 100000 1000000 --loop-limit 10000
+
+Half of the shapes belong to the class that is split, the rest is spread over nine other classes.
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import geopandas
+import numpy
+import pandas
+import shapely
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from loguru import logger
+
+import qupath_to_lmd.pipeline as pipeline
+import qupath_to_lmd.utils as utils
+
+logger.remove()
+
+
+def synthetic_classes(n: int, seed: int = 0) -> geopandas.GeoDataFrame:
+   """Shapes of which about half share one class, the rest spread over nine others."""
+   rng = numpy.random.default_rng(seed)
+   names = numpy.where(rng.random(n) < 0.5, "tumor", rng.choice([f"class_{i}" for i in range(9)], n))
+   colors = {name: [int(c) for c in rng.integers(0, 255, 3)] for name in numpy.unique(names)}
+   classification = [json.dumps({"name": name, "color": colors[name]}) for name in names]
+   return geopandas.GeoDataFrame(
+      {"classification": classification, "classification_name": pandas.Categorical(names)},
+      geometry=shapely.points(rng.uniform(0, 20000, (n, 2))))
+
+
+def row_wise(gdf: geopandas.GeoDataFrame, classes_to_modify: list) -> geopandas.GeoDataFrame:
+   """The previous implementation: one .loc assignment per shape, then every row rewritten."""
+   gdf = gdf.copy()
+   if 'original_classification_name' not in gdf.columns:
+      gdf['original_classification_name'] = gdf['classification_name']
+   gdf['classification_name'] = gdf['classification_name'].astype(object)
+   for class_name in classes_to_modify:
+      matching_indices = gdf[gdf['original_classification_name'] == class_name].index
+      for i, idx in enumerate(matching_indices):
+         gdf.loc[idx, 'classification_name'] = f"{class_name}_{str(i+1).zfill(3)}"
+   gdf['classification_name'] = gdf['classification_name'].astype('category')
+   return utils.update_classification_column(gdf=gdf)
+
+
+def main():
+   """Times the grouped numbering against the row-wise loop and checks both agree."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--shapes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+   parser.add_argument("--loop-limit", type=int, default=10000, help="skip the row-wise loop above this many shapes")
+   args = parser.parse_args()
+
+   for n in args.shapes:
+      gdf = synthetic_classes(n)
+      start = time.perf_counter()
+      result = pipeline.make_classes_unique(gdf, ["tumor"])
+      grouped = time.perf_counter() - start
+
+      loop = float("nan")
+      if n <= args.loop_limit:
+         start = time.perf_counter()
+         reference = row_wise(gdf, ["tumor"])
+         loop = time.perf_counter() - start
+         assert (reference['classification_name'].astype(str) == result['classification_name'].astype(str)).all()
+      print(f"{n:>9,} shapes: grouped {grouped:7.3f} s ({n / grouped:12,.0f} shapes/s)  row-wise {loop:8.3f} s")
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,46 @@
+"""Benchmark cut-path ordering: stage travel before and after, and time per slide size.
+
+Usage:
+   python benchmarks/bench_ordering.py --sizes 1000 10000 100000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy
+import pandas
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from bench_emit import synthetic_cells
+from loguru import logger
+
+import qupath_to_lmd.ordering as ordering
+import qupath_to_lmd.shapes as shapes
+
+logger.remove()
+
+
+def run(n: int) -> dict:
+   """Stage travel before and after ordering `n` synthetic cells, and the time it took."""
+   gdf = synthetic_cells(n)
+   coords, offsets = shapes.flat_coordinates(gdf.geometry.simplify(1))
+   start = time.perf_counter()
+   order, report = ordering.order_shapes(coords, offsets, gdf["well"])
+   seconds = time.perf_counter() - start
+   assert numpy.array_equal(numpy.sort(order), numpy.arange(n))
+   before, after = report["Stage travel before ordering"], report["Stage travel after ordering"]
+   return {"shapes": n, "travel before": before, "travel after": after,
+           "reduction": f"{before / after:.1f}x" if after else "-", "seconds": round(seconds, 3)}
+
+
+def main():
+   """Prints the ordering results for every size."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+   args = parser.parse_args()
+   print(pandas.DataFrame([run(n) for n in args.sizes]).to_string(index=False))
+
+
+if __name__ == "__main__":
+   main()
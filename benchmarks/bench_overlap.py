@@ -0,0 +1,62 @@
+"""Benchmark the STRtree overlap and proximity QC on tissue-like and densely overlapping cells.
+
+Usage:
+   python benchmarks/bench_overlap.py --sizes 10000 100000 1000000 --min-distance 2
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy
+import pandas
+import shapely
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from bench_emit import synthetic_cells
+from loguru import logger
+
+import qupath_to_lmd.qc as qc
+
+logger.remove()
+
+
+def tissue_cells(n: int, spacing: float = 25.0, seed: int = 0) -> tuple[numpy.ndarray, numpy.ndarray]:
+   """Cells on a jittered grid, mostly apart with a few overlapping or touching neighbours, as in segmented tissue."""
+   rng = numpy.random.default_rng(seed)
+   side = int(numpy.ceil(numpy.sqrt(n)))
+   grid = numpy.stack(numpy.meshgrid(numpy.arange(side), numpy.arange(side)), -1).reshape(-1, 2)[:n] * spacing
+   centers = grid + rng.normal(0, spacing / 8, grid.shape)
+   cells = shapely.buffer(shapely.points(centers), rng.uniform(4, 12, n), quad_segs=8)
+   return cells, rng.choice(["C3", "C5", "C7"], n)
+
+
+def run(layout: str, geoms: numpy.ndarray, wells: numpy.ndarray, min_distance: float) -> dict:
+   """Times proximity QC and the well contamination summary on one layout."""
+   start = time.perf_counter()
+   pairs = qc.proximity_qc(geoms, wells, min_distance=min_distance)
+   pairs_s = time.perf_counter() - start
+   start = time.perf_counter()
+   qc.well_contamination_summary(pairs, wells)
+   counts = pairs["kind"].value_counts()
+   return {"layout": layout, "shapes": len(geoms), **{kind: int(counts[kind]) for kind in qc.PAIR_KINDS},
+           "pairs s": round(pairs_s, 3), "summary s": round(time.perf_counter() - start, 3)}
+
+
+def main():
+   """Runs the proximity QC on a tissue-like and a dense layout for every size."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+   parser.add_argument("--min-distance", type=float, default=2.0)
+   args = parser.parse_args()
+
+   rows = []
+   for n in args.sizes:
+      rows.append(run("tissue", *tissue_cells(n), args.min_distance))
+      dense = synthetic_cells(n)
+      rows.append(run("dense", numpy.asarray(dense.geometry.array, dtype=object), dense["well"].to_numpy(), args.min_distance))
+   print(pandas.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+   main()
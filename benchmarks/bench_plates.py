@@ -0,0 +1,57 @@
+"""Time plate layout operations for every plate type with many candidate samples.
+
+Usage:
+   python benchmarks/bench_plates.py --samples 1000 10000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import pandas
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from loguru import logger
+
+import qupath_to_lmd.pipeline as pipeline
+import qupath_to_lmd.plates as plates
+import qupath_to_lmd.sharding as sharding
+import qupath_to_lmd.utils as utils
+
+logger.remove()
+
+
+def timed(func, *args, **kwargs) -> tuple[float, object]:
+   """Wall time of `func(*args, **kwargs)` in seconds and its result."""
+   start = time.perf_counter()
+   result = func(*args, **kwargs)
+   return time.perf_counter() - start, result
+
+
+def main():
+   """Times well lists, plate assignment, validation and the plate csv for every plate type."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--samples", type=int, nargs="+", default=[1000, 10000])
+   args = parser.parse_args()
+
+   rows = []
+   for plate_type in plates.PLATE_SHAPES:
+      for n_samples in args.samples:
+         classes = [f"sample_{i}" for i in range(n_samples)]
+         wells_s, wells = timed(utils.create_list_of_acceptable_wells, plate_type, margins=1)
+         assign_s, manifest = timed(sharding.assign_plates, classes, wells)
+         saw = sharding.plate_saws(manifest)[1]
+         check_s, _ = timed(pipeline.check_samples_and_wells, classes, saw, plate_type)
+         csv_s, _ = timed(
+            lambda saw=saw, plate_type=plate_type: utils.sample_placement(saw=saw, plate_type=plate_type).to_csv())
+         layout = plates.PlateLayout(plate_type)
+         frame = layout.place(saw).sample_frame()
+         to_saw_s, _ = timed(utils.dataframe_to_saw_dict, frame)
+         rows.append({"plate": plate_type, "samples": n_samples, "plates": int(manifest["plate"].max()),
+                      "acceptable_wells_ms": wells_s * 1e3, "assign_ms": assign_s * 1e3, "validate_ms": check_s * 1e3,
+                      "plate_csv_ms": csv_s * 1e3, "frame_to_saw_ms": to_saw_s * 1e3})
+   print(pandas.DataFrame(rows).round(2).to_string(index=False))
+
+
+if __name__ == "__main__":
+   main()
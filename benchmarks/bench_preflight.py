@@ -0,0 +1,68 @@
+"""Time the stage coordinate preflight on millions of vertices.
+
+Usage:
+   python benchmarks/bench_preflight.py --vertices 1000000 10000000
+
+For every size, random contours of 4 to 60 vertices are spread over a slide with a calibration
+triangle in one corner and sorted into 384 wells. `stage.preflight` transforms all vertices to
+stage coordinates, flags shapes outside the stage range or far outside the calibration triangle,
+and builds the stage bounding box of every well.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy
+import pandas
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from loguru import logger
+
+import qupath_to_lmd.stage as stage
+import qupath_to_lmd.utils as utils
+
+logger.remove()
+
+ORIENTATION = numpy.array([[1, 0], [0, -1]])
+SIDE = 100000.0
+
+
+def synthetic_outlines(vertices: int, rng: numpy.random.Generator) -> tuple[numpy.ndarray, numpy.ndarray, pandas.Series]:
+   """Flat coordinates, offsets and wells of random contours with about `vertices` vertices in all."""
+   sizes = rng.integers(4, 61, size=vertices // 32 + 1)
+   sizes = sizes[:numpy.searchsorted(numpy.cumsum(sizes), vertices) + 1]
+   offsets = numpy.concatenate([[0], numpy.cumsum(sizes)])
+   centres = rng.uniform(0, SIDE, size=(len(sizes), 2))
+   coords = numpy.repeat(centres, sizes, axis=0) + rng.normal(0, 20, size=(offsets[-1], 2))
+   wells = utils.create_list_of_acceptable_wells(plate="384", margins=1)
+   return coords, offsets, pandas.Series(numpy.array(wells)[rng.integers(0, len(wells), size=len(sizes))])
+
+
+def main():
+   """Times the preflight and the bare stage transform for every size."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--vertices", type=int, nargs="+", default=[1000000, 10000000])
+   parser.add_argument("--repeats", type=int, default=3)
+   args = parser.parse_args()
+
+   rng = numpy.random.default_rng(0)
+   calib = numpy.array([[0.0, 0.0], [SIDE / 2, 0.0], [0.0, SIDE / 2]])
+   rows = []
+   for vertices in args.vertices:
+      coords, offsets, wells = synthetic_outlines(vertices, rng)
+      best = float("inf")
+      for _ in range(args.repeats):
+         start = time.perf_counter()
+         checks = stage.preflight(coords, offsets, wells, calib, ORIENTATION, 100)
+         best = min(best, time.perf_counter() - start)
+      start = time.perf_counter()
+      stage.to_stage(coords, ORIENTATION, 100)
+      transform_ms = (time.perf_counter() - start) * 1000
+      rows.append({"vertices": len(coords), "shapes": len(offsets) - 1, "transform_ms": round(transform_ms, 1),
+                   "preflight_ms": round(best * 1000, 1), "wells": len(checks.wells), "flagged": len(checks.flagged)})
+   print(pandas.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+   main()
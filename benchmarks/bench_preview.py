@@ -0,0 +1,58 @@
+"""Benchmark the QC image: rasterized preview vs matplotlib plot, for growing shape counts.
+
+Usage:
+   python benchmarks/bench_preview.py --shapes 1000 10000 100000 --plot-limit 10000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from bench_emit import synthetic_cells
+from lmd.lib import Collection
+from loguru import logger
+
+import qupath_to_lmd.plotting as plotting
+import qupath_to_lmd.preview as preview
+import qupath_to_lmd.shapes as shapes
+
+logger.remove()
+
+
+def main():
+   """Times the rasterized preview against the matplotlib plot for every size."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--shapes", type=int, nargs="+", default=[1000, 10000, 100000])
+   parser.add_argument("--plot-limit", type=int, default=10000, help="skip matplotlib above this many shapes")
+   parser.add_argument("--size", type=int, default=1024)
+   args = parser.parse_args()
+
+   for n in args.shapes:
+      df = synthetic_cells(n)
+      df["geometry"] = df.geometry.simplify(1)
+      coords, offsets = shapes.flat_coordinates(df.geometry)
+      calibration = numpy.array([[0, 0], [20000, 0], [0, 20000]])
+
+      start = time.perf_counter()
+      raster = preview.render_preview(coords, offsets, df["well"], calibration_points=calibration, size=args.size)
+      png = preview.to_png(raster.image)
+      tiles = preview.preview_tiles(raster.image)
+      raster_time = time.perf_counter() - start
+
+      plot_time = float("nan")
+      if n <= args.plot_limit:
+         collection = Collection(calibration_points=calibration)
+         collection.orientation_transform = numpy.array([[1, 0], [0, -1]])
+         shapes.emit_shapes(collection, coords, offsets, df["well"])
+         start = time.perf_counter()
+         plotting.plot_collection(collection)
+         plot_time = time.perf_counter() - start
+      print(f"{n:>9,} shapes: raster {raster_time:6.3f} s ({len(png) / 1024:.0f} KiB, {len(tiles)} zoom levels)"
+            f"  matplotlib {plot_time:6.3f} s")
+
+
+if __name__ == "__main__":
+   main()
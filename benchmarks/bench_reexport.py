@@ -0,0 +1,72 @@
+"""Time re-exporting a collection after only the plate layout changed, with and without the intermediates cache.
+
+Usage:
+   python benchmarks/bench_reexport.py --sizes 10000 50000 --repeats 3
+
+For every size a synthetic slide (see `synthetic.py`) is exported once to fill the cache, then
+its classes are moved to other wells and it is exported again, `--repeats` times each with the
+intermediates cache and without it (no geometry version).
+"""
+import argparse
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import pandas
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+import synthetic
+from loguru import logger
+
+import qupath_to_lmd.pipeline as pipeline
+import qupath_to_lmd.utils as utils
+
+logger.remove()
+
+
+def best_of(repeats: int, func, *args, **kwargs) -> float:
+   """Best wall time of `repeats` calls of `func(*args, **kwargs)` in seconds."""
+   times = []
+   for _ in range(repeats):
+      start = time.perf_counter()
+      func(*args, **kwargs)
+      times.append(time.perf_counter() - start)
+   return min(times)
+
+
+def main():
+   """Times a first export and re-exports into other wells with and without the intermediates cache."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000])
+   parser.add_argument("--repeats", type=int, default=3)
+   args = parser.parse_args()
+
+   wells = utils.create_list_of_acceptable_wells(plate="384", margins=1)
+   rows = []
+   with tempfile.TemporaryDirectory() as tmp:
+      for size in args.sizes:
+         path = Path(tmp) / f"synthetic_{size}.geojson"
+         synthetic.write_feature_collection(path, size)
+         gdf, available_points = pipeline.load_geojson(path)
+         calib = pipeline.calibration_array(available_points)
+         classes = gdf["classification_name"].unique().tolist()
+         layouts = [{name: wells[(i + shift) % len(wells)] for i, name in enumerate(classes)} for shift in range(2)]
+         version = uuid.uuid4().hex
+
+         start = time.perf_counter()
+         pipeline.export_collection(gdf, calib, layouts[0], geometry_version=version)
+         first = time.perf_counter() - start
+         rows.append({
+            "shapes": len(gdf),
+            "first_export_s": round(first, 3),
+            "reexport_cached_s": round(best_of(args.repeats, pipeline.export_collection, gdf, calib, layouts[1],
+                                           geometry_version=version), 3),
+            "reexport_uncached_s": round(best_of(args.repeats, pipeline.export_collection, gdf, calib, layouts[1]), 3),
+         })
+   print(pandas.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+   main()
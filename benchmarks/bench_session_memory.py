@@ -0,0 +1,87 @@
+"""Measure what one session's shapes cost in memory as GeoDataFrame, compact form and spilled to disk.
+
+Usage:
+   python benchmarks/bench_session_memory.py --sizes 10000 100000
+
+For every size a synthetic slide (see `synthetic.py`) is loaded in a fresh subprocess, and the
+RSS growth is measured after storing it as a frame, evicting it to the compact form and spilling
+it to disk, together with the time to rebuild the GeoDataFrame from each form.
+"""
+import argparse
+import ctypes
+import gc
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas
+
+REPO = Path(__file__).resolve().parents[1]
+
+
+def release_memory():
+   """Collects garbage and returns freed heap pages to the OS, so the RSS shows what is still in use."""
+   gc.collect()
+   try:
+      ctypes.CDLL("libc.so.6").malloc_trim(0)
+   except (OSError, AttributeError):
+      pass
+
+
+def measure(path: str) -> dict:
+   """Memory of the session shapes as a frame, compacted and spilled to disk, run in its own process."""
+   sys.path.insert(0, str(REPO / "src"))
+   from loguru import logger
+
+   logger.remove()
+   import qupath_to_lmd.instrument as instrument
+   import qupath_to_lmd.pipeline as pipeline
+   import qupath_to_lmd.store as store
+
+   release_memory()
+   baseline = instrument.current_rss()
+   gdf, _ = pipeline.load_geojson(path)
+   shapes = store.GeometryStore(gdf, budget=1 << 40)
+   del gdf
+   release_memory()
+   row = {"shapes": len(shapes), "frame_mb": (instrument.current_rss() - baseline) / 2**20,
+          "estimated_frame_mb": shapes.memory()["memory_mb"]}
+   for state in ("compact", "disk"):
+      shapes.evict(to_disk=state == "disk")
+      release_memory()
+      row[f"{state}_mb"] = (instrument.current_rss() - baseline) / 2**20
+      start = time.perf_counter()
+      shapes.frame()
+      row[f"rebuild_from_{state}_s"] = time.perf_counter() - start
+   shapes.close()
+   return {key: round(value, 2) if isinstance(value, float) else value for key, value in row.items()}
+
+
+def main():
+   """Measures every size in a fresh process and prints the table."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+   parser.add_argument("--worker", help=argparse.SUPPRESS)
+   args = parser.parse_args()
+   if args.worker:
+      print(json.dumps(measure(args.worker)))
+      return
+
+   import synthetic
+
+   rows = []
+   with tempfile.TemporaryDirectory() as tmp:
+      for size in args.sizes:
+         path = Path(tmp) / f"synthetic_{size}.geojson"
+         synthetic.write_feature_collection(path, size)
+         out = subprocess.run([sys.executable, __file__, "--worker", str(path)],
+                              check=True, capture_output=True, text=True).stdout
+         rows.append(json.loads(out.strip().splitlines()[-1]))
+   print(pandas.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+   main()
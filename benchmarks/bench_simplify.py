@@ -0,0 +1,70 @@
+"""Benchmark fixed vs adaptive simplification on single cells mixed with large, detailed regions.
+
+Usage:
+   python benchmarks/bench_simplify.py --cells 50000 --regions 200 --vertex-budget 200
+"""
+import argparse
+import io
+import sys
+import time
+from pathlib import Path
+
+import geopandas
+import numpy
+import pandas
+import shapely
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from bench_emit import synthetic_cells
+from loguru import logger
+
+import qupath_to_lmd.pipeline as pipeline
+import qupath_to_lmd.simplify as simplify
+import qupath_to_lmd.xml_writer as xml_writer
+
+logger.remove()
+
+
+def synthetic_regions(n: int, vertices: int = 4000, seed: int = 1) -> geopandas.GeoDataFrame:
+   """Large tissue regions: wobbly outlines with `vertices` points each, as traced by hand or a brush."""
+   rng = numpy.random.default_rng(seed)
+   angles = numpy.linspace(0, 2 * numpy.pi, vertices, endpoint=False)
+   regions = []
+   for center, radius in zip(rng.uniform(0, 20000, (n, 2)), rng.uniform(200, 800, n), strict=True):
+      wobble = radius * (1 + 0.1 * numpy.sin(5 * angles + rng.uniform(0, 6)) + rng.normal(0, 0.002, vertices))
+      ring = numpy.column_stack([center[0] + wobble * numpy.cos(angles), center[1] + wobble * numpy.sin(angles)])
+      regions.append(shapely.Polygon(ring))
+   return geopandas.GeoDataFrame({"well": rng.choice(["D3", "D5"], n)}, geometry=regions)
+
+
+def run(gdf: geopandas.GeoDataFrame, settings: simplify.SimplifySettings | None) -> dict:
+   """Builds the collection with `settings` and reports time, vertices and area change."""
+   saw = {well: well for well in gdf["well"].unique()}
+   gdf = gdf.assign(classification_name=gdf["well"])
+   start = time.perf_counter()
+   collection, report = pipeline.build_collection(gdf, numpy.array([[0, 0], [20000, 0], [0, 20000]]), saw, settings)
+   build = time.perf_counter() - start
+   start = time.perf_counter()
+   size = xml_writer.write_collection_xml(collection, io.BytesIO())
+   return {**report, "build s": round(build, 3), "xml s": round(time.perf_counter() - start, 3), "xml MB": round(size / 1e6, 2)}
+
+
+def main():
+   """Compares the fixed tolerance with the vertex budget on cells and large regions."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--cells", type=int, default=50000)
+   parser.add_argument("--regions", type=int, default=200)
+   parser.add_argument("--vertex-budget", type=int, default=200)
+   parser.add_argument("--collection-budget", type=int, default=None)
+   parser.add_argument("--max-area-deviation", type=float, default=2.0, help="percent")
+   args = parser.parse_args()
+
+   gdf = pandas.concat([synthetic_cells(args.cells), synthetic_regions(args.regions)], ignore_index=True)
+   settings = simplify.SimplifySettings(args.vertex_budget or None, args.collection_budget or None,
+                                        args.max_area_deviation / 100)
+   rows = {"fixed": run(gdf, None), "adaptive": run(gdf, settings)}
+   print(pandas.DataFrame(rows).to_string())
+
+
+if __name__ == "__main__":
+   main()
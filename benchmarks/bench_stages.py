@@ -0,0 +1,231 @@
+"""Time and memory-profile every stage of the pipeline on synthetic whole-slide exports.
+
+Usage:
+   python benchmarks/bench_stages.py --sizes 1000 10000 100000 1000000
+   python benchmarks/bench_stages.py --compare benchmarks/results/stages-<old>.json benchmarks/results/stages-<new>.json
+
+For every size a QuPath-style FeatureCollection is generated (see `synthetic.py`) and the stages
+run one after the other in a fresh subprocess, the way the app calls them: loading and QC,
+triangle QC, making a class unique, building the collection (simplify, extract, new_shape, plot,
+save and the whole `pipeline.export_collection`), the plate csv, and sanitizing plus writing the processed
+GeoJSON. Every stage records wall time, CPU time and its peak RSS above the RSS it started with.
+Results are written as JSON, tagged with the commit, so runs of two commits can be compared.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import UTC, datetime
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+RESULTS_DIR = REPO / "benchmarks" / "results"
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+
+def current_rss() -> int:
+   """Resident set size of this process in bytes."""
+   with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakRss:
+   """Samples the RSS on a background thread and keeps the peak above the starting RSS."""
+
+   def __init__(self, interval: float = 0.002):
+      self.interval = interval
+      self.start_rss = self.peak_rss = current_rss()
+      self._done = threading.Event()
+      self._thread = threading.Thread(target=self._sample, daemon=True)
+
+   def _sample(self):
+      while not self._done.wait(self.interval):
+         self.peak_rss = max(self.peak_rss, current_rss())
+
+   def __enter__(self):
+      self._thread.start()
+      return self
+
+   def __exit__(self, *exc):
+      self._done.set()
+      self._thread.join()
+      self.peak_rss = max(self.peak_rss, current_rss())
+
+   @property
+   def delta_mb(self) -> float:
+      """Peak RSS above the RSS at the start in MB."""
+      return (self.peak_rss - self.start_rss) / 2**20
+
+
+def run_stages(path: str, info: dict) -> list[dict]:
+   """Runs all stages on one synthetic file and returns one result row per stage."""
+   os.environ["QUPATH_TO_LMD_CACHE_MAX_MB"] = "0"  # time the parser, not the cache
+   sys.path.insert(0, str(REPO / "src"))
+   from loguru import logger
+
+   logger.remove()
+   from qupath_to_lmd.mock_streamlit import patch_streamlit
+
+   with contextlib.redirect_stdout(io.StringIO()):
+      patch_streamlit()
+   import geopandas
+   import streamlit as st
+   from lmd.lib import Collection
+
+   import qupath_to_lmd.core as core
+   import qupath_to_lmd.pipeline as pipeline
+   import qupath_to_lmd.preview as preview
+   import qupath_to_lmd.shapes as shapes
+   import qupath_to_lmd.simplify as simplify
+   import qupath_to_lmd.store as store
+   import qupath_to_lmd.utils as utils
+   import qupath_to_lmd.xml_writer as xml_writer
+
+   rows = []
+
+   @contextlib.contextmanager
+   def stage(name: str):
+      counts = {}
+      with contextlib.redirect_stdout(io.StringIO()), PeakRss() as rss:
+         wall, cpu = time.perf_counter(), time.process_time()
+         yield counts
+         wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+      rows.append({"stage": name, "wall_s": round(wall, 4), "cpu_s": round(cpu, 4),
+                   "peak_rss_delta_mb": round(rss.delta_mb, 1), **counts})
+
+   with stage("load_and_QC_geojson_file") as counts:
+      gdf, available_points = core.load_and_QC_geojson_file(path)
+      counts["shapes"] = len(gdf)
+   st.session_state.shapes = store.GeometryStore(gdf)
+   st.session_state.calibs = info["calibration_points"]
+
+   with stage("perform_triangle_qc") as counts:
+      st.session_state.calib_array = core.perform_triangle_qc(gdf, available_points, info["calibration_points"])
+      counts["shapes"] = len(gdf)
+
+   with stage("make_classes_unique") as counts:
+      largest_class = gdf["classification_name"].value_counts().index[0]
+      core.make_classes_unique([largest_class])
+      counts["shapes"] = int((gdf["classification_name"] == largest_class).sum())
+   st.session_state.shapes.replace(gdf)  # the collection is built from the classes as exported
+
+   classes = gdf["classification_name"].cat.categories
+   saw = dict(zip(classes, utils.create_list_of_acceptable_wells("384")[:len(classes)], strict=True))
+   st.session_state.saw = saw
+   wells = gdf["classification_name"].map(saw)
+
+   with stage("create_collection.simplify") as counts:
+      simplified, _ = simplify.fixed_simplify(gdf.geometry)
+      counts["shapes"] = len(simplified)
+   with stage("create_collection.extract") as counts:
+      coords, offsets = shapes.flat_coordinates(simplified)
+      counts.update(shapes=len(offsets) - 1, vertices=len(coords))
+   with stage("create_collection.new_shape") as counts:
+      collection = Collection(calibration_points=st.session_state.calib_array)
+      collection.orientation_transform = pipeline.ORIENTATION_TRANSFORM
+      shapes.emit_shapes(collection, coords, offsets, wells)
+      counts.update(shapes=len(collection.shapes), wells=len(saw))
+   with stage("create_collection.plot") as counts:
+      preview.to_png(preview.render_collection_preview(collection).image)
+      counts["shapes"] = len(collection.shapes)
+   with tempfile.TemporaryFile() as sink, stage("create_collection.save") as counts:
+      counts["bytes"] = xml_writer.write_collection_xml(collection, sink)
+   del collection, coords, offsets, simplified
+   with tempfile.TemporaryFile() as sink, stage("export_collection") as counts:
+      pipeline.export_collection(gdf, st.session_state.calib_array, saw, xml_sink=sink)
+      counts.update(shapes=len(gdf), wells=len(saw))
+
+   with stage("sample_placement") as counts:
+      utils.sample_placement(saw=saw, plate_type="384")
+      counts["wells"] = len(saw)
+   with stage("sanitize_gdf") as counts:
+      sanitized = utils.sanitize_gdf(gdf)
+      counts["shapes"] = len(sanitized)
+   with tempfile.TemporaryDirectory() as tmp, stage("write_geojson") as counts:
+      geopandas.GeoDataFrame(sanitized).to_file(Path(tmp) / "processed.geojson", driver="GeoJSON")
+      counts["shapes"] = len(sanitized)
+   return rows
+
+
+def git_commit() -> tuple[str, bool]:
+   """Short hash of HEAD and whether tracked files have uncommitted changes."""
+   def git(*args):
+      return subprocess.run(["git", *args], cwd=REPO, capture_output=True, text=True).stdout.strip()
+   return git("rev-parse", "--short", "HEAD") or "unknown", bool(git("status", "--porcelain", "--untracked-files=no"))
+
+
+def run_suite(sizes: list[int], seed: int) -> dict:
+   """Runs all stages on a synthetic slide of every size and returns the report with its metadata."""
+   import synthetic
+
+   commit, dirty = git_commit()
+   report = {
+      "meta": {"commit": commit, "dirty": dirty, "timestamp": datetime.now(UTC).isoformat(timespec="seconds"),
+               "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+               "seed": seed},
+      "results": [],
+   }
+   with tempfile.TemporaryDirectory() as tmp:
+      for size in sizes:
+         path = Path(tmp) / f"synthetic_{size}.geojson"
+         start = time.perf_counter()
+         info = synthetic.write_feature_collection(path, size, seed=seed)
+         print(f"{size} shapes: generated {info['bytes'] / 1e6:.1f} MB in {time.perf_counter() - start:.1f} s",
+               file=sys.stderr)
+         out = subprocess.run([sys.executable, __file__, "--worker", str(path), json.dumps(info)],
+                              check=True, capture_output=True, text=True).stdout
+         for row in json.loads(out.strip().splitlines()[-1]):
+            report["results"].append({"size": size, "file_mb": round(info["bytes"] / 1e6, 1), **row})
+            print(f"{size:>8} {row['stage']:<28} {row['wall_s']:9.3f} s {row['peak_rss_delta_mb']:9.1f} MB",
+                  file=sys.stderr)
+         path.unlink()
+   return report
+
+
+def compare(old_path: Path, new_path: Path) -> str:
+   """Table of wall time and peak memory per size and stage of two result files."""
+   import pandas
+
+   old, new = (json.loads(Path(p).read_text()) for p in (old_path, new_path))
+   frames = [pandas.DataFrame(report["results"]).set_index(["size", "stage"])[["wall_s", "peak_rss_delta_mb"]]
+             for report in (old, new)]
+   table = frames[0].join(frames[1], lsuffix="_old", rsuffix="_new", how="outer")
+   table["wall_ratio"] = (table["wall_s_new"] / table["wall_s_old"]).round(2)
+   table["rss_ratio"] = (table["peak_rss_delta_mb_new"] / table["peak_rss_delta_mb_old"]).round(2)
+   return f"{old['meta']['commit']} -> {new['meta']['commit']}\n{table.to_string()}"
+
+
+def main():
+   """Runs the suite and writes the report, or compares two earlier reports."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+   parser.add_argument("--seed", type=int, default=0)
+   parser.add_argument("-o", "--output", type=Path, default=None,
+                       help="result file (default: benchmarks/results/stages-<commit>.json)")
+   parser.add_argument("--compare", type=Path, nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+   parser.add_argument("--worker", nargs=2, help=argparse.SUPPRESS)
+   args = parser.parse_args()
+
+   if args.worker:
+      print(json.dumps(run_stages(args.worker[0], json.loads(args.worker[1]))))
+      return
+   if args.compare:
+      print(compare(*args.compare))
+      return
+
+   report = run_suite(args.sizes, args.seed)
+   output = args.output or RESULTS_DIR / f"stages-{report['meta']['commit']}.json"
+   output.parent.mkdir(parents=True, exist_ok=True)
+   output.write_text(json.dumps(report, indent=1))
+   print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,76 @@
+"""Job queue stress check: submit more "Process files" jobs than the queue takes and cancel one.
+
+Usage:
+   python benchmarks/stress_jobs.py --size 20000 --jobs 6 --max-jobs 2 --max-queued 2
+
+All jobs export the same synthetic slide (see `synthetic.py`). Jobs beyond `--max-jobs` running
+and `--max-queued` waiting are rejected, the second accepted job is cancelled once it runs.
+Prints per job how long it waited, ran and what it ended as, and the most jobs seen running at once.
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+import synthetic
+from loguru import logger
+
+import qupath_to_lmd.core as core
+import qupath_to_lmd.jobs as jobs
+import qupath_to_lmd.pipeline as pipeline
+import qupath_to_lmd.utils as utils
+
+logger.remove()
+
+
+def main():
+   """Submits more jobs than may run at once, cancels some and checks every job ends in the right state."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--size", type=int, default=20000)
+   parser.add_argument("--jobs", type=int, default=6)
+   parser.add_argument("--max-jobs", type=int, default=2)
+   parser.add_argument("--max-queued", type=int, default=2)
+   args = parser.parse_args()
+
+   with tempfile.TemporaryDirectory() as tmp:
+      path = Path(tmp) / "synthetic.geojson"
+      synthetic.write_feature_collection(path, args.size)
+      gdf, available_points = pipeline.load_geojson(path)
+   calib = pipeline.calibration_array(available_points)
+   wells = utils.create_list_of_acceptable_wells(plate="384", margins=1)
+   saw = {name: wells[i % len(wells)] for i, name in enumerate(gdf["classification_name"].unique())}
+
+   queue = jobs.JobQueue(args.max_jobs, args.max_queued)
+   submitted, rejected = [], 0
+   for i in range(args.jobs):
+      try:
+         submitted.append(queue.submit(f"job_{i}", core.process_files, gdf, calib, saw, f"job_{i}"))
+      except jobs.QueueFull:
+         rejected += 1
+
+   victim = submitted[1] if len(submitted) > 1 else None
+   cancelled_at = None
+   peak_running = 0
+   while not all(job.finished for job in submitted):
+      peak_running = max(peak_running, sum(job.state == jobs.RUNNING for job in submitted))
+      if victim is not None and cancelled_at is None and victim.state == jobs.RUNNING:
+         victim.cancel()
+         cancelled_at = time.monotonic()
+      time.sleep(0.01)
+
+   rows = [{"job": job.name, "state": job.state,
+            "waited_s": round((job.started or job.finished_at) - job.submitted, 2), "ran_s": round(job.elapsed, 2),
+            "zip_mb": round(job.result.bundle.size / 2**20, 1) if job.state == jobs.DONE else None}
+           for job in submitted]
+   print(pandas.DataFrame(rows).to_string(index=False))
+   print(f"{len(submitted)} accepted, {rejected} rejected, at most {peak_running} running at once")
+   if cancelled_at is not None:
+      print(f"cancellation took {victim.finished_at - cancelled_at:.2f} s")
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,67 @@
+"""Concurrency stress check: run N pipelines at once in threads and verify every output.
+
+Usage:
+   python benchmarks/stress_sessions.py --sessions 16
+
+Every simulated session loads the demo slide, splits the single cell class and exports the
+collection with its own plate layout. Each result is compared with a sequential reference run of
+the same inputs; the script exits non-zero if any session got a different or mixed-up output.
+tests/test_concurrency.py runs the same comparison for a few sessions with pytest.
+"""
+import argparse
+import hashlib
+import string
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from loguru import logger
+
+import qupath_to_lmd.pipeline as pipeline
+
+logger.remove()
+REPO = Path(__file__).resolve().parents[1]
+DEMO = REPO / "demo_Qupath_project" / "Single_cells.geojson"
+
+
+def run_session(session: int) -> dict:
+   """One full pipeline whose plate layout depends on the session number."""
+   gdf, points = pipeline.load_geojson(DEMO)
+   gdf = pipeline.make_classes_unique(gdf, ["single_cells_demo"])
+   wells = [f"{row}{col}" for row in string.ascii_uppercase[2:14] for col in range(3, 23)]
+   classes = sorted(gdf["classification_name"].unique())
+   shift = session % len(wells)
+   saw = {name: wells[(i + shift) % len(wells)] for i, name in enumerate(classes)}
+   artifacts = pipeline.export_collection(gdf, pipeline.calibration_array(points), saw)
+   return {
+      "xml": hashlib.sha256(artifacts.xml).hexdigest(),
+      "csv": hashlib.sha256(artifacts.plate_csv.encode()).hexdigest(),
+      "png": hashlib.sha256(artifacts.qc_png).hexdigest(),
+      "wells_ok": all(f"<CapID>{well}</CapID>" in artifacts.xml.decode() for well in saw.values()),
+   }
+
+
+def main():
+   """Runs the sessions concurrently, compares them with the sequential runs and exits 1 on a mismatch."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--sessions", type=int, default=16)
+   parser.add_argument("--layouts", type=int, default=4, help="number of distinct plate layouts among the sessions")
+   args = parser.parse_args()
+
+   references = {layout: run_session(layout) for layout in range(args.layouts)}
+
+   start = time.perf_counter()
+   with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+      results = list(pool.map(lambda s: run_session(s % args.layouts), range(args.sessions)))
+   elapsed = time.perf_counter() - start
+
+   failures = [s for s, result in enumerate(results)
+               if result != references[s % args.layouts] or not result["wells_ok"]]
+   print(f"{args.sessions} concurrent sessions in {elapsed:.2f} s, {len(failures)} mismatching outputs")
+   sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+   main()
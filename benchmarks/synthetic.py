@@ -0,0 +1,126 @@
+"""Synthetic QuPath-style whole-slide exports for benchmarks.
+
+Usage:
+   python benchmarks/synthetic.py 100000 slide_100k.geojson
+
+The FeatureCollection mixes what QuPath exports from a real slide: three calibration points,
+a few large tissue annotations and cutting lines, and many single cells (objectType "cell")
+with measurements, spread over several classes with some unclassified detections.
+Features are generated and written in chunks, so even 1M shapes need little memory.
+"""
+import argparse
+import json
+from pathlib import Path
+
+import numpy
+
+CELL_CLASSES = ["CD3_positive", "CD8_positive", "PanCK_positive", "Stroma", "Immune_other"]
+ANNOTATION_CLASSES = ["Tumor", "Tissue"]
+MEASUREMENTS = ["Cell: Area", "Cell: Perimeter", "Cell: Circularity", "Nucleus: Area",
+                "DAPI mean", "CD3 mean", "CD8 mean", "PanCK mean"]
+COLORS = {name: [int(c) for c in numpy.random.default_rng(i).integers(0, 256, 3)]
+          for i, name in enumerate(CELL_CLASSES + ANNOTATION_CLASSES)}
+CELL_SPACING = 25.0
+CHUNK_SIZE = 10000
+
+
+def slide_side(n_shapes: int) -> float:
+   """Side length in pixels of a square slide that fits `n_shapes` cells at tissue density."""
+   return float(max(numpy.sqrt(n_shapes) * CELL_SPACING, 2000.0))
+
+
+def _ring(center: numpy.ndarray, radius: numpy.ndarray, vertices: int, rng: numpy.random.Generator) -> numpy.ndarray:
+   """Closed, irregular rings of shape (n, vertices + 1, 2), traced like QuPath contours."""
+   angles = numpy.linspace(0, 2 * numpy.pi, vertices, endpoint=False)
+   wobble = radius[:, None] * (1 + 0.15 * numpy.sin(3 * angles + rng.uniform(0, 6, (len(center), 1))))
+   ring = center[:, None, :] + wobble[..., None] * numpy.stack([numpy.cos(angles), numpy.sin(angles)], -1)
+   return numpy.round(numpy.concatenate([ring, ring[:, :1]], axis=1), 2)
+
+
+def _feature(geometry_type: str, coordinates: list, properties: dict, i: int) -> str:
+   return json.dumps({"type": "Feature", "id": f"{i:08x}-0000-4000-8000-000000000000",
+                      "geometry": {"type": geometry_type, "coordinates": coordinates}, "properties": properties})
+
+
+def calibration_features(side: float) -> list[str]:
+   """The three calibration point features near three corners of the slide."""
+   points = [[side * 0.01, side * 0.01], [side * 0.99, side * 0.02], [side * 0.02, side * 0.99]]
+   return [_feature("Point", point, {"objectType": "annotation", "name": f"calib{i + 1}"}, i)
+           for i, point in enumerate(points)]
+
+
+def annotation_features(n: int, side: float, rng: numpy.random.Generator, start: int) -> list[str]:
+   """Large tissue regions with hundreds of vertices, every fourth one a cutting LineString."""
+   rings = _ring(rng.uniform(side * 0.1, side * 0.9, (n, 2)), rng.uniform(side * 0.02, side * 0.08, n), 400, rng)
+   features = []
+   for i, ring in enumerate(rings):
+      name = ANNOTATION_CLASSES[i % len(ANNOTATION_CLASSES)]
+      properties = {"objectType": "annotation", "classification": {"name": name, "color": COLORS[name]}}
+      if i % 4 == 3:
+         features.append(_feature("LineString", ring[:200].tolist(), properties, start + i))
+      else:
+         features.append(_feature("Polygon", [ring.tolist()], properties, start + i))
+   return features
+
+
+def cell_features(n: int, side: float, rng: numpy.random.Generator, start: int, id_offset: int,
+                  unclassified_fraction: float = 0.02) -> list[str]:
+   """Single cells `start` to `start + n` of a jittered grid, with 16-24 vertices and measurements."""
+   columns = int(side // CELL_SPACING)
+   grid = numpy.arange(start, start + n)
+   centers = numpy.column_stack([grid % columns, grid // columns]) * CELL_SPACING + CELL_SPACING / 2
+   centers += rng.normal(0, CELL_SPACING / 8, centers.shape)
+   radius = rng.uniform(4, 11, n)
+   vertex_counts = rng.choice([16, 20, 24], n)
+   classes = rng.integers(0, len(CELL_CLASSES), n)
+   unclassified = rng.random(n) < unclassified_fraction
+   values = numpy.round(rng.gamma(2.0, 50.0, (n, len(MEASUREMENTS))), 3)
+
+   features = [""] * n
+   for vertices in (16, 20, 24):
+      members = numpy.flatnonzero(vertex_counts == vertices)
+      for j, ring in zip(members.tolist(), _ring(centers[members], radius[members], vertices, rng), strict=True):
+         properties = {"objectType": "cell"}
+         if not unclassified[j]:
+            name = CELL_CLASSES[classes[j]]
+            properties["classification"] = {"name": name, "color": COLORS[name]}
+         properties["measurements"] = dict(zip(MEASUREMENTS, values[j].tolist(), strict=True))
+         features[j] = _feature("Polygon", [ring.tolist()], properties, id_offset + start + j)
+   return features
+
+
+def write_feature_collection(path, n_shapes: int, seed: int = 0, annotation_fraction: float = 0.001) -> dict:
+   """Writes a synthetic QuPath export with `n_shapes` shapes (plus three calibration points).
+
+   Returns:
+      A summary with the number of cells, annotations, the calibration point names and the slide size.
+   """
+   rng = numpy.random.default_rng(seed)
+   side = slide_side(n_shapes)
+   n_annotations = max(1, int(n_shapes * annotation_fraction)) if n_shapes > 1 else 0
+   n_cells = n_shapes - n_annotations
+   with open(path, "w") as f:
+      f.write('{"type": "FeatureCollection", "features": [\n')
+      f.write(",\n".join(calibration_features(side)))
+      for feature in annotation_features(n_annotations, side, rng, 3):
+         f.write(",\n" + feature)
+      for start in range(0, n_cells, CHUNK_SIZE):
+         chunk = cell_features(min(CHUNK_SIZE, n_cells - start), side, rng, start, 3 + n_annotations)
+         f.write(",\n" + ",\n".join(chunk))
+      f.write("\n]}\n")
+   return {"cells": n_cells, "annotations": n_annotations, "calibration_points": ["calib1", "calib2", "calib3"],
+           "side": side, "bytes": Path(path).stat().st_size}
+
+
+def main():
+   """Writes a synthetic export with the given number of shapes."""
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("shapes", type=int)
+   parser.add_argument("path", type=Path)
+   parser.add_argument("--seed", type=int, default=0)
+   args = parser.parse_args()
+   print(write_feature_collection(args.path, args.shapes, args.seed))
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,276 @@
+import contextlib
+import contextvars
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from loguru import logger
+
+SPOOL_MAX_MB_ENV = "QUPATH_TO_LMD_SPOOL_MAX_MB"
+DEFAULT_SPOOL_MAX_MB = 64
+# compressed entries larger than this move from memory to a temporary file while the bundle is built
+ENTRY_SPOOL_BYTES = 8 << 20
+CHUNK_SIZE = 1 << 20
+COMPRESS_LEVEL = 6
+
+_STORED, _DEFLATED = 0, 8
+_UTF8_FLAG = 0x800
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP64_COUNT_LIMIT = 0xFFFF
+
+
+def spool_max_bytes() -> int:
+   """Size up to which a finished bundle stays in memory, from QUPATH_TO_LMD_SPOOL_MAX_MB."""
+   return int(float(os.environ.get(SPOOL_MAX_MB_ENV, DEFAULT_SPOOL_MAX_MB)) * 2**20)
+
+
+class _EntrySink:
+   """Writable sink of one zip entry that compresses and checksums everything written to it."""
+
+   def __init__(self, compress: bool, level: int = COMPRESS_LEVEL):
+      self.method = _DEFLATED if compress else _STORED
+      self.crc = 0
+      self.size = 0
+      self.data = tempfile.SpooledTemporaryFile(max_size=ENTRY_SPOOL_BYTES)
+      self._compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if compress else None
+      self._finished = False
+
+   @property
+   def closed(self) -> bool:
+      """True once the entry is finished, writers such as pyarrow check it before writing."""
+      return self._finished
+
+   def writable(self) -> bool:
+      """Always True, the sink is write-only."""
+      return True
+
+   def tell(self) -> int:
+      """Uncompressed bytes written so far."""
+      return self.size
+
+   def flush(self):
+      """Nothing to do, compressed data is flushed by `finish`."""
+
+   def write(self, data) -> int:
+      """Compresses and checksums `data` (bytes or str) into the entry."""
+      if isinstance(data, str):
+         data = data.encode()
+      self.crc = zlib.crc32(data, self.crc)
+      self.size += len(data)
+      self.data.write(self._compressor.compress(data) if self._compressor else data)
+      return len(data)
+
+   def finish(self):
+      """Flushes the compressor, nothing can be written afterwards."""
+      if self._compressor is not None:
+         self.data.write(self._compressor.flush())
+         self._compressor = None
+      self._finished = True
+
+   @property
+   def compressed_size(self) -> int:
+      return self.data.tell()
+
+
+class Bundle:
+   """A finished zip archive in a spooled temporary file, in memory when small and on disk when large.
+
+   This handle is all a session keeps of its output; the archive itself is only read when it is downloaded.
+   """
+
+   def __init__(self, file, size: int, names: list[str]):
+      self.file = file
+      self.size = size
+      self.names = names
+      self._lock = threading.Lock()
+
+   @property
+   def in_memory(self) -> bool:
+      """Whether the archive is still held in memory, i.e. its spooled file has not rolled over to disk."""
+      return isinstance(self.file, tempfile.SpooledTemporaryFile) and not self.file._rolled
+
+   def read(self) -> bytes:
+      """The whole archive as bytes."""
+      with self._lock:
+         self.file.seek(0)
+         return self.file.read()
+
+   def iter_chunks(self, chunk_size: int = CHUNK_SIZE):
+      """Yields the archive in chunks, e.g. to stream it into a response or a file."""
+      with self._lock:
+         self.file.seek(0)
+         while chunk := self.file.read(chunk_size):
+            yield chunk
+
+   def close(self):
+      """Closes the archive, a file on disk is deleted."""
+      self.file.close()
+
+   def __len__(self) -> int:
+      return self.size
+
+
+class BundleWriter:
+   """Builds a zip archive whose entries are produced and compressed concurrently.
+
+   Entries are added as bytes, files, or producer functions that write into a sink. Everything but
+   `open` runs on a thread pool (zlib releases the GIL), every entry compresses into its own spooled
+   buffer, and `close` assembles the entries in the order they were added.
+
+   Example:
+      with BundleWriter() as writer:
+         with writer.open("slide.xml") as sink:
+            xml_writer.write_collection_xml(collection, sink)
+         writer.add("samples_and_wells.json", json.dumps(saw))
+         writer.add_task("slide_processed.geojson", write_geojson)
+      bundle = writer.bundle
+   """
+
+   def __init__(self, workers: int | None = None, level: int = COMPRESS_LEVEL, spool_max: int | None = None):
+      self.level = level
+      self.spool_max = spool_max_bytes() if spool_max is None else spool_max
+      self.bundle = None
+      self._entries = []
+      self._pool = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1),
+                                      thread_name_prefix="bundle")
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc, tb):
+      if exc_type is None:
+         self.close()
+      else:
+         self._pool.shutdown(wait=True, cancel_futures=True)
+         self._discard()
+
+   def _discard(self):
+      for _, future in self._entries:
+         if future.done() and not future.cancelled() and future.exception() is None:
+            future.result()[0].data.close()
+
+   def _submit(self, name: str, produce: Callable, compress: bool) -> Future:
+      def run():
+         sink = _EntrySink(compress, self.level)
+         result = produce(sink)
+         sink.finish()
+         return sink, result
+
+      # producers run in a copy of the caller's context, so their instrumentation spans reach the caller's report
+      future = self._pool.submit(contextvars.copy_context().run, run)
+      self._entries.append((name, future))
+      return future
+
+   def add(self, name: str, data: bytes | str, compress: bool = True):
+      """Adds an entry with the given content, compressed on the pool."""
+      self._submit(name, lambda sink: sink.write(data), compress)
+
+   def add_file(self, name: str, path, compress: bool = True):
+      """Adds an entry with the content of a file, read and compressed on the pool."""
+      def copy(sink):
+         with open(path, "rb") as f:
+            shutil.copyfileobj(f, sink, CHUNK_SIZE)
+      self._submit(name, copy, compress)
+
+   def add_task(self, name: str, produce: Callable, compress: bool = True) -> Future:
+      """Adds an entry that `produce(sink)` writes on the pool.
+
+      Returns:
+         A future of what `produce` returns, e.g. other artifacts it made along the way.
+      """
+      result = Future()
+
+      def relay(future: Future):
+         if future.cancelled():
+            result.cancel()
+         elif future.exception() is not None:
+            result.set_exception(future.exception())
+         else:
+            result.set_result(future.result()[1])
+
+      self._submit(name, produce, compress).add_done_callback(relay)
+      return result
+
+   @contextlib.contextmanager
+   def open(self, name: str, compress: bool = True):
+      """Sink of an entry that is written on the calling thread, e.g. by code that needs the Streamlit session."""
+      sink = _EntrySink(compress, self.level)
+      try:
+         yield sink
+         sink.finish()
+      except BaseException:
+         # an entry whose writer failed is dropped, not bundled half-written
+         sink.data.close()
+         raise
+      future = Future()
+      future.set_result((sink, None))
+      self._entries.append((name, future))
+
+   def close(self) -> Bundle:
+      """Waits for all entries and writes the archive into a spooled temporary file."""
+      start = time.perf_counter()
+      archive = tempfile.SpooledTemporaryFile(max_size=self.spool_max) if self.spool_max > 0 else tempfile.TemporaryFile()
+      central = []
+      try:
+         for name, future in self._entries:
+            sink, _ = future.result()
+            central.append(_write_entry(archive, name, sink))
+         _write_central_directory(archive, central)
+      except BaseException:
+         archive.close()
+         self._pool.shutdown(wait=True, cancel_futures=True)
+         raise
+      finally:
+         self._pool.shutdown(wait=True)
+         self._discard()
+      size = archive.tell()
+      self.bundle = Bundle(archive, size, [name for name, _ in self._entries])
+      logger.debug(f"Bundled {len(central)} files into {size / 2**20:.1f} MB in {time.perf_counter() - start:.2f} s")
+      return self.bundle
+
+
+def _dos_time(timestamp: float) -> tuple[int, int]:
+   t = time.localtime(timestamp)
+   return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _write_entry(archive, name: str, sink: _EntrySink) -> tuple:
+   """Writes the local header and data of one entry, returns what the central directory needs."""
+   encoded = name.encode()
+   offset = archive.tell()
+   dos_time, dos_date = _dos_time(time.time())
+   zip64 = sink.size >= _ZIP64_LIMIT or sink.compressed_size >= _ZIP64_LIMIT
+   extra = struct.pack("<HHQQ", 1, 16, sink.size, sink.compressed_size) if zip64 else b""
+   archive.write(struct.pack(
+      "<IHHHHHIIIHH", 0x04034B50, 45 if zip64 else 20, _UTF8_FLAG, sink.method, dos_time, dos_date, sink.crc,
+      _ZIP64_LIMIT if zip64 else sink.compressed_size, _ZIP64_LIMIT if zip64 else sink.size, len(encoded), len(extra)))
+   archive.write(encoded + extra)
+   sink.data.seek(0)
+   shutil.copyfileobj(sink.data, archive, CHUNK_SIZE)
+   return encoded, sink.method, dos_time, dos_date, sink.crc, sink.compressed_size, sink.size, offset
+
+
+def _write_central_directory(archive, central: list[tuple]):
+   start = archive.tell()
+   for encoded, method, dos_time, dos_date, crc, compressed_size, size, offset in central:
+      # zip64 fields hold, in this order, whichever of the sizes and the offset do not fit 32 bits
+      wide = [value for value in (size, compressed_size, offset) if value >= _ZIP64_LIMIT]
+      extra = struct.pack(f"<HH{len(wide)}Q", 1, 8 * len(wide), *wide) if wide else b""
+      archive.write(struct.pack(
+         "<IHHHHHHIIIHHHHHII", 0x02014B50, (3 << 8) | 45, 45 if wide else 20, _UTF8_FLAG, method, dos_time, dos_date, crc,
+         min(compressed_size, _ZIP64_LIMIT), min(size, _ZIP64_LIMIT), len(encoded), len(extra), 0, 0, 0,
+         0o644 << 16, min(offset, _ZIP64_LIMIT)))
+      archive.write(encoded + extra)
+   end = archive.tell()
+   count, length = len(central), end - start
+   if count >= _ZIP64_COUNT_LIMIT or length >= _ZIP64_LIMIT or start >= _ZIP64_LIMIT:
+      archive.write(struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0, count, count, length, start))
+      archive.write(struct.pack("<IIQI", 0x07064B50, 0, end, 1))
+   archive.write(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, min(count, _ZIP64_COUNT_LIMIT),
+                             min(count, _ZIP64_COUNT_LIMIT), min(length, _ZIP64_LIMIT), min(start, _ZIP64_LIMIT), 0))
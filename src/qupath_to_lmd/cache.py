@@ -0,0 +1,147 @@
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import uuid
+from pathlib import Path
+
+import geopandas
+import pyarrow
+import pyarrow.parquet
+from loguru import logger
+
+CACHE_DIR_ENV = "QUPATH_TO_LMD_CACHE_DIR"
+CACHE_MAX_MB_ENV = "QUPATH_TO_LMD_CACHE_MAX_MB"
+DEFAULT_MAX_MB = 2048
+ROW_GROUP_SIZE = 4096
+# bump when the cleaned table layout changes, so stale entries are never read
+CACHE_VERSION = 2
+
+
+def content_hash(source, chunk_size: int = 1 << 20) -> str:
+   """Hashes a file path or file-like object (e.g. a Streamlit upload) chunk by chunk."""
+   digest = hashlib.blake2b(digest_size=20)
+   if isinstance(source, (str, Path)):
+      with open(source, "rb") as f:
+         for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+   else:
+      source.seek(0)
+      for chunk in iter(lambda: source.read(chunk_size), b""):
+         digest.update(chunk.encode() if isinstance(chunk, str) else chunk)
+      source.seek(0)
+   return digest.hexdigest()
+
+
+def content_key(source, parser: str) -> str:
+   """Cache key of a geojson: its content hash, the parser that cleaned it and the cache version."""
+   return f"{content_hash(source)}-{parser}-v{CACHE_VERSION}"
+
+
+def write_table(gdf: geopandas.GeoDataFrame, path, row_group_size: int = ROW_GROUP_SIZE):
+   """Writes a GeoDataFrame as GeoArrow-encoded Parquet, one row group at a time.
+
+   Converting in row groups keeps the Arrow copy of large text columns (e.g. measurements)
+   small, where `to_parquet` would briefly hold the whole table twice.
+   """
+   # the schema comes from the first non-null value of every column, so all-null chunks cast cleanly
+   first_valid = {gdf[column].first_valid_index() for column in gdf.columns} - {None}
+   sample = gdf.loc[sorted(first_valid)] if first_valid else gdf.iloc[:1]
+   schema = pyarrow.table(sample.to_arrow(index=True)).schema
+   with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+      for start in range(0, max(len(gdf), 1), row_group_size):
+         chunk = gdf.iloc[start:start + row_group_size]
+         writer.write_table(pyarrow.table(chunk.to_arrow(index=True)).cast(schema))
+
+
+def read_table(path) -> geopandas.GeoDataFrame:
+   """Reads a table written by `write_table`."""
+   return geopandas.GeoDataFrame.from_arrow(pyarrow.parquet.read_table(path))
+
+
+class ParsedCache:
+   """Content-addressed on-disk cache of cleaned geojson tables.
+
+   Every entry is a Parquet file with the cleaned shapes and a JSON sidecar with the
+   calibration points and QC report. Entries are written atomically, so concurrent sessions
+   can share a directory. Once the directory exceeds `max_bytes`, the least recently used
+   entries are evicted.
+   """
+
+   def __init__(self, directory, max_bytes: int = DEFAULT_MAX_MB * 2**20):
+      self.directory = Path(directory)
+      self.directory.mkdir(parents=True, exist_ok=True)
+      self.max_bytes = max_bytes
+
+   def _paths(self, key: str) -> tuple[Path, Path]:
+      return self.directory / f"{key}.parquet", self.directory / f"{key}.json"
+
+   def get(self, key: str) -> tuple[geopandas.GeoDataFrame, dict, dict | None] | None:
+      """Returns (gdf, available_points, report) for `key`, or None on a miss."""
+      table_path, meta_path = self._paths(key)
+      try:
+         meta = json.loads(meta_path.read_text())
+         gdf = read_table(table_path)
+         os.utime(table_path)
+      except FileNotFoundError:
+         return None
+      except Exception as e:  # noqa: BLE001
+         logger.warning(f"Ignoring unreadable cache entry {key}: {e}")
+         return None
+      logger.info(f"Loaded {len(gdf)} shapes from cache entry {key}")
+      return gdf, meta["available_points"], meta["report"]
+
+   def put(self, key: str, gdf: geopandas.GeoDataFrame, available_points: dict, report: dict | None = None):
+      """Stores a cleaned table and evicts old entries if the cache is over budget."""
+      table_path, meta_path = self._paths(key)
+      tmp_suffix = f".{uuid.uuid4().hex}.tmp"
+      tmp_table, tmp_meta = Path(f"{table_path}{tmp_suffix}"), Path(f"{meta_path}{tmp_suffix}")
+      try:
+         tmp_meta.write_text(json.dumps({"available_points": available_points, "report": report}))
+         write_table(gdf, tmp_table)
+         # the sidecar goes first, an entry only counts once its table exists
+         os.replace(tmp_meta, meta_path)
+         os.replace(tmp_table, table_path)
+      except Exception as e:  # noqa: BLE001
+         logger.warning(f"Could not write cache entry {key}: {e}")
+         tmp_meta.unlink(missing_ok=True)
+         tmp_table.unlink(missing_ok=True)
+         return
+      logger.debug(f"Stored cache entry {key} ({table_path.stat().st_size / 2**20:.1f} MB)")
+      self.evict()
+
+   def evict(self):
+      """Removes least recently used entries until the cache fits into `max_bytes`."""
+      entries = []
+      for table_path in self.directory.glob("*.parquet"):
+         meta_path = table_path.with_suffix(".json")
+         try:
+            stat = table_path.stat()
+            size = stat.st_size + (meta_path.stat().st_size if meta_path.exists() else 0)
+         except FileNotFoundError:
+            continue
+         entries.append((stat.st_mtime, size, table_path, meta_path))
+
+      total = sum(size for _, size, _, _ in entries)
+      for _, size, table_path, meta_path in sorted(entries):
+         if total <= self.max_bytes:
+            break
+         table_path.unlink(missing_ok=True)
+         meta_path.unlink(missing_ok=True)
+         total -= size
+         logger.debug(f"Evicted cache entry {table_path.stem}")
+
+
+@functools.cache
+def default_cache() -> ParsedCache | None:
+   """Cache configured by QUPATH_TO_LMD_CACHE_DIR and QUPATH_TO_LMD_CACHE_MAX_MB (0 disables it)."""
+   max_mb = float(os.environ.get(CACHE_MAX_MB_ENV, DEFAULT_MAX_MB))
+   if max_mb <= 0:
+      return None
+   directory = os.environ.get(CACHE_DIR_ENV) or Path(tempfile.gettempdir()) / "qupath_to_lmd_cache"
+   try:
+      return ParsedCache(directory, max_bytes=int(max_mb * 2**20))
+   except OSError as e:
+      logger.warning(f"Parsed geojson cache disabled, {directory} is not writable: {e}")
+      return None
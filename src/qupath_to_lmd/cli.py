@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pandas
+from loguru import logger
+
+SAW_SUFFIXES = ("_samples_and_wells.txt", "_samples_and_wells.json", ".txt", ".json")
+# QuPath exports as GeoJSON, or converted to GeoParquet or FlatGeobuf
+SLIDE_PATTERNS = ("*.geojson", "*.parquet", "*.fgb")
+LOG_FORMAT = "{time:HH:mm:ss.SS} | {level} | {message}"
+
+
+def find_samples_and_wells(geojson_path: Path, default: Path | None = None) -> Path | None:
+   """Returns the samples-and-wells file next to a geojson (`<stem>.txt`, `<stem>_samples_and_wells.json`, ...)."""
+   for suffix in SAW_SUFFIXES:
+      candidate = geojson_path.with_name(geojson_path.stem + suffix)
+      if candidate.exists():
+         return candidate
+   return default
+
+
+def _init_worker():
+   logger.remove()
+
+
+def _summary_row(stem: str) -> dict:
+   """Batch summary row of a slide before it is processed."""
+   return {"slide": stem, "status": "ok", "shapes": 0, "vertices": 0, "flagged_shapes": 0, "cross_well_pairs": None,
+           "seconds": 0.0, "error": ""}
+
+
+def process_slide(geojson_path: Path, saw_path: Path | None, output_dir: Path,
+                  calib_names: list | None = None, plate_type: str = "384", hifi_plot: bool = False,
+                  simplify_settings=None, optimize_order: bool = False, overlap_distance: float | None = None,
+                  bbox: tuple | None = None, processed_format: str = "geojson", stage_range: tuple | None = None) -> dict:
+   """Processes one slide and writes XML, plate CSV, QC PNG, processed shapes, log and run report into `output_dir/<stem>`.
+
+   Errors are caught and reported in the returned summary row, so that one bad slide does not stop a batch.
+   """
+   import qupath_to_lmd.instrument as instrument
+   import qupath_to_lmd.pipeline as pipeline
+   import qupath_to_lmd.utils as utils
+
+   stem = geojson_path.stem
+   slide_dir = output_dir / stem
+   slide_dir.mkdir(parents=True, exist_ok=True)
+   sink_id = logger.add(slide_dir / f"{stem}.log", format=LOG_FORMAT, level="DEBUG")
+   summary = _summary_row(stem)
+   start = time.perf_counter()
+   recorder = instrument.RunRecorder(stem)
+   token = instrument.activate(recorder)
+   try:
+      if saw_path is None:
+         raise FileNotFoundError(f"No samples and wells file found for {geojson_path.name}")
+      saw = utils.parse_dictionary_from_file(str(saw_path))
+      if not saw:
+         raise ValueError(f"Could not parse samples and wells from {saw_path.name}")
+
+      gdf, available_points = pipeline.load_geojson(geojson_path, bbox=bbox)
+      calib_array = pipeline.calibration_array(available_points, calib_names)
+      with open(slide_dir / f"{stem}.xml", "wb") as f:
+         artifacts = pipeline.export_collection(gdf, calib_array, saw, plate_type=plate_type, xml_sink=f,
+                                                hifi_plot=hifi_plot, simplify_settings=simplify_settings,
+                                                optimize_order=optimize_order, stage_range=stage_range)
+      artifacts.preflight.wells.to_csv(slide_dir / f"{stem}_well_bounds.csv", index=False)
+      if len(artifacts.preflight.flagged):
+         artifacts.preflight.flagged.to_csv(slide_dir / f"{stem}_flagged_shapes.csv", index=False)
+      (slide_dir / f"{stem}_{plate_type}_wellplate.csv").write_text(artifacts.plate_csv)
+      (slide_dir / f"{stem}_collection.png").write_bytes(artifacts.qc_png)
+      if overlap_distance is not None:
+         pairs, well_summary = pipeline.overlap_qc(gdf, saw, min_distance=overlap_distance)
+         pairs.to_csv(slide_dir / f"{stem}_overlap_pairs.csv", index=False)
+         well_summary.to_csv(slide_dir / f"{stem}_overlap_wells.csv")
+         summary["cross_well_pairs"] = int(pairs["cross_well"].sum())
+      with open(slide_dir / f"{stem}_processed{utils.PROCESSED_FORMATS[processed_format]}", "wb") as f:
+         utils.write_processed(gdf, f, processed_format)
+      summary["shapes"] = artifacts.stats["Number of shapes"]
+      summary["vertices"] = artifacts.stats["Number of vertices"]
+      summary["flagged_shapes"] = len(artifacts.preflight.flagged)
+      logger.success(f"Processed {stem}")
+   except Exception as e:  # noqa: BLE001
+      logger.exception(f"Processing {stem} failed")
+      summary.update(status="error", error=f"{type(e).__name__}: {e}")
+   finally:
+      summary["seconds"] = round(time.perf_counter() - start, 3)
+      instrument.deactivate(token)
+      (slide_dir / f"{stem}_run_report.json").write_text(recorder.to_json())
+      logger.remove(sink_id)
+   return summary
+
+
+def run_batch(input_dir: Path, output_dir: Path, saw: Path | None = None, workers: int | None = None,
+              calib_names: list | None = None, plate_type: str = "384",
+              hifi_plot: bool = False, simplify_settings=None, optimize_order: bool = False,
+              overlap_distance: float | None = None, bbox: tuple | None = None,
+              processed_format: str = "geojson", stage_range: tuple | None = None) -> pandas.DataFrame:
+   """Processes every .geojson, .parquet and .fgb in `input_dir` across a process pool and returns the per-slide summary.
+
+   Outputs are named by the file stem, so two inputs of the same slide (`slide.geojson` and
+   `slide.parquet`) are rejected. A worker that dies (e.g. killed for running out of memory) fails
+   the slides that had not finished, the others and the summary are still written.
+   """
+   slides = sorted(path for pattern in SLIDE_PATTERNS for path in input_dir.glob(pattern))
+   if not slides:
+      raise FileNotFoundError(f"No .geojson, .parquet or .fgb files found in {input_dir}")
+   stems = pandas.Series([path.stem for path in slides])
+   duplicates = sorted(stems[stems.duplicated()].unique())
+   if duplicates:
+      raise ValueError(f"Several input files share the stem {', '.join(duplicates)}, "
+                       "their outputs would overwrite each other. Keep one format per slide.")
+   workers = workers or min(len(slides), os.cpu_count() or 1)
+   output_dir.mkdir(parents=True, exist_ok=True)
+   logger.info(f"Processing {len(slides)} slides with {workers} workers")
+
+   start = time.perf_counter()
+   rows = []
+   with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+      futures = {
+         pool.submit(process_slide, path, find_samples_and_wells(path, saw), output_dir, calib_names, plate_type,
+                     hifi_plot, simplify_settings, optimize_order, overlap_distance, bbox, processed_format, stage_range): path
+         for path in slides
+      }
+      for future in as_completed(futures):
+         try:
+            row = future.result()
+         except BrokenProcessPool as e:
+            row = _summary_row(futures[future].stem)
+            row.update(status="error", error=f"{type(e).__name__}: {e}")
+         rows.append(row)
+         logger.info(f"{row['slide']}: {row['status']} in {row['seconds']:.2f} s {row['error']}")
+   wall_time = time.perf_counter() - start
+
+   summary = pandas.DataFrame(rows).sort_values("slide").reset_index(drop=True)
+   summary.to_csv(output_dir / "batch_summary.csv", index=False)
+   with open(output_dir / "batch_summary.json", "w") as f:
+      json.dump({"wall_seconds": round(wall_time, 3), "workers": workers, "slides": summary.to_dict("records")}, f, indent=2)
+   logger.info(f"Batch finished in {wall_time:.2f} s, {summary['seconds'].sum():.2f} s of slide time "
+               f"({(summary['status'] == 'error').sum()} errors)")
+   return summary
+
+
+def main(argv: list | None = None) -> int:
+   """Entry point of the `qupath-to-lmd` command."""
+   parser = argparse.ArgumentParser(prog="qupath-to-lmd", description="Convert QuPath geojson exports for LMD collection.")
+   subparsers = parser.add_subparsers(dest="command", required=True)
+
+   batch = subparsers.add_parser("batch", help="process a directory of geojson files in parallel")
+   batch.add_argument("input_dir", type=Path,
+                      help="directory with .geojson, .parquet or .fgb files and their samples and wells files")
+   batch.add_argument("-o", "--output", type=Path, default=None, help="output directory (default: <input_dir>/lmd_output)")
+   batch.add_argument("--saw", type=Path, default=None,
+                      help="samples and wells file used for slides without their own <stem>.txt/.json")
+   batch.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes (default: all cores)")
+   batch.add_argument("--calibs", nargs=3, default=None, metavar="NAME",
+                      help="names of the three calibration points (default: first three points in each file)")
+   batch.add_argument("--plate", choices=["384", "96", "1536"], default="384", help="plate type for the plate csv")
+   batch.add_argument("--hifi-plot", action="store_true",
+                      help="render the QC image with matplotlib instead of the fast raster preview")
+   batch.add_argument("--vertex-budget", type=int, default=None,
+                      help="adaptive simplification: max vertices per contour (default: fixed tolerance of 1)")
+   batch.add_argument("--collection-budget", type=int, default=None,
+                      help="adaptive simplification: max vertices of all contours of a slide")
+   batch.add_argument("--max-area-deviation", type=float, default=2.0,
+                      help="adaptive simplification: max area change per contour in percent (default: 2)")
+   batch.add_argument("--optimize-order", action="store_true",
+                      help="reorder the contours of every well to minimise stage travel (default: file order)")
+   batch.add_argument("--overlap-qc", type=float, default=None, metavar="DISTANCE",
+                      help="report overlapping, duplicated and contours closer than DISTANCE pixels (e.g. the laser kerf)")
+   batch.add_argument("--bbox", type=float, nargs=4, default=None, metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+                      help="only collect contours intersecting this region (GeoParquet and FlatGeobuf inputs only)")
+   batch.add_argument("--processed-format", choices=["geojson", "geoparquet", "flatgeobuf"], default="geojson",
+                      help="format of the processed shapes (default: geojson, which QuPath imports)")
+   batch.add_argument("--stage-range", type=int, nargs=4, default=None, metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+                      help="flag contours whose XML coordinates leave this range (default: the 32-bit integer range)")
+
+   args = parser.parse_args(argv)
+   logger.remove()
+   logger.add(sys.stderr, format=LOG_FORMAT, level="INFO")
+
+   simplify_settings = None
+   if args.vertex_budget or args.collection_budget:
+      from qupath_to_lmd.simplify import SimplifySettings
+      simplify_settings = SimplifySettings(args.vertex_budget, args.collection_budget, args.max_area_deviation / 100)
+
+   summary = run_batch(args.input_dir, args.output or args.input_dir / "lmd_output", saw=args.saw,
+                       workers=args.workers, calib_names=args.calibs, plate_type=args.plate, hifi_plot=args.hifi_plot,
+                       simplify_settings=simplify_settings, optimize_order=args.optimize_order,
+                       overlap_distance=args.overlap_qc, bbox=tuple(args.bbox) if args.bbox else None,
+                       processed_format=args.processed_format,
+                       stage_range=tuple(args.stage_range) if args.stage_range else None)
+   print(summary.to_string(index=False))
+   return int((summary["status"] == "error").any())
+
+
+if __name__ == "__main__":
+   sys.exit(main())
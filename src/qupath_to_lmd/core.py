@@ -1,21 +1,79 @@
-import ast
-import os
-import tempfile
+import functools
+import json
+from pathlib import Path
+from typing import NamedTuple
 
 import geopandas
 import numpy
-import shapely
+import pandas
 import streamlit as st
-from lmd.lib import Collection
 from loguru import logger
 
+import qupath_to_lmd.bundle as bundle
+import qupath_to_lmd.cache as cache
+import qupath_to_lmd.ingest as ingest
+import qupath_to_lmd.instrument as instrument
+import qupath_to_lmd.jobs as jobs
+import qupath_to_lmd.normalize as normalize
+import qupath_to_lmd.pipeline as pipeline
+import qupath_to_lmd.qc as qc
+import qupath_to_lmd.sharding as sharding
+import qupath_to_lmd.stage as stage
 import qupath_to_lmd.utils as utils
 
-@st.cache_data
-def load_and_QC_geojson_file(geojson_path: str) -> tuple[geopandas.GeoDataFrame, dict]:
-   """Checks and load the geojson. Returns cleaned GDF and available calibration points."""
+
+@instrument.timed()
+def load_and_QC_geojson_file(geojson_path: str, streaming: bool = False) -> tuple[geopandas.GeoDataFrame, dict]:
+   """Checks and load the geojson. Returns cleaned GDF and available calibration points.
+
+   With `streaming=True` the file is parsed one feature at a time and QC'ed in the same pass,
+   which keeps peak memory close to the size of the cleaned table (useful for whole-slide single cell exports).
+   GeoParquet and FlatGeobuf files are recognized by their content and read as columns
+   (see `ingest.read_columnar`), `streaming` only applies to GeoJSON.
+   Geometries are then repaired, exploded and oriented (see `normalize.normalize_geometries`) and
+   summarized in one QC table. Cleaned tables are kept in the on-disk cache keyed by file content,
+   so repeat uploads skip parsing and normalization.
+   """
    logger.info(f"Starting load_and_QC_geojson_file for path: {geojson_path}")
+   parsed_cache = cache.default_cache()
+   file_format = ingest.detect_format(geojson_path)
+   parser = file_format if file_format != "geojson" else "streaming" if streaming else "geopandas"
+   key = None
+   if parsed_cache is not None:
+      key = cache.content_key(geojson_path, parser=parser)
+      cached = parsed_cache.get(key)
+      if cached is not None:
+         df, available_points, report = cached
+         if "n_features" in report:
+            _report_streaming_qc(report, available_points)
+         else:
+            geometry_counts = df.geometry.geom_type.value_counts()
+            st.write("Geometries in DataFrame: " + ", ".join(f"{count} {geom_type}s" for geom_type, count in geometry_counts.items()))
+            st.success('The file QC is complete (loaded from cache)')
+         _report_normalization(report["normalization"])
+         instrument.count(shapes=len(df), cached=1)
+         return df, available_points
+
+   if parser != "geopandas":
+      try:
+         df, available_points, report = ingest.read_shapes(geojson_path)
+      except ValueError as e:
+         st.error(str(e))
+         logger.error(str(e))
+         st.stop()
+      _report_streaming_qc(report, available_points)
+   else:
+      df, available_points = _load_and_QC_geojson_default(geojson_path)
+      report = {}
+   df, report["normalization"] = normalize.normalize_geometries(df)
+   _report_normalization(report["normalization"])
+   if parsed_cache is not None:
+      parsed_cache.put(key, df, available_points, report)
+   instrument.count(shapes=len(df))
+   return df, available_points
 
+def _load_and_QC_geojson_default(geojson_path) -> tuple[geopandas.GeoDataFrame, dict]:
+   """Reads the whole geojson with geopandas and QCs it."""
    # 1 Digestion
    df = geopandas.read_file(geojson_path)
    logger.info(f"Geojson file loaded with shape {df.shape}")
@@ -59,21 +117,49 @@ def load_and_QC_geojson_file(geojson_path: str) -> tuple[geopandas.GeoDataFrame,
       df = df[df['classification'].notna()]
 
    #get classification name from inside geometry properties
-   df['classification_name'] = df['classification'].apply(lambda x: ast.literal_eval(x).get('name') if isinstance(x, str) else x.get('name'))
-
-   #check for MultiPolygon objects
-   if 'MultiPolygon' in df.geometry.geom_type.value_counts().keys():
-      logger.debug(f"{df[df.geometry.geom_type == 'MultiPolygon'].shape[0]} MultiPolygons found")
-      st.write('MultiPolygon objects present:')
-      st.table(df[df.geometry.geom_type == 'MultiPolygon'][['annotation_name','classification_name']])
-      st.write('these are not supported, please convert them to polygons in Qupath',
-      'the script will continue but these objects will be ignored')
-      df = df[df.geometry.geom_type != 'MultiPolygon']
+   df['classification_name'] = utils.parse_classification_names(df['classification'])
 
    st.success('The file QC is complete')
    logger.success("GeoJSON file QC performed")
    return df, available_points
 
+def _report_streaming_qc(report: dict, available_points: dict):
+   """Shows the QC messages of a streaming read, the same as the geopandas path reports them."""
+   if report["n_features"] == 0:
+      st.warning("The uploaded geojson file is empty.")
+      logger.warning("The uploaded geojson file is empty.")
+      st.stop()
+   if not report["has_name"]:
+      st.warning("No 'name' column found, cannot identify calibration points.")
+      logger.warning("No 'name' column found in GeoJSON.")
+      st.stop()
+
+   log_message = ", ".join(f"{count} {geom_type}s" for geom_type, count in report["geometry_counts"].items())
+   logger.info(f"Geometries in DataFrame: {log_message}")
+   st.write(f"Geometries in DataFrame: {log_message}")
+   logger.info(f"Found {len(available_points)} potential calibration points: {list(available_points.keys())}")
+
+   if report["n_unclassified"] != 0:
+      logger.debug(f"you have {report['n_unclassified']} NaNs in your classification column")
+      st.write(f"you have {report['n_unclassified']} NaNs in your classification column",
+            "these are unclassified objects from Qupath, they will be ignored")
+
+   st.success('The file QC is complete')
+   logger.success("GeoJSON file QC performed")
+
+def _report_normalization(summary: dict):
+   """Shows what the geometry normalization repaired, exploded or dropped, as one table."""
+   counts = {key: value for key, value in summary.items() if key != "issues"}
+   logger.info(f"Geometry normalization: {counts}")
+   if not summary["issues"]:
+      return
+   st.warning(f"{counts['Invalid shapes repaired']} invalid shapes were repaired, {counts['Multi-part shapes exploded']} "
+              f"multi-part shapes were split into their parts and {counts['Shapes dropped (empty, collapsed or points)']} "
+              "shapes that cannot be cut were dropped")
+   st.write(counts)
+   st.dataframe(pandas.DataFrame(summary["issues"]))
+
+@instrument.timed()
 def perform_triangle_qc(df: geopandas.GeoDataFrame, calib_points_dict: dict, selected_calib_names: list) -> numpy.ndarray:
    """Performs the triangle intersection QC check."""
    logger.info("Starting triangle QC check")
@@ -86,28 +172,28 @@ def perform_triangle_qc(df: geopandas.GeoDataFrame, calib_points_dict: dict, sel
 
    calib_np_array = numpy.array([calib_points_dict[name] for name in selected_calib_names])
    logger.info(f"Calib_array set to {calib_np_array}")
+   angle = stage.smallest_angle(calib_np_array)
+   if angle < stage.MIN_TRIANGLE_ANGLE:
+      st.warning(f"WARNING: The calibration points are almost on a line (smallest angle {angle:.1f} degrees), "
+                 "every error in finding them on the stage is magnified far from them. Choose points that span a triangle.")
+      logger.warning(f"Calibration triangle is degenerate, smallest angle {angle:.1f} degrees")
 
-   def polygon_intersects_triangle(polygon, triangle):
-      if isinstance(polygon, shapely.Polygon):
-         return polygon.intersects(triangle)
-      elif isinstance(polygon, shapely.LineString):
-         return polygon.intersects(triangle)
-      else:
-         return False  # for other geometry types
+   qc_table = qc.triangle_qc(df['geometry'], calib_np_array)
+   instrument.count(shapes=len(df))
+   is_polygon_or_line = df['geometry'].geom_type.isin(['Polygon', 'LineString']).to_numpy()
+   num_of_polygons_and_LineString = int(is_polygon_or_line.sum())
 
-   # how many polygons intersect the triangle made by calibs?
-   # Note: we use a copy or just calculate on the fly to avoid modifying the passed df permanently if not needed
-   # But user might want to know.
-   
-   triangle = shapely.Polygon(calib_np_array)
-   intersects = df['geometry'].apply(lambda x: polygon_intersects_triangle(x, triangle))
-   
-   num_of_polygons_and_LineString = df[df['geometry'].geom_type.isin(['Polygon', 'LineString'])].shape[0]
-   
    if num_of_polygons_and_LineString > 0:
-       intersect_fraction = intersects.sum()/num_of_polygons_and_LineString
+       status_counts = qc_table['triangle_status'][is_polygon_or_line].value_counts()
+       intersect_fraction = (status_counts['inside'] + status_counts['intersecting'])/num_of_polygons_and_LineString
        logger.info(f" {intersect_fraction*100:.2f}% of polygons are within calibration triangle")
        st.write(f" {intersect_fraction*100:.2f}% of polygons are within calibration triangle")
+       logger.info(f"Triangle QC: {status_counts['inside']} inside, {status_counts['intersecting']} intersecting, "
+                   f"{status_counts['outside']} outside")
+       if status_counts['outside'] > 0:
+          max_distance = qc_table['distance_outside'][is_polygon_or_line].max()
+          st.write(f"{status_counts['outside']} objects are outside the calibration triangle, "
+                   f"the furthest one is {max_distance:.1f} units away")
 
        if intersect_fraction < 0.25:
           st.warning('WARNING: Less than 25% of the objects intersect with the calibration triangle')
@@ -118,17 +204,24 @@ def perform_triangle_qc(df: geopandas.GeoDataFrame, calib_points_dict: dict, sel
 
    return calib_np_array
 
+def _plate_type() -> str:
+   """Plate type of the plate layout settings in session state, 384 by default."""
+   if isinstance(st.session_state.get('plate_gen_params'), dict):
+      return st.session_state.plate_gen_params.get('plate_type', "384")
+   return "384"
+
+@instrument.timed()
 def load_and_QC_SamplesandWells(samples_and_wells: dict):
    """Loads and checks for common errors.
 
    Checks for:
    If it is empty
    gdf samples are in saw
-   Provided wells inside normal 384 well plate
+   Provided wells exist on the plate type of the layout settings (384 well plate by default)
    """
    #TODO typos of missing " end up in index error
    logger.info("Checking samples and wells")
-   if st.session_state.gdf is None:
+   if st.session_state.shapes is None:
       logger.error("GeoDataFrame not found in session state. Please upload and process a GeoJSON file first.")
       st.error("GeoDataFrame not found in session state. Please upload and process a GeoJSON file first.")
       st.stop()
@@ -137,78 +230,165 @@ def load_and_QC_SamplesandWells(samples_and_wells: dict):
       st.error("Calibration points were not accesible directly")
       st.stop()
 
-   gdf_samples = st.session_state['gdf'].classification_name.unique().tolist()
-   allowed_wells = utils.create_list_of_acceptable_wells(plate="384", margins=0)
-
-   samples = samples_and_wells.keys()
-   wells = samples_and_wells.values()
-
-   # Is it empty?
-   if not isinstance(samples_and_wells,dict):
-      raise ValueError("samples and wells is not a dict")
-   if not samples_and_wells: #if empty
-      raise ValueError("dictionary is empty, most likely typo, please double check")
+   gdf_samples = st.session_state.shapes.class_names()
+   plate_type = _plate_type()
+   missing, crazy_wells = pipeline.check_samples_and_wells(gdf_samples, samples_and_wells, plate_type=plate_type)
 
    # gdf samples in saw
-   missing = set(gdf_samples) - samples
    if missing:
       logger.error(f"Classes in geodataframe, but not in samples and wells: {missing}")
       st.error(f"Classes in geodataframe, but not in samples and wells: {missing}")
       # st.stop()
 
    # wells inside allowable wells
-   crazy_wells = set(wells) - set(allowed_wells)
    if crazy_wells:
-      logger.error(f"Wells not existing in 384wp: {crazy_wells}")
-      st.error(f"Wells not existing in 384wp: {crazy_wells}")
+      logger.error(f"Wells not existing in {plate_type}wp: {crazy_wells}")
+      st.error(f"Wells not existing in {plate_type}wp: {crazy_wells}")
       st.stop()
 
    logger.success('The samples and wells scheme QC is done!')
    st.success('The samples and wells scheme QC is done!')
 
+@instrument.timed()
 def make_classes_unique(classes_to_modify: list):
    """Modifies the GeoDataFrame in session state to make specified class names unique.
 
    For each row of a specified class, a unique suffix is added to its 'classification_name'.
    """
    logger.info("Splitting specified classes into replicates")
-   if 'gdf' not in st.session_state or st.session_state.gdf is None:
+   if st.session_state.get('shapes') is None:
       logger.error("GeoDataFrame not found. Please load a GeoJSON file first.")
       st.error("GeoDataFrame not found. Please load a GeoJSON file first.")
       st.stop()
 
-   gdf = st.session_state.gdf.copy()
+   gdf = pipeline.make_classes_unique(st.session_state.shapes.frame(), classes_to_modify)
 
-   # Keep track of original names for the download
-   if 'original_classification_name' not in gdf.columns:
-      gdf['original_classification_name'] = gdf['classification_name']
+   # Update the session state
+   # numbering renames classes only, the geometries and what is cached of them stay valid
+   st.session_state.shapes.replace(gdf, keep_geometry=True)
 
-   for class_name in classes_to_modify:
-      # Find all rows that match the original class_name
-      # Important to match on the original name in case of multiple runs
-      matching_indices = gdf[gdf['original_classification_name'] == class_name].index
+   logger.success("GeoDataFrame updated with unique class names.")
+   st.success("GeoDataFrame updated with unique class names.")
 
-      if not matching_indices.empty:
-         # Generate new unique names for these rows
-         for i, idx in enumerate(matching_indices):
-               new_name = f"{class_name}_{str(i+1).zfill(3)}"
-               gdf.loc[idx, 'classification_name'] = new_name
 
-   #replace old classification name inside classification dict
-   gdf = utils.update_classification_column(gdf=gdf)
+@instrument.timed()
+def check_overlaps(min_distance: float = 0.0):
+   """Checks the shapes in session state for overlaps, duplicates and neighbours closer than `min_distance`.
 
-   # Update the session state
-   st.session_state.gdf = gdf
+   Pairs are grouped by the wells of the samples and wells scheme if there is one, by class otherwise.
+   Shows and returns the flagged pairs and the per-well cross-contamination summary.
+   """
+   logger.info("Checking overlaps and proximity of contours")
+   if st.session_state.shapes is None:
+      st.error("GeoDataFrame not found in session state. Please upload and process a GeoJSON file first.")
+      st.stop()
 
-   logger.success("GeoDataFrame updated with unique class names.")
-   st.success("GeoDataFrame updated with unique class names.")
+   pairs, summary = pipeline.overlap_qc(st.session_state.shapes.frame(), st.session_state.saw,
+                                        min_distance=min_distance)
+   if pairs.empty:
+      st.success("No overlapping, duplicated or too close contours found")
+      return pairs, summary
+
+   groups = "wells" if st.session_state.saw is not None else "classes"
+   counts = pairs['kind'].value_counts()
+   message = ", ".join(f"{n} {kind}" for kind, n in counts.items() if n)
+   cross_well = int(pairs['cross_well'].sum())
+   if cross_well:
+      logger.warning(f"Flagged pairs: {message}, {cross_well} between different {groups}")
+      st.warning(f"Flagged pairs: {message}. {cross_well} pairs are between different {groups} and can cross-contaminate them.")
+   else:
+      st.info(f"Flagged pairs: {message}, none between different {groups}")
+   st.write(f"Cross-contamination per {groups[:-1] if groups == 'wells' else 'class'}")
+   st.dataframe(summary)
+   st.write("Flagged pairs")
+   st.dataframe(pairs)
+   return pairs, summary
 
 
-def create_collection():
-   """Creates XML from geojson and returns file contents."""
-   logger.info("Creating collection")
-   # streamlit checks
-   if st.session_state.gdf is None:
+class ProcessedFiles(NamedTuple):
+   """Everything "Process files" produces.
+
+   The zip bundle, the QC images in it, the stats, the plate csv and the shapes
+   the stage coordinate preflight flagged.
+   """
+
+   bundle: bundle.Bundle
+   qc_images: dict[str, bytes]
+   stats: dict
+   csv_content: str | None
+   flagged: pandas.DataFrame | None = None
+
+
+def _preflight_tables(plate_artifacts: dict[int, pipeline.CollectionArtifacts]) -> tuple[pandas.DataFrame, pandas.DataFrame]:
+   """Stage bounds of every well and the flagged shapes of all plates, with a plate column."""
+   bounds = [artifacts.preflight.wells.assign(plate=plate) for plate, artifacts in plate_artifacts.items()]
+   flagged = [artifacts.preflight.flagged.assign(plate=plate) for plate, artifacts in plate_artifacts.items()]
+   return (pandas.concat(bounds, ignore_index=True)[["plate", *bounds[0].columns[:-1]]],
+           pandas.concat(flagged, ignore_index=True)[["plate", *flagged[0].columns[:-1]]])
+
+
+def process_files(gdf: geopandas.GeoDataFrame, calib_array: numpy.ndarray, saw: dict, stem: str,
+                  plate_type: str = "384", plate_manifest: pandas.DataFrame | None = None,
+                  log_file_path: str | None = None, run_report: instrument.RunRecorder | None = None,
+                  session_id: str | None = None, geometry_version: str | None = None,
+                  processed_format: str = "geojson", **export_options) -> ProcessedFiles:
+   """Builds the collection (one per plate with a `plate_manifest`) and zips it with all other outputs.
+
+   Takes everything from its arguments and nothing from session state, so it runs as a background
+   job. The processed shapes are written as `processed_format` (see `utils.write_processed`),
+   `export_options` are passed on to `pipeline.export_collection`.
+   """
+   # the processed shapes, json and images are written and compressed on a thread pool while the collection is built
+   with bundle.BundleWriter() as writer:
+      processed = writer.add_task(f'{stem}_processed{utils.PROCESSED_FORMATS[processed_format]}',
+                                  functools.partial(utils.write_processed, gdf, file_format=processed_format))
+      writer.add('samples_and_wells.json', json.dumps(saw, indent=4))
+      csv_content = None
+      if plate_manifest is None:
+         # the xml is streamed straight into its bundle entry
+         with writer.open(f'{stem}.xml') as xml_entry:
+            artifacts = pipeline.export_collection(gdf, calib_array, saw, plate_type=plate_type, xml_sink=xml_entry,
+                                                   geometry_version=geometry_version, **export_options)
+         csv_content = artifacts.plate_csv
+         writer.add(f'{stem}_{plate_type}_wellplate.csv', csv_content)
+         qc_images = {"collection.png": artifacts.qc_png}
+         stats = artifacts.stats
+         well_bounds, flagged = artifacts.preflight.wells, artifacts.preflight.flagged
+      else:
+         plate_artifacts, manifest = sharding.export_plates(gdf, calib_array, plate_manifest, plate_type=plate_type,
+                                                            geometry_version=geometry_version, **export_options)
+         qc_images = {}
+         for plate, artifacts in plate_artifacts.items():
+            writer.add(f'{stem}_plate{plate}.xml', artifacts.xml)
+            writer.add(f'{stem}_plate{plate}_{plate_type}_wellplate.csv', artifacts.plate_csv)
+            qc_images[f"collection_plate{plate}.png"] = artifacts.qc_png
+         writer.add(f'{stem}_plate_manifest.csv', manifest.to_csv(index=False))
+         stats = {f"Plate {plate}": artifacts.stats for plate, artifacts in plate_artifacts.items()}
+         well_bounds, flagged = _preflight_tables(plate_artifacts)
+      writer.add(f'{stem}_well_bounds.csv', well_bounds.to_csv(index=False))
+      if len(flagged):
+         writer.add(f'{stem}_flagged_shapes.csv', flagged.to_csv(index=False))
+      for image_name, qc_png in qc_images.items():
+         writer.add(image_name, qc_png, compress=False)  # png is compressed already
+      jobs.progress("Writing processed shapes", unit="")
+      processed.result()  # the log and report come last, once everything else is done
+      jobs.progress("Packing zip", unit="")
+      if log_file_path:
+         writer.add_file(f"log_{session_id}.log", log_file_path)
+      if run_report is not None:
+         writer.add(f"run_report_{session_id}.json", run_report.to_json())
+   logger.success("All files processed and zipped")
+   return ProcessedFiles(writer.bundle, qc_images, stats, csv_content, flagged)
+
+
+def submit_processing(hifi_plot=False, simplify_settings=None, optimize_order=False,
+                      processed_format="geojson") -> jobs.Job:
+   """Checks the session and queues `process_files` with a snapshot of it on the process-wide job queue.
+
+   Raises:
+      jobs.QueueFull: If the server already runs and queues as many jobs as it allows.
+   """
+   if st.session_state.shapes is None:
       st.error("GeoDataFrame not found in session state. Please upload and process a GeoJSON file first.")
       st.stop()
    if st.session_state.calibs is None:
@@ -218,49 +398,33 @@ def create_collection():
       st.error("Samples and wells were not accesible")
       st.stop()
 
-   df = st.session_state.gdf.copy()
-   df['coords'] = df.geometry.simplify(1).apply(utils.extract_coordinates)
-   logger.info("Simplified geometries")
-
-   logger.debug("Calibration point array")
-   logger.debug(st.session_state.calib_array)
-   the_collection = Collection(calibration_points = st.session_state.calib_array)
-   logger.debug("Created collection and added calibration points")
-   the_collection.orientation_transform = numpy.array([[1,0 ], [0,-1]])
-   logger.debug("Added orientation transform to collection")
-
-   for i in df.index:
-      classification = df.at[i, "classification_name"]
-      if classification in st.session_state.saw:
-         the_collection.new_shape(
-               df.at[i, 'coords'],
-               well=st.session_state.saw[classification]
-         )
-      else:
-         logger.debug(
-            f"{classification} was not found in samples and wells, it is skipped")
-   logger.debug("Added shapes to collection")
-
-   image_path = "./TheCollection.png"
-   the_collection.plot(save_name=image_path)
-   logger.debug("Saved QC image to tmp location")
-   st.write(the_collection.stats())
-
-   xml_content = ""
-   fd, path = tempfile.mkstemp(suffix=".xml", text=True)
-   logger.debug("Created temporary xml file to populate and export")
-   try:
-       the_collection.save(path)
-       logger.debug("Populated xml with the collection")
-       with os.fdopen(fd, 'r') as tmpfile:
-           xml_content = tmpfile.read()
-           logger.debug("content of xml file passed to variable")
-   finally:
-       os.remove(path)
-       logger.debug("Deleted temp xml file")
-
-   df_wp384 = utils.sample_placement()
-   csv_content = df_wp384.to_csv(index=True)
-
-   logger.success("Collection created, exporting XML and QC")
-   return xml_content, csv_content, image_path
+   stem = Path(st.session_state.file_name).stem
+   shapes = st.session_state.shapes
+   return jobs.default_queue().submit(
+      f"process_{stem}", process_files, shapes.frame(), st.session_state.calib_array, st.session_state.saw, stem,
+      plate_type=_plate_type(), plate_manifest=st.session_state.get('plate_manifest'),
+      log_file_path=st.session_state.get('log_file_path'), run_report=st.session_state.run_report,
+      session_id=st.session_state.session_id, geometry_version=shapes.geometry_version,
+      processed_format=processed_format, hifi_plot=hifi_plot, simplify_settings=simplify_settings, optimize_order=optimize_order)
+
+
+def show_session_memory():
+   """Shows in the sidebar how much memory and disk the shapes and output of this session use."""
+   shapes = st.session_state.get('shapes')
+   output = st.session_state.get('bundle')
+   memory = disk = 0.0
+   lines = []
+   if shapes is not None:
+      usage = shapes.memory()
+      memory += usage['memory_mb']
+      disk += usage['disk_mb']
+      lines.append(f"Shapes: {len(shapes)} as {usage['state']}, {usage['memory_mb']} MB in memory, "
+                   f"{usage['disk_mb']} MB on disk, budget {usage['budget_mb']} MB")
+   if output is not None:
+      size = round(output.size / 2**20, 1)
+      memory += size if output.in_memory else 0
+      disk += 0 if output.in_memory else size
+      lines.append(f"Output zip: {size} MB {'in memory' if output.in_memory else 'on disk'}")
+   st.sidebar.metric("Session memory", f"{memory:.1f} MB", help=f"{disk:.1f} MB on disk")
+   for line in lines:
+      st.sidebar.caption(line)
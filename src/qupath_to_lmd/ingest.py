@@ -0,0 +1,409 @@
+import codecs
+import itertools
+import json
+import re
+from array import array
+from collections import Counter
+from pathlib import Path
+
+import geopandas
+import numpy
+import pandas
+import pyarrow
+import pyarrow.compute
+import pyogrio
+import shapely
+import shapely.geometry
+from loguru import logger
+
+import qupath_to_lmd.utils as utils
+
+# the columnar formats are recognized by their first bytes, everything else is read as GeoJSON
+_MAGIC = {b"PAR1": "geoparquet", b"fgb\x03": "flatgeobuf"}
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_DECODER = json.JSONDecoder()
+
+
+class FeatureStream:
+   """Iterates over the features of a GeoJSON FeatureCollection without loading the whole document.
+
+   The document is read in chunks of `chunk_size` bytes, and each feature is decoded on its own,
+   so memory use is bounded by the chunk size and the largest single feature.
+   """
+
+   def __init__(self, fp, chunk_size: int = 1 << 20):
+      self._fp = fp
+      self._chunk_size = chunk_size
+      self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+      self._buf = ""
+      self._pos = 0
+      self._eof = False
+
+   def _fill(self) -> bool:
+      """Reads the next chunk into the buffer, returns False once the stream is exhausted."""
+      if self._eof:
+         return False
+      chunk = self._fp.read(self._chunk_size)
+      if isinstance(chunk, bytes):
+         text = self._decoder.decode(chunk, final=not chunk)
+      else:
+         text = chunk
+      if not chunk:
+         self._eof = True
+      self._buf = self._buf[self._pos:] + text
+      self._pos = 0
+      return True
+
+   def _peek(self) -> str:
+      while True:
+         self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+         if self._pos < len(self._buf):
+            return self._buf[self._pos]
+         if not self._fill():
+            return ""
+
+   def _expect(self, char: str):
+      found = self._peek()
+      if found != char:
+         raise ValueError(f"Malformed GeoJSON: expected '{char}' but found '{found}' at offset {self._pos}")
+      self._pos += 1
+
+   def _decode(self):
+      self._peek()
+      while True:
+         try:
+            value, end = _DECODER.raw_decode(self._buf, self._pos)
+            # a value ending exactly at the buffer edge may be a truncated number, read on to be sure
+            if end < len(self._buf) or self._eof:
+               self._pos = end
+               return value
+         except json.JSONDecodeError:
+            if self._eof:
+               raise
+         self._fill()
+
+   def __iter__(self):
+      self._expect("{")
+      if self._peek() == "}":
+         return
+      while True:
+         key = self._decode()
+         self._expect(":")
+         if key == "features":
+            self._expect("[")
+            if self._peek() == "]":
+               self._pos += 1
+            else:
+               while True:
+                  yield self._decode()
+                  separator = self._peek()
+                  self._pos += 1
+                  if separator == "]":
+                     break
+                  if separator != ",":
+                     raise ValueError(f"Malformed GeoJSON: unexpected '{separator}' between features")
+         else:
+            value = self._decode()
+            if key == "type" and value != "FeatureCollection":
+               raise ValueError(f"Expected a GeoJSON FeatureCollection, found type '{value}'")
+         if self._peek() == "}":
+            self._pos += 1
+            return
+         self._expect(",")
+
+
+class _RaggedGeometries:
+   """Accumulates the vertices of one geometry type in flat buffers, in GeoArrow ragged layout."""
+
+   def __init__(self, geometry_type: shapely.GeometryType):
+      self.geometry_type = geometry_type
+      self.coords = array("d")
+      self.ring_offsets = array("q", [0])
+      self.geom_offsets = array("q", [0])
+      self.positions = array("q")
+
+   def _add_ring(self, ring: list):
+      flat = list(itertools.chain.from_iterable(ring))
+      if len(flat) != 2 * len(ring):
+         # 3D coordinates, keep x and y only
+         flat = [value for point in ring for value in point[:2]]
+      self.coords.extend(flat)
+      self.ring_offsets.append(len(self.coords) // 2)
+
+   def add(self, position: int, coordinates: list):
+      if self.geometry_type == shapely.GeometryType.POLYGON:
+         for ring in coordinates:
+            self._add_ring(ring)
+         self.geom_offsets.append(len(self.ring_offsets) - 1)
+      else:
+         self._add_ring(coordinates)
+      self.positions.append(position)
+
+   def build(self) -> numpy.ndarray:
+      coords = numpy.frombuffer(self.coords, dtype=numpy.float64).reshape(-1, 2)
+      if self.geometry_type == shapely.GeometryType.POLYGON:
+         offsets = (numpy.frombuffer(self.ring_offsets, dtype=numpy.int64),
+                    numpy.frombuffer(self.geom_offsets, dtype=numpy.int64))
+      else:
+         offsets = (numpy.frombuffer(self.ring_offsets, dtype=numpy.int64),)
+      return shapely.from_ragged_array(self.geometry_type, coords, offsets=offsets)
+
+
+def _open_source(source):
+   """Returns a readable binary/text handle and whether we own (and must close) it."""
+   if isinstance(source, (str, Path)):
+      return open(source, "rb"), True
+   if hasattr(source, "read"):
+      if hasattr(source, "seek"):
+         source.seek(0)
+      return source, False
+   raise TypeError(f"Unsupported GeoJSON source type: {type(source)}")
+
+
+def read_geojson_streaming(source, chunk_size: int = 1 << 20) -> tuple[geopandas.GeoDataFrame, dict, dict]:
+   """Reads and QCs a QuPath FeatureCollection in a single streaming pass.
+
+   Calibration points are extracted, unclassified objects are dropped and the remaining shapes
+   are written straight into the output table, so the raw JSON is never held in memory as a whole.
+   MultiPolygons are kept, `normalize.normalize_geometries` explodes them.
+
+   Args:
+      source: Path to a .geojson file or a file-like object (e.g. a Streamlit upload).
+      chunk_size: Number of bytes read from the source at a time.
+
+   Returns:
+      The cleaned GeoDataFrame, a dict of calibration point names to [x, y], and a report dict
+      with the geometry type counts and the number of unclassified objects.
+   """
+   logger.info("Streaming geojson features")
+   fp, owned = _open_source(source)
+
+   ragged = {
+      "Polygon": _RaggedGeometries(shapely.GeometryType.POLYGON),
+      "LineString": _RaggedGeometries(shapely.GeometryType.LINESTRING),
+   }
+   other_geometries, other_positions = [], []
+   columns = {"id": []}
+   classification_names = []
+   classification_strings = {}
+   available_points = {}
+   geometry_counts = Counter()
+   n_unclassified = 0
+   n_features = 0
+   has_name = False
+   index = []
+
+   try:
+      for n_features, feature in enumerate(FeatureStream(fp, chunk_size=chunk_size), start=1):
+         geometry = feature.get("geometry") or {}
+         geom_type = geometry.get("type")
+         properties = feature.get("properties") or {}
+         has_name = has_name or "name" in properties
+         geometry_counts[geom_type] += 1
+
+         if geom_type == "Point":
+            name = properties.get("name")
+            if name:
+               available_points[name] = list(geometry["coordinates"][:2])
+            continue
+
+         classification = properties.get("classification")
+         if classification is None:
+            n_unclassified += 1
+            continue
+         if isinstance(classification, str):
+            classification = utils.parse_classification(classification)
+
+         if geom_type is None:
+            logger.debug(f"Feature {feature.get('id')} has no geometry, it is skipped")
+            continue
+
+         position = len(index)
+         if geom_type in ragged:
+            ragged[geom_type].add(position, geometry["coordinates"])
+         else:
+            other_geometries.append(shapely.geometry.shape(geometry))
+            other_positions.append(position)
+
+         index.append(n_features - 1)
+         columns["id"].append(feature.get("id"))
+         for key, value in properties.items():
+            if key == "classification":
+               raw = json.dumps(value) if isinstance(value, dict) else value
+               value = classification_strings.setdefault(raw, raw)
+            elif isinstance(value, (dict, list)):
+               value = json.dumps(value)
+            if key not in columns:
+               columns[key] = [None] * position
+            columns[key].append(value)
+         for values in columns.values():
+            if len(values) == position:
+               values.append(None)
+         classification_names.append(classification.get("name"))
+   finally:
+      if owned:
+         fp.close()
+
+   geometries = numpy.empty(len(index), dtype=object)
+   for accumulator in ragged.values():
+      if accumulator.positions:
+         geometries[numpy.frombuffer(accumulator.positions, dtype=numpy.int64)] = accumulator.build()
+   for position, geom in zip(other_positions, other_geometries, strict=True):
+      geometries[position] = geom
+
+   if has_name and "name" not in columns:
+      columns["name"] = [None] * len(index)
+   columns["classification_name"] = pandas.Categorical(classification_names)
+   df = geopandas.GeoDataFrame(
+      columns, index=index, geometry=geopandas.GeoSeries(geometries, index=index, crs="EPSG:4326"))
+
+   report = {
+      "n_features": n_features,
+      "has_name": has_name,
+      "geometry_counts": dict(geometry_counts),
+      "n_unclassified": n_unclassified,
+   }
+   logger.info(f"Streamed {n_features} features, kept {len(df)} shapes")
+   return df, available_points, report
+
+
+def detect_format(source) -> str:
+   """Format of a path or file-like object from its first bytes: "geoparquet", "flatgeobuf" or "geojson"."""
+   fp, owned = _open_source(source)
+   try:
+      head = fp.read(4)
+      if not owned and hasattr(fp, "seek"):
+         fp.seek(0)
+   finally:
+      if owned:
+         fp.close()
+   head = head.encode() if isinstance(head, str) else head
+   return _MAGIC.get(bytes(head), "geojson")
+
+
+def _columnar_source(source):
+   """A path as is, an upload as a buffer both pyarrow and GDAL read without copying it into a file."""
+   if isinstance(source, (str, Path)):
+      return source
+   if hasattr(source, "getbuffer"):
+      return source.getbuffer()
+   source.seek(0)
+   return source.read()
+
+
+def _read_frame(source, file_format: str, bbox: tuple | None = None, **kwargs) -> geopandas.GeoDataFrame:
+   if file_format == "geoparquet":
+      source = pyarrow.BufferReader(source) if isinstance(source, (bytes, memoryview)) else source
+      # only files written with a bbox covering column can skip row groups, the rest is filtered after reading
+      try:
+         return geopandas.read_parquet(source, bbox=bbox, memory_map=True, **kwargs)
+      except ValueError:
+         if bbox is None:
+            raise
+      df = geopandas.read_parquet(source, memory_map=True, **kwargs)
+      return df[df.intersects(shapely.box(*bbox))]
+   # FlatGeobuf files with a spatial index are read only where they overlap the box
+   source = bytes(source) if isinstance(source, memoryview) else source
+   return pyogrio.read_dataframe(source, bbox=bbox, use_arrow=True, **kwargs)
+
+
+def _read_named(source, file_format: str, order: bool = False) -> geopandas.GeoDataFrame:
+   """Name and geometry of the named features only, with the FlatGeobuf feature order if `order` is set."""
+   if file_format == "geoparquet":
+      return _read_frame(source, file_format, columns=["name", "geometry"], filters=pyarrow.compute.field("name").is_valid())
+   columns = ["name", utils.FEATURE_ORDER_COLUMN] if order else ["name"]
+   return _read_frame(source, file_format, columns=columns, where="name IS NOT NULL")
+
+
+def _in_file_order(df: geopandas.GeoDataFrame) -> geopandas.GeoDataFrame:
+   """Rows of a FlatGeobuf sorted back into the order they were written in, without the order column."""
+   order = df[utils.FEATURE_ORDER_COLUMN].to_numpy()
+   return df.iloc[numpy.argsort(order, kind="stable")].drop(columns=utils.FEATURE_ORDER_COLUMN).reset_index(drop=True)
+
+
+def _named_points(df: geopandas.GeoDataFrame) -> dict:
+   points = df[(df.geometry.geom_type == "Point") & df["name"].notna() & (df["name"] != "")]
+   return dict(zip(points["name"], numpy.column_stack([points.geometry.x, points.geometry.y]).tolist(), strict=True))
+
+
+def read_columnar(source, file_format: str | None = None,
+                  bbox: tuple[float, float, float, float] | None = None) -> tuple[geopandas.GeoDataFrame, dict, dict]:
+   """Reads and QCs a QuPath export stored as GeoParquet or FlatGeobuf, the columnar counterpart of `read_geojson_streaming`.
+
+   GeoParquet is memory-mapped and FlatGeobuf read through GDAL, both straight into Arrow
+   columns. With a `bbox` (xmin, ymin, xmax, ymax) only the shapes that intersect it are read,
+   using the bbox covering column of GeoParquet and the spatial index of FlatGeobuf; the
+   calibration points are always read from the whole file.
+
+   The spatial index of FlatGeobuf stores the features in spatial order. Files written by
+   `utils.write_processed` carry the original order in `utils.FEATURE_ORDER_COLUMN` and are put
+   back into it; files without a spatial index are in their original order already.
+
+   Args:
+      source: Path or file-like object (e.g. a Streamlit upload).
+      file_format: "geoparquet" or "flatgeobuf", detected from the content if None.
+      bbox: Region of the slide to read, in QuPath pixel coordinates.
+
+   Returns:
+      The same as `read_geojson_streaming`: the cleaned GeoDataFrame, the calibration points
+      and the report.
+
+   Raises:
+      ValueError: If a FlatGeobuf with a spatial index and several named points has no
+         FEATURE_ORDER_COLUMN, the order of its calibration points is lost.
+   """
+   file_format = file_format or detect_format(source)
+   logger.info(f"Reading {file_format}" + (f" in {bbox}" if bbox is not None else ""))
+   source = _columnar_source(source)
+   df = _read_frame(source, file_format, bbox=bbox)
+   ordered = file_format == "flatgeobuf" and utils.FEATURE_ORDER_COLUMN in df.columns
+   if ordered:
+      df = _in_file_order(df)
+   has_name = "name" in df.columns
+   available_points = _named_points(df) if has_name else {}
+   if bbox is not None and has_name:
+      # the calibration points may lie outside of the region
+      named = _read_named(source, file_format, order=ordered)
+      available_points = _named_points(_in_file_order(named) if ordered else named)
+   if file_format == "flatgeobuf" and not ordered and len(available_points) > 1:
+      source_for_info = bytes(source) if isinstance(source, memoryview) else source
+      if pyogrio.read_info(source_for_info)["capabilities"]["fast_spatial_filter"]:
+         raise ValueError(f"The FlatGeobuf has a spatial index, which stores its features in spatial order, so the "
+                          f"order of the calibration points {', '.join(available_points)} is lost. Convert it with "
+                          f"`-lco SPATIAL_INDEX=NO` or add a '{utils.FEATURE_ORDER_COLUMN}' column with the original order.")
+
+   geom_types = df.geometry.geom_type
+   # the counts of the GeoJSON reader, geometries missing there are counted as None
+   geometry_counts = {None if pandas.isna(geom_type) else geom_type: count
+                      for geom_type, count in geom_types.value_counts(dropna=False).items()}
+   if "classification" not in df.columns:
+      df["classification"] = None
+   classified = df["classification"].notna().to_numpy()
+   keep = classified & geom_types.notna().to_numpy() & (geom_types != "Point").to_numpy()
+   n_unclassified = int((~classified & (geom_types != "Point").to_numpy()).sum())
+   df = df[keep]
+   df = df.assign(classification_name=utils.parse_classification_names(df["classification"]))
+
+   report = {
+      "n_features": len(geom_types),
+      "has_name": has_name,
+      "geometry_counts": geometry_counts,
+      "n_unclassified": n_unclassified,
+   }
+   logger.info(f"Read {report['n_features']} features, kept {len(df)} shapes")
+   return df, available_points, report
+
+
+def read_shapes(source, bbox: tuple[float, float, float, float] | None = None) -> tuple[geopandas.GeoDataFrame, dict, dict]:
+   """Reads a QuPath export in any supported format, see `read_geojson_streaming` and `read_columnar`.
+
+   Raises:
+      ValueError: If a `bbox` is given for GeoJSON, which can only be read as a whole.
+   """
+   file_format = detect_format(source)
+   if file_format == "geojson":
+      if bbox is not None:
+         raise ValueError("Reading a region (bbox) needs GeoParquet or FlatGeobuf, GeoJSON is read as a whole")
+      return read_geojson_streaming(source)
+   return read_columnar(source, file_format, bbox=bbox)
@@ -0,0 +1,265 @@
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import UTC, datetime
+from pathlib import Path
+
+from loguru import logger
+
+METRICS_FILE_ENV = "QUPATH_TO_LMD_METRICS_FILE"
+# upper bounds in seconds of the Prometheus latency histogram
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, float("inf"))
+MAX_SPANS = 10000
+RSS_INTERVAL = 0.02
+
+_recorder = contextvars.ContextVar("qupath_to_lmd_recorder", default=None)
+_parent = contextvars.ContextVar("qupath_to_lmd_span", default=None)
+
+
+def current_rss() -> int:
+   """Resident set size of the process in bytes, the peak RSS where /proc is not available."""
+   try:
+      with open("/proc/self/statm") as f:
+         return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+   except OSError:
+      try:
+         import resource
+      except ImportError:
+         return 0
+      return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _RssSampler:
+   """Background thread that tracks the peak RSS of every open span, running only while spans are open."""
+
+   def __init__(self, interval: float = RSS_INTERVAL):
+      self.interval = interval
+      self._open = set()
+      self._lock = threading.Lock()
+      self._stop = None
+
+   def track(self, span: "Span"):
+      with self._lock:
+         self._open.add(span)
+         if self._stop is None:
+            self._stop = threading.Event()
+            threading.Thread(target=self._sample, args=(self._stop,), name="rss-sampler", daemon=True).start()
+
+   def release(self, span: "Span"):
+      with self._lock:
+         self._open.discard(span)
+         if not self._open and self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+   @property
+   def running(self) -> bool:
+      return self._stop is not None
+
+   def _sample(self, stop: threading.Event):
+      while not stop.wait(self.interval):
+         rss = current_rss()
+         with self._lock:
+            for span in self._open:
+               span.peak_rss = max(span.peak_rss, rss)
+
+
+_sampler = _RssSampler()
+
+
+class _LatencyMetrics:
+   """Process-wide latency histogram per stage, rendered in the Prometheus text format."""
+
+   def __init__(self):
+      self._lock = threading.Lock()
+      self._stages = {}
+
+   def observe(self, stage: str, seconds: float):
+      with self._lock:
+         buckets, total = self._stages.get(stage, ([0] * len(LATENCY_BUCKETS), [0.0, 0]))
+         for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+               buckets[i] += 1
+         total[0] += seconds
+         total[1] += 1
+         self._stages[stage] = (buckets, total)
+
+   def prometheus_text(self) -> str:
+      lines = ["# HELP qupath_to_lmd_stage_seconds Wall time of pipeline stages.",
+               "# TYPE qupath_to_lmd_stage_seconds histogram"]
+      with self._lock:
+         for stage, (buckets, (seconds, count)) in sorted(self._stages.items()):
+            for bound, n in zip(LATENCY_BUCKETS, buckets, strict=True):
+               le = "+Inf" if bound == float("inf") else repr(bound)
+               lines.append(f'qupath_to_lmd_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {n}')
+            lines.append(f'qupath_to_lmd_stage_seconds_sum{{stage="{stage}"}} {seconds:.6f}')
+            lines.append(f'qupath_to_lmd_stage_seconds_count{{stage="{stage}"}} {count}')
+      return "\n".join(lines) + "\n"
+
+
+METRICS = _LatencyMetrics()
+
+
+def prometheus_text() -> str:
+   """Latency histograms of all stages run by this process, in the Prometheus text exposition format."""
+   return METRICS.prometheus_text()
+
+
+def write_metrics_file(path=None):
+   """Atomically writes the Prometheus text to `path` or QUPATH_TO_LMD_METRICS_FILE, e.g. for the node_exporter textfile collector."""
+   path = path or os.environ.get(METRICS_FILE_ENV)
+   if not path:
+      return
+   path = Path(path)
+   try:
+      with tempfile.NamedTemporaryFile("w", dir=path.parent, prefix=f".{path.name}.", delete=False) as f:
+         f.write(prometheus_text())
+      os.replace(f.name, path)
+   except OSError as e:
+      logger.warning(f"Could not write metrics to {path}: {e}")
+
+
+class Span:
+   """Wall time, CPU time of the calling thread, peak RSS delta and item counts of one stage.
+
+   The RSS is that of the whole process: while other sessions or jobs run at the same time, their
+   allocations count into this span's peak too, so `peak_rss_delta_mb` is an upper bound then.
+   """
+
+   def __init__(self, name: str, parent: "Span | None", start: float, counts: dict):
+      self.name = name
+      self.parent = parent
+      self.start = start
+      self.counts = counts
+      self.wall_s = self.cpu_s = 0.0
+      self.start_rss = self.peak_rss = current_rss()
+
+   def count(self, **counts):
+      """Records item counts, e.g. `span.count(shapes=len(gdf), vertices=n)`."""
+      self.counts.update({key: int(value) for key, value in counts.items()})
+
+   @property
+   def path(self) -> str:
+      """Names of the enclosing spans and this one, e.g. "process_files/export_collection"."""
+      return self.name if self.parent is None else f"{self.parent.path}/{self.name}"
+
+   def to_dict(self, origin: float) -> dict:
+      """Report row of the span, `start_s` relative to `origin` and the process-wide peak RSS delta in MB."""
+      return {
+         "stage": self.path,
+         "start_s": round(self.start - origin, 4),
+         "wall_s": round(self.wall_s, 4),
+         "cpu_s": round(self.cpu_s, 4),
+         "peak_rss_delta_mb": round((self.peak_rss - self.start_rss) / 2**20, 1),
+         **self.counts,
+      }
+
+
+class RunRecorder:
+   """Collects the spans of one run (a CLI slide or a Streamlit session) for the JSON report."""
+
+   def __init__(self, run_id: str | None = None):
+      self.run_id = run_id
+      self.started = datetime.now(UTC).isoformat(timespec="seconds")
+      self.origin = time.perf_counter()
+      self.spans = deque(maxlen=MAX_SPANS)
+      self._lock = threading.Lock()
+
+   def add(self, span: Span):
+      """Records a finished span, the oldest ones are dropped beyond MAX_SPANS."""
+      with self._lock:
+         self.spans.append(span.to_dict(self.origin))
+
+   def report(self) -> dict:
+      """The spans in the order they finished, and wall and CPU time summed per stage."""
+      with self._lock:
+         spans = list(self.spans)
+      totals = {}
+      for span in spans:
+         total = totals.setdefault(span["stage"], {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0})
+         total["calls"] += 1
+         total["wall_s"] = round(total["wall_s"] + span["wall_s"], 4)
+         total["cpu_s"] = round(total["cpu_s"] + span["cpu_s"], 4)
+      return {"run_id": self.run_id, "started": self.started, "spans": spans, "totals": totals}
+
+   def to_json(self) -> str:
+      """The report as indented JSON, e.g. for the run report file."""
+      return json.dumps(self.report(), indent=1)
+
+
+def activate(recorder: RunRecorder | None) -> contextvars.Token:
+   """Makes `recorder` collect the spans of the current thread (context), e.g. on every Streamlit rerun."""
+   return _recorder.set(recorder)
+
+
+def deactivate(token: contextvars.Token):
+   """Restores the recorder that was active before `activate` returned `token`."""
+   _recorder.reset(token)
+
+
+@contextlib.contextmanager
+def recording(run_id: str | None = None):
+   """Records all spans inside the block into a new `RunRecorder`."""
+   recorder = RunRecorder(run_id)
+   token = _recorder.set(recorder)
+   try:
+      yield recorder
+   finally:
+      _recorder.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str, **counts):
+   """Times a stage. Spans nest, and are recorded by the active recorder and the process-wide metrics.
+
+   Worker threads only see the recorder if they run in a copy of the caller's context
+   (`contextvars.copy_context().run`).
+   """
+   parent = _parent.get()
+   current = Span(name, parent, time.perf_counter(), {})
+   current.count(**counts)
+   token = _parent.set(current)
+   _sampler.track(current)
+   cpu = time.thread_time()
+   try:
+      yield current
+   finally:
+      current.wall_s = time.perf_counter() - current.start
+      current.cpu_s = time.thread_time() - cpu
+      _sampler.release(current)
+      current.peak_rss = max(current.peak_rss, current_rss())
+      _parent.reset(token)
+
+      recorder = _recorder.get()
+      if recorder is not None:
+         recorder.add(current)
+      METRICS.observe(current.path, current.wall_s)
+      counted = ", ".join(f"{n} {key}" for key, n in current.counts.items())
+      logger.debug(f"{current.path} took {current.wall_s:.3f} s (cpu {current.cpu_s:.3f} s"
+                   f"{', ' + counted if counted else ''})")
+      if parent is None:
+         write_metrics_file()
+
+
+def count(**counts):
+   """Adds item counts to the innermost open span, if any."""
+   current = _parent.get()
+   if current is not None:
+      current.count(**counts)
+
+
+def timed(name: str | None = None):
+   """Decorator that runs the function in a span named `name` or after the function."""
+   def decorate(func):
+      @functools.wraps(func)
+      def wrapper(*args, **kwargs):
+         with span(name or func.__name__):
+            return func(*args, **kwargs)
+      return wrapper
+   return decorate
@@ -0,0 +1,100 @@
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy
+from loguru import logger
+
+INTERMEDIATES_MAX_MB_ENV = "QUPATH_TO_LMD_INTERMEDIATES_MAX_MB"
+DEFAULT_MAX_MB = 512
+
+
+def digest(*arrays) -> str:
+   """Short content hash of arrays, e.g. of the selected shapes, for use in keys."""
+   h = hashlib.blake2b(digest_size=12)
+   for array in arrays:
+      array = numpy.ascontiguousarray(array)
+      h.update(f"{array.dtype}{array.shape}".encode())
+      h.update(array.data)
+   return h.hexdigest()
+
+
+class IntermediateCache:
+   """Process-wide in-memory LRU cache of intermediate results that only depend on the geometry.
+
+   Keys are tuples starting with the geometry version of a `store.GeometryStore`, so replacing the
+   shapes of a session makes its entries unreachable, and `discard` frees them right away. Values
+   are never copied, callers must not modify what they get or put.
+   """
+
+   def __init__(self, max_bytes: int = DEFAULT_MAX_MB * 2**20):
+      self.max_bytes = max_bytes
+      self.bytes = 0
+      self.hits = self.misses = 0
+      self._entries = OrderedDict()  # key -> (value, nbytes)
+      self._lock = threading.Lock()
+
+   def get(self, key: tuple):
+      """Returns the value of `key` or None on a miss."""
+      with self._lock:
+         entry = self._entries.get(key)
+         if entry is None:
+            self.misses += 1
+            return None
+         self._entries.move_to_end(key)
+         self.hits += 1
+         return entry[0]
+
+   def put(self, key: tuple, value, nbytes: int):
+      """Stores `value` and evicts the least recently used entries over `max_bytes`. Too large values are not kept."""
+      if nbytes > self.max_bytes:
+         logger.debug(f"Not caching {key[1:2]} of {nbytes / 2**20:.1f} MB, over the intermediates budget")
+         return
+      with self._lock:
+         if key in self._entries:
+            self.bytes -= self._entries.pop(key)[1]
+         self._entries[key] = (value, nbytes)
+         self.bytes += nbytes
+         while self.bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+
+   def discard(self, version: str):
+      """Drops all entries of a geometry version, including those of its shards."""
+      with self._lock:
+         stale = [key for key in self._entries if str(key[0]).split(":")[0] == version]
+         for key in stale:
+            self.bytes -= self._entries.pop(key)[1]
+      if stale:
+         logger.debug(f"Dropped {len(stale)} intermediates of geometry {version}")
+
+
+@functools.cache
+def default_cache() -> IntermediateCache | None:
+   """Cache configured by QUPATH_TO_LMD_INTERMEDIATES_MAX_MB (0 disables it)."""
+   max_mb = float(os.environ.get(INTERMEDIATES_MAX_MB_ENV, DEFAULT_MAX_MB))
+   if max_mb <= 0:
+      return None
+   return IntermediateCache(int(max_mb * 2**20))
+
+
+def cached(key: tuple | None, compute, nbytes):
+   """Returns the cached value of `key`, or computes and caches it. Without a key or cache it only computes.
+
+   Args:
+      key: Cache key, starting with the geometry version; None to skip the cache.
+      compute: Function without arguments that computes the value.
+      nbytes: Function that returns the memory of a computed value.
+   """
+   cache = default_cache() if key is not None else None
+   if cache is None:
+      return compute()
+   value = cache.get(key)
+   if value is None:
+      value = compute()
+      cache.put(key, value, nbytes(value))
+   else:
+      logger.debug(f"Reusing {key[1]} of geometry {key[0]}")
+   return value
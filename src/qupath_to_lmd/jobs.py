@@ -0,0 +1,221 @@
+import contextlib
+import contextvars
+import functools
+import os
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from loguru import logger
+
+MAX_JOBS_ENV = "QUPATH_TO_LMD_MAX_JOBS"
+DEFAULT_MAX_JOBS = 2
+MAX_QUEUED_JOBS_ENV = "QUPATH_TO_LMD_MAX_QUEUED_JOBS"
+DEFAULT_MAX_QUEUED_JOBS = 8
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+_job = contextvars.ContextVar("qupath_to_lmd_job", default=None)
+_silenced = contextvars.ContextVar("qupath_to_lmd_job_silenced", default=False)
+
+
+class JobCancelled(Exception):
+   """Raised inside a job at its next progress report or checkpoint once it was cancelled."""
+
+
+class QueueFull(RuntimeError):
+   """Raised when a job is submitted while the queue already holds the maximum number of jobs."""
+
+
+class Job:
+   """A background job: its state, the progress of its current stage, and its result or error.
+
+   The job's function reports progress with the module-level `progress`, `advance` and
+   `checkpoint`, which also raise `JobCancelled` once `cancel` was called. Everything the
+   function needs is passed in when it is submitted, it must not read Streamlit state.
+   """
+
+   def __init__(self, name: str):
+      self.name = name
+      self.state = QUEUED
+      self.stage = "Waiting in queue"
+      self.done = 0
+      self.total = None
+      self.unit = ""
+      self.result = None
+      self.error = None
+      self.submitted = time.monotonic()
+      self.started = self.finished_at = None
+      self._cancel = threading.Event()
+      self._lock = threading.Lock()
+      self._future: Future | None = None
+
+   @property
+   def finished(self) -> bool:
+      """Whether the job is done, failed or cancelled."""
+      return self.state in (DONE, FAILED, CANCELLED)
+
+   @property
+   def fraction(self) -> float:
+      """Progress of the current stage between 0 and 1, 0 for stages without a total."""
+      return min(self.done / self.total, 1.0) if self.total else 0.0
+
+   @property
+   def elapsed(self) -> float:
+      """Seconds the job has been running, or ran until it finished; 0 while queued."""
+      if self.started is None:
+         return 0.0
+      return (self.finished_at or time.monotonic()) - self.started
+
+   def describe(self) -> str:
+      """The current stage, e.g. "Writing XML: 12,400 / 50,000 shapes"."""
+      if self.total:
+         return f"{self.stage}: {self.done:,} / {self.total:,} {self.unit}".rstrip()
+      return self.stage
+
+   def report(self, stage: str, done: int = 0, total: int | None = None, unit: str = "shapes"):
+      """Sets the current stage and how many of its `total` items are done."""
+      with self._lock:
+         self.stage, self.done, self.total, self.unit = stage, int(done), total, unit
+
+   def step(self, stage: str, total: int, unit: str, n: int = 1):
+      """Adds `n` done items to `stage`, or starts counting from `n` if another stage was current."""
+      with self._lock:
+         self.done = self.done + n if self.stage == stage else n
+         self.stage, self.total, self.unit = stage, total, unit
+
+   def cancel(self):
+      """Cancels a queued job right away, a running one at its next progress report."""
+      self._cancel.set()
+      if self._future is not None and self._future.cancel():
+         self._finish(CANCELLED)
+
+   @property
+   def cancel_requested(self) -> bool:
+      """Whether `cancel` was called, even if the job has not stopped yet."""
+      return self._cancel.is_set()
+
+   def checkpoint(self):
+      """Raises `JobCancelled` if `cancel` was called."""
+      if self._cancel.is_set():
+         raise JobCancelled(self.name)
+
+   def _finish(self, state: str):
+      self.finished_at = time.monotonic()
+      self.state = state
+
+
+def current_job() -> Job | None:
+   """The job the calling thread (context) works for, if any."""
+   return _job.get()
+
+
+def checkpoint():
+   """Raises `JobCancelled` if the current job was cancelled, does nothing outside of jobs."""
+   job = _job.get()
+   if job is not None:
+      job.checkpoint()
+
+
+def progress(stage: str, done: int = 0, total: int | None = None, unit: str = "shapes"):
+   """Reports the progress of the current job's stage and checks for cancellation."""
+   job = _job.get()
+   if job is None:
+      return
+   job.checkpoint()
+   if not _silenced.get():
+      job.report(stage, done, total, unit)
+
+
+def advance(stage: str, total: int, unit: str, n: int = 1):
+   """Adds `n` finished items to the stage, for stages whose items finish on several threads."""
+   job = _job.get()
+   if job is None:
+      return
+   job.checkpoint()
+   job.step(stage, total, unit, n)
+
+
+@contextlib.contextmanager
+def silenced():
+   """Drops the progress reports of the block, e.g. of the per-plate stages while plates are counted.
+
+   Cancellation is still checked at every report.
+   """
+   token = _silenced.set(True)
+   try:
+      yield
+   finally:
+      _silenced.reset(token)
+
+
+class JobQueue:
+   """Runs jobs on a bounded thread pool, `max_jobs` at a time, with at most `max_queued` waiting.
+
+   With `max_jobs` 0, jobs run synchronously in `submit`, e.g. for tests and scripts.
+   """
+
+   def __init__(self, max_jobs: int = DEFAULT_MAX_JOBS, max_queued: int = DEFAULT_MAX_QUEUED_JOBS):
+      self.max_jobs = max_jobs
+      self.max_queued = max_queued
+      self._pool = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="job") if max_jobs > 0 else None
+      self._jobs = []
+      self._lock = threading.Lock()
+
+   def submit(self, name: str, func: Callable, *args, **kwargs) -> Job:
+      """Queues `func(*args, **kwargs)` as a job that runs in a copy of the caller's context.
+
+      Raises:
+         QueueFull: If `max_jobs` jobs run and `max_queued` wait already.
+      """
+      job = Job(name)
+      context = contextvars.copy_context()
+      if self._pool is None:
+         context.run(self._run, job, func, args, kwargs)
+         return job
+      with self._lock:
+         self._jobs = [pending for pending in self._jobs if not pending.finished]
+         if len(self._jobs) >= self.max_jobs + self.max_queued:
+            raise QueueFull(f"{len(self._jobs)} jobs are running or waiting, try again later")
+         self._jobs.append(job)
+         job._future = self._pool.submit(context.run, self._run, job, func, args, kwargs)
+      logger.info(f"Queued job {name}, {len(self._jobs)} jobs running or waiting")
+      return job
+
+   def ahead(self, job: Job) -> int:
+      """Number of jobs that start before a queued job."""
+      with self._lock:
+         queued = [pending for pending in self._jobs if pending.state == QUEUED]
+      return queued.index(job) if job in queued else 0
+
+   def _run(self, job: Job, func: Callable, args: tuple, kwargs: dict):
+      if job.cancel_requested:
+         job._finish(CANCELLED)
+         return
+      job.started = time.monotonic()
+      job.state = RUNNING
+      job.report("Starting", unit="")
+      token = _job.set(job)
+      try:
+         job.result = func(*args, **kwargs)
+      except JobCancelled:
+         job._finish(CANCELLED)
+         logger.info(f"Job {job.name} cancelled after {job.elapsed:.1f} s")
+      except Exception as e:  # noqa: BLE001
+         # any error of the job's function fails only this job, the session shows it instead of crashing
+         job.error = e
+         job._finish(FAILED)
+         logger.opt(exception=e).error(f"Job {job.name} failed: {e}")
+      else:
+         job._finish(DONE)
+         logger.info(f"Job {job.name} finished in {job.elapsed:.1f} s")
+      finally:
+         _job.reset(token)
+
+
+@functools.cache
+def default_queue() -> JobQueue:
+   """The process-wide queue, sized by QUPATH_TO_LMD_MAX_JOBS and QUPATH_TO_LMD_MAX_QUEUED_JOBS."""
+   return JobQueue(int(os.environ.get(MAX_JOBS_ENV, DEFAULT_MAX_JOBS)),
+                   int(os.environ.get(MAX_QUEUED_JOBS_ENV, DEFAULT_MAX_QUEUED_JOBS)))
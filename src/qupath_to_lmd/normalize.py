@@ -0,0 +1,168 @@
+import contextvars
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import geopandas
+import numpy
+import shapely
+from loguru import logger
+
+import qupath_to_lmd.instrument as instrument
+
+CHUNK_SIZE = 65536
+# rows listed in the QC summary, the counts always cover all of them
+MAX_ISSUES = 1000
+# columns added when parts are exploded: index label of the original row, 0-based part number within it
+SOURCE_COLUMN = "_source_label"
+PART_COLUMN = "_part"
+
+_POLYGON = int(shapely.GeometryType.POLYGON)
+_LINESTRING = int(shapely.GeometryType.LINESTRING)
+_MULTI = [int(shapely.GeometryType.MULTIPOLYGON), int(shapely.GeometryType.MULTILINESTRING),
+          int(shapely.GeometryType.GEOMETRYCOLLECTION)]
+
+
+class _Chunk(NamedTuple):
+   """Normalized geometries of one chunk, the row each comes from, and what happened to the rows."""
+
+   geometries: numpy.ndarray
+   source: numpy.ndarray
+   invalid: numpy.ndarray
+   reasons: numpy.ndarray
+   parts: numpy.ndarray
+   reoriented: int
+
+
+def _normalize_chunk(geoms: numpy.ndarray) -> _Chunk:
+   input_types = shapely.get_type_id(geoms)
+   invalid = numpy.flatnonzero(~shapely.is_valid(geoms) & (input_types >= 0))
+   reasons = shapely.is_valid_reason(geoms[invalid])
+   if len(invalid):
+      geoms = geoms.copy()
+      geoms[invalid] = shapely.make_valid(geoms[invalid], method="structure", keep_collapsed=False)
+
+   # explode only the multi-part rows, singles keep their geometry objects
+   types = shapely.get_type_id(geoms)
+   multi = numpy.isin(types, _MULTI)
+   parts, part_of = shapely.get_parts(geoms[multi], return_index=True)
+   single = numpy.flatnonzero(~multi)
+   source = numpy.concatenate([single, numpy.flatnonzero(multi)[part_of]])
+   order = numpy.argsort(source, kind="stable")
+   source = source[order]
+   exploded = numpy.concatenate([geoms[single], parts])[order]
+
+   # keep outlines the LMD can cut: polygons, and lines that were drawn as lines (not collapsed polygons)
+   part_types = shapely.get_type_id(exploded)
+   keep = ((part_types == _POLYGON) | ((part_types == _LINESTRING) & (input_types[source] != _POLYGON))) \
+      & ~shapely.is_empty(exploded)
+   keep[keep] = (shapely.area(exploded[keep]) > 0) | (part_types[keep] == _LINESTRING)
+   exploded, source, part_types = exploded[keep], source[keep], part_types[keep]
+
+   # QuPath exports exteriors clockwise, turn the others around so all contours are cut the same way
+   polygons = numpy.flatnonzero(part_types == _POLYGON)
+   counter_clockwise = polygons[shapely.is_ccw(shapely.get_exterior_ring(exploded[polygons]))]
+   exploded[counter_clockwise] = shapely.orient_polygons(exploded[counter_clockwise], exterior_cw=True)
+   return _Chunk(exploded, source, invalid, reasons, numpy.bincount(source, minlength=len(geoms)),
+                 len(counter_clockwise))
+
+
+def _label_parts(gdf: geopandas.GeoDataFrame, source: numpy.ndarray) -> geopandas.GeoDataFrame:
+   """Unique labels and ids for the rows of `gdf` taken from positions `source`, which repeat for exploded parts."""
+   taken = [column for column in (SOURCE_COLUMN, PART_COLUMN) if column in gdf.columns]
+   if taken:
+      raise ValueError(f"Cannot label exploded parts, the shapes already have the column(s) {', '.join(taken)}")
+   # source is sorted, the first part of every row is where its position is first found
+   part = numpy.arange(len(source)) - numpy.searchsorted(source, source)
+   gdf = gdf.assign(**{SOURCE_COLUMN: gdf.index, PART_COLUMN: part}).reset_index(drop=True)
+   if "id" in gdf.columns:
+      later = numpy.flatnonzero((part > 0) & gdf["id"].notna().to_numpy())
+      ids = gdf["id"].to_numpy(dtype=object, copy=True)
+      ids[later] = [str(uuid.uuid5(uuid.NAMESPACE_OID, f"{ids[i]}/{part[i]}")) for i in later.tolist()]
+      gdf["id"] = ids
+   return gdf
+
+
+@instrument.timed()
+def normalize_geometries(gdf: geopandas.GeoDataFrame, workers: int | None = None,
+                         chunk_size: int = CHUNK_SIZE) -> tuple[geopandas.GeoDataFrame, dict]:
+   """Repairs, explodes and orients all geometries so that every row is a Polygon or LineString the LMD can cut.
+
+   Invalid geometries (self-intersections, collapsed rings, ...) are repaired with `make_valid`,
+   multi-part geometries (from the file or from a repair) are exploded into one row per part that
+   keeps the attributes of its row, and polygon exteriors are oriented clockwise. If parts were
+   added, the result gets a new RangeIndex, so that QC reports name every part by its own label, and
+   the columns SOURCE_COLUMN and PART_COLUMN. The first part keeps the QuPath id of its row, the
+   others get a UUID derived from it, so that the processed GeoJSON has no duplicate ids.
+   Empty, zero-area and point geometries are dropped. Chunks run on a thread pool, shapely releases
+   the GIL.
+
+   Returns:
+      The normalized GeoDataFrame (`gdf` itself if nothing changed) and the QC summary: counts,
+      and up to MAX_ISSUES affected rows by index label with the reason and what was done.
+
+   Raises:
+      ValueError: If parts have to be added and `gdf` already has SOURCE_COLUMN or PART_COLUMN.
+   """
+   geoms = gdf.geometry.to_numpy()
+   starts = range(0, len(geoms), chunk_size)
+   workers = workers or min(len(starts), os.cpu_count() or 1) or 1
+   with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="normalize") as pool:
+      chunks = list(pool.map(lambda start: contextvars.copy_context().run(
+         _normalize_chunk, geoms[start:start + chunk_size]), starts))
+
+   source = numpy.concatenate([chunk.source + start for start, chunk in zip(starts, chunks, strict=True)] or
+                              [numpy.empty(0, dtype=numpy.int64)])
+   geometries = numpy.concatenate([chunk.geometries for chunk in chunks] or [numpy.empty(0, dtype=object)])
+   parts = numpy.concatenate([chunk.parts for chunk in chunks] or [numpy.empty(0, dtype=numpy.int64)])
+   invalid = numpy.zeros(len(geoms), dtype=bool)
+   reasons = numpy.full(len(geoms), "", dtype=object)
+   for start, chunk in zip(starts, chunks, strict=True):
+      invalid[chunk.invalid + start] = True
+      reasons[chunk.invalid + start] = chunk.reasons
+   reoriented = sum(chunk.reoriented for chunk in chunks)
+
+   input_types = shapely.get_type_id(geoms)
+   multi_input = numpy.isin(input_types, _MULTI)
+   dropped = parts == 0
+   exploded = (parts > 1) | (multi_input & ~dropped)
+   summary = {
+      "Shapes checked": len(geoms),
+      "Invalid shapes repaired": int((invalid & ~dropped).sum()),
+      "Multi-part shapes exploded": int(exploded.sum()),
+      "Parts added by exploding": int(parts[exploded].sum() - exploded.sum()),
+      "Shapes dropped (empty, collapsed or points)": int(dropped.sum()),
+      "Polygons reoriented clockwise": int(reoriented),
+      "Parts given a new id": 0,
+      "Shapes after normalization": len(geometries),
+   }
+
+   affected = numpy.flatnonzero(invalid | exploded | dropped)
+   reasons[multi_input & (reasons == "")] = "Multi-part geometry"
+   reasons[dropped & (reasons == "")] = "Empty or unsupported geometry"
+   issues = []
+   for position in affected[:MAX_ISSUES].tolist():
+      action = "dropped" if dropped[position] else ("repaired" if invalid[position] else "exploded")
+      if parts[position] > 1:
+         action += f" into {parts[position]} parts"
+      issues.append({"label": gdf.index[position], "id": gdf["id"].iat[position] if "id" in gdf.columns else None,
+                     "classification_name": gdf["classification_name"].iat[position]
+                     if "classification_name" in gdf.columns else None,
+                     "reason": reasons[position], "action": action})
+   summary["issues"] = issues
+   instrument.count(shapes=len(geoms), repaired=summary["Invalid shapes repaired"], exploded=exploded.sum(),
+                    dropped=dropped.sum())
+
+   if len(affected) or reoriented:
+      gdf = gdf.take(source) if len(affected) else gdf.copy(deep=False)
+      # an array is assigned by position, exploded parts still repeat the index label of their row here
+      gdf[gdf.geometry.name] = geopandas.array.from_shapely(geometries, crs=gdf.crs)
+      if len(source) and (numpy.diff(source) == 0).any():
+         gdf = _label_parts(gdf, source)
+         if "id" in gdf.columns:
+            summary["Parts given a new id"] = int(((gdf[PART_COLUMN] > 0) & gdf["id"].notna()).sum())
+   logger.info(f"Normalized {len(geoms)} shapes: {summary['Invalid shapes repaired']} repaired, "
+               f"{summary['Multi-part shapes exploded']} exploded, {summary['Shapes dropped (empty, collapsed or points)']} "
+               f"dropped, {reoriented} reoriented")
+   return gdf, summary
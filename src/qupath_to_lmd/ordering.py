@@ -0,0 +1,136 @@
+import numpy
+import pandas
+from loguru import logger
+
+NEIGHBOURS = 16
+TWO_OPT_WINDOW = 32
+TWO_OPT_PASSES = 8
+
+
+def travel_distance(coords: numpy.ndarray, offsets: numpy.ndarray, order: numpy.ndarray | None = None) -> float:
+   """Stage travel of cutting the shapes in `order`: from the end of each contour to the start of the next."""
+   starts = coords[offsets[:-1]]
+   ends = coords[offsets[1:] - 1]
+   if order is not None:
+      starts, ends = starts[order], ends[order]
+   return float(numpy.hypot(*(starts[1:] - ends[:-1]).T).sum())
+
+
+def _nearest_neighbour_tour(points: numpy.ndarray, first: int) -> numpy.ndarray:
+   """Greedy nearest neighbour tour starting at `first`.
+
+   Candidates come from one k-nearest query over all points. Only when all of them are
+   already visited is a tree of the remaining points queried, rebuilt when it has gone stale.
+   """
+   # scipy is only needed when shapes are reordered
+   from scipy.spatial import cKDTree
+
+   n = len(points)
+   k = min(NEIGHBOURS + 1, n)
+   neighbours = cKDTree(points).query(points, k=k)[1].reshape(n, k).tolist()
+   visited = bytearray(n)
+   tour = [first]
+   visited[first] = 1
+   remaining_ids, remaining_tree = None, None
+   current = first
+   for _ in range(n - 1):
+      nxt = next((j for j in neighbours[current] if not visited[j]), None)
+      while nxt is None:
+         if remaining_tree is not None:
+            for query_k in (NEIGHBOURS, 16 * NEIGHBOURS):
+               hits = numpy.atleast_1d(remaining_tree.query(points[current], k=min(query_k, len(remaining_ids)))[1])
+               nxt = next((remaining_ids[h] for h in hits.tolist() if not visited[remaining_ids[h]]), None)
+               if nxt is not None:
+                  break
+         if nxt is None:
+            remaining_ids = numpy.flatnonzero(numpy.frombuffer(visited, dtype=numpy.uint8) == 0).tolist()
+            remaining_tree = cKDTree(points[remaining_ids])
+      tour.append(nxt)
+      visited[nxt] = 1
+      current = nxt
+   return numpy.asarray(tour, dtype=numpy.int64)
+
+
+def _two_opt(points: numpy.ndarray, tour: numpy.ndarray, window: int = TWO_OPT_WINDOW,
+             passes: int = TWO_OPT_PASSES) -> numpy.ndarray:
+   """2-opt on an open path, restricted to reversing runs of at most `window` shapes.
+
+   Gains of all candidate reversals are computed as arrays, then the best non-overlapping
+   improving reversals are applied together, for a few passes or until nothing improves.
+   """
+   tour = tour.copy()
+   n = len(tour)
+   if n < 4:
+      return tour
+   for _ in range(passes):
+      x, y = points[tour, 0], points[tour, 1]
+      edge = numpy.hypot(numpy.diff(x), numpy.diff(y))
+      best_gain = numpy.zeros(n)
+      best_length = numpy.zeros(n, dtype=numpy.int64)
+      for length in range(2, min(window, n - 2) + 1):
+         m = n - 1 - length
+         # reversing tour[i + 1:i + length + 1] swaps edges (i, i+1), (b, b+1) for (i, b), (i+1, b+1)
+         gain = (edge[:m] + edge[length:length + m]
+                 - numpy.hypot(x[:m] - x[length:length + m], y[:m] - y[length:length + m])
+                 - numpy.hypot(x[1:m + 1] - x[length + 1:], y[1:m + 1] - y[length + 1:]))
+         better = gain > best_gain[:m]
+         best_gain[:m][better] = gain[better]
+         best_length[:m][better] = length
+      candidates = numpy.flatnonzero(best_gain > 1e-9)
+      if len(candidates) == 0:
+         break
+      used = bytearray(n)
+      for i in candidates[numpy.argsort(-best_gain[candidates])].tolist():
+         end = i + int(best_length[i]) + 1
+         if any(used[i:end + 1]):
+            continue
+         used[i:end + 1] = b"\x01" * (end + 1 - i)
+         tour[i + 1:end] = tour[i + 1:end][::-1]
+   return tour
+
+
+def order_shapes(coords: numpy.ndarray, offsets: numpy.ndarray, wells) -> tuple[numpy.ndarray, dict]:
+   """Orders shapes to minimise stage travel: grouped by well, then a short tour within every well.
+
+   Wells keep the order in which they first appear. Within a well, a nearest neighbour tour over
+   the contour centroids is improved with 2-opt, starting from the shape closest to where the
+   previous well ended.
+
+   Returns:
+      The new shape order (indices into the offsets slices) and a report with the stage travel
+      before and after, measured from the end of each contour to the start of the next.
+   """
+   n_shapes = len(offsets) - 1
+   if n_shapes == 0:
+      return numpy.zeros(0, dtype=numpy.int64), {"Stage travel before ordering": 0.0, "Stage travel after ordering": 0.0}
+   counts = numpy.diff(offsets)
+   centroids = numpy.add.reduceat(coords, offsets[:-1], axis=0) / counts[:, None]
+   well_codes, _ = pandas.factorize(numpy.asarray(wells, dtype=object))
+
+   order = []
+   position = coords[offsets[0]]
+   for code in range(well_codes.max() + 1):
+      members = numpy.flatnonzero(well_codes == code)
+      points = centroids[members]
+      first = int(numpy.argmin(numpy.hypot(*(points - position).T)))
+      tour = _two_opt(points, _nearest_neighbour_tour(points, first))
+      order.append(members[tour])
+      position = coords[offsets[members[tour[-1]] + 1] - 1]
+   order = numpy.concatenate(order)
+
+   report = {
+      "Stage travel before ordering": round(travel_distance(coords, offsets), 1),
+      "Stage travel after ordering": round(travel_distance(coords, offsets, order), 1),
+   }
+   logger.info(f"Ordered {n_shapes} shapes, stage travel {report['Stage travel before ordering']} -> "
+               f"{report['Stage travel after ordering']}")
+   return order, report
+
+
+def reorder(coords: numpy.ndarray, offsets: numpy.ndarray, order: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+   """Returns the flat coordinate buffer and offsets with the shapes in `order`."""
+   counts = numpy.diff(offsets)[order]
+   new_offsets = numpy.zeros(len(order) + 1, dtype=numpy.int64)
+   numpy.cumsum(counts, out=new_offsets[1:])
+   source = numpy.repeat(offsets[:-1][order] - new_offsets[:-1], counts) + numpy.arange(new_offsets[-1])
+   return coords[source], new_offsets
@@ -0,0 +1,336 @@
+import io
+from typing import TYPE_CHECKING, NamedTuple
+
+import geopandas
+import numpy
+import pandas
+from loguru import logger
+
+import qupath_to_lmd.ingest as ingest
+import qupath_to_lmd.instrument as instrument
+import qupath_to_lmd.intermediates as intermediates
+import qupath_to_lmd.jobs as jobs
+import qupath_to_lmd.normalize as normalize
+import qupath_to_lmd.ordering as ordering
+import qupath_to_lmd.plates as plates
+import qupath_to_lmd.plotting as plotting
+import qupath_to_lmd.preview as preview
+import qupath_to_lmd.qc as qc
+import qupath_to_lmd.shapes as shapes
+import qupath_to_lmd.simplify as simplify
+import qupath_to_lmd.stage as stage
+import qupath_to_lmd.utils as utils
+import qupath_to_lmd.xml_writer as xml_writer
+
+if TYPE_CHECKING:
+   from lmd.lib import Collection
+
+ORIENTATION_TRANSFORM = numpy.array([[1, 0], [0, -1]])
+# XML units per QuPath unit, the scale of every py-lmd Collection
+LMD_SCALE = 100
+
+
+@instrument.timed()
+def load_geojson(geojson_path, bbox: tuple[float, float, float, float] | None = None) -> tuple[geopandas.GeoDataFrame, dict]:
+   """Streams, QCs and normalizes a QuPath export. Returns cleaned GDF and available calibration points.
+
+   GeoParquet and FlatGeobuf exports are read as columns, and only where they intersect `bbox`
+   if one is given (see `ingest.read_shapes`).
+   """
+   df, available_points, report = ingest.read_shapes(geojson_path, bbox=bbox)
+   if report["n_features"] == 0:
+      raise ValueError("The geojson file is empty.")
+   if report["n_unclassified"]:
+      logger.info(f"{report['n_unclassified']} unclassified objects are ignored")
+   df, summary = normalize.normalize_geometries(df)
+   if summary["issues"]:
+      logger.warning(f"{summary['Invalid shapes repaired']} shapes were repaired, {summary['Multi-part shapes exploded']} "
+                     f"exploded and {summary['Shapes dropped (empty, collapsed or points)']} dropped")
+   logger.info(f"Loaded {len(df)} shapes and {len(available_points)} calibration points")
+   instrument.count(shapes=len(df))
+   return df, available_points
+
+
+def calibration_array(available_points: dict, calib_names: list | None = None) -> numpy.ndarray:
+   """Returns the (3, 2) calibration array, by default from the first three points in the file."""
+   if calib_names is None:
+      calib_names = list(available_points)[:3]
+   if len(calib_names) != 3:
+      raise ValueError(f"Three calibration points are needed, got {len(calib_names)}: {calib_names}")
+   missing = [name for name in calib_names if name not in available_points]
+   if missing:
+      raise ValueError(f"Calibration points not found in file: {missing}")
+   return numpy.array([available_points[name] for name in calib_names])
+
+
+class Outlines(NamedTuple):
+   """Simplified outlines of the collected shapes as flat coordinates and offsets, with the simplification report."""
+
+   coords: numpy.ndarray
+   offsets: numpy.ndarray
+   report: dict
+
+
+def _select_wells(gdf: geopandas.GeoDataFrame, saw: dict) -> tuple[pandas.Series, numpy.ndarray]:
+   """Well of every shape and the mask of shapes whose class has no well."""
+   # one lookup per category instead of per shape
+   wells = gdf['classification_name'].map(saw)
+   skipped = wells.isna().to_numpy()
+   for classification in gdf.loc[skipped, 'classification_name'].unique():
+      logger.debug(f"{classification} was not found in samples and wells, it is skipped")
+   return wells[~skipped], skipped
+
+
+def simplified_outlines(geometries, simplify_settings: simplify.SimplifySettings | None = None) -> Outlines:
+   """Simplifies the geometries and extracts their outlines, see `build_collection`."""
+   with instrument.span("simplify", shapes=len(geometries)) as span:
+      if simplify_settings is None:
+         simplified, simplify_report = simplify.fixed_simplify(geometries)
+      else:
+         simplified, simplify_report = simplify.adaptive_simplify(geometries, simplify_settings)
+      span.count(vertices=simplify_report["Vertices after simplification"])
+   logger.info("Simplified geometries")
+   with instrument.span("extract") as span:
+      coords, offsets = shapes.flat_coordinates(simplified)
+      span.count(shapes=len(offsets) - 1, vertices=len(coords))
+   logger.info(f"Extracted {len(coords)} vertices")
+   return Outlines(coords, offsets, simplify_report)
+
+
+def _intermediate_key(geometry_version: str | None, name: str, *parts) -> tuple | None:
+   return None if geometry_version is None else (geometry_version, name, *parts)
+
+
+def _empty_collection(calib_array: numpy.ndarray) -> "Collection":
+   # py-lmd loads numba, scikit-image and matplotlib, only the hifi plot and `build_collection` need it
+   from lmd.lib import Collection
+
+   logger.debug(f"Calibration point array {calib_array}")
+   the_collection = Collection(calibration_points=calib_array)
+   the_collection.orientation_transform = ORIENTATION_TRANSFORM
+   logger.debug("Created collection with calibration points and orientation transform")
+   return the_collection
+
+
+def _order(coords: numpy.ndarray, offsets: numpy.ndarray, wells: pandas.Series) -> tuple[numpy.ndarray, dict]:
+   with instrument.span("order", shapes=len(offsets) - 1):
+      return ordering.order_shapes(coords, offsets, wells)
+
+
+def _ordered(coords: numpy.ndarray, offsets: numpy.ndarray, order: numpy.ndarray | None) -> tuple[numpy.ndarray, numpy.ndarray]:
+   return (coords, offsets) if order is None else ordering.reorder(coords, offsets, order)
+
+
+@instrument.timed()
+def build_collection(gdf: geopandas.GeoDataFrame, calib_array: numpy.ndarray, saw: dict,
+                     simplify_settings: simplify.SimplifySettings | None = None,
+                     optimize_order: bool = False) -> tuple["Collection", dict]:
+   """Builds the py-lmd Collection for all shapes whose class has a well in `saw`.
+
+   Shapes are simplified with a fixed tolerance of 1, or adaptively to the vertex budgets of
+   `simplify_settings`. With `optimize_order` they are grouped by well and reordered to
+   minimise stage travel, otherwise they keep the row order of `gdf`.
+
+   Returns:
+      The collection and the simplification (and ordering) report.
+
+   Raises:
+      ValueError: If a geometry to be collected is neither a Polygon nor a LineString.
+   """
+   wells, skipped = _select_wells(gdf, saw)
+   coords, offsets, simplify_report = simplified_outlines(gdf.geometry[~skipped], simplify_settings)
+   if optimize_order:
+      order, order_report = _order(coords, offsets, wells)
+      coords, offsets = ordering.reorder(coords, offsets, order)
+      wells = wells.iloc[order]
+      simplify_report = {**simplify_report, **order_report}
+
+   the_collection = _empty_collection(calib_array)
+   with instrument.span("new_shape", shapes=len(offsets) - 1, wells=wells.nunique()):
+      shapes.emit_shapes(the_collection, coords, offsets, wells)
+   logger.debug("Added shapes to collection")
+   return the_collection, simplify_report
+
+
+@instrument.timed()
+def overlap_qc(gdf: geopandas.GeoDataFrame, saw: dict | None = None,
+               min_distance: float = 0.0) -> tuple[pandas.DataFrame, pandas.DataFrame]:
+   """Finds overlapping, duplicated and too close shapes and summarizes cross-contamination per well.
+
+   With `saw` only shapes that are collected are checked and pairs are grouped by well,
+   otherwise all classified shapes are checked and grouped by class.
+
+   Returns:
+      The flagged pairs and the per-well (or per-class) summary.
+   """
+   groups = gdf['classification_name'].astype(object)
+   if saw is not None:
+      groups = groups.map(saw)
+   checked = groups.notna().to_numpy()
+   pairs = qc.proximity_qc(gdf.geometry[checked], groups[checked], min_distance=min_distance)
+   summary = qc.well_contamination_summary(pairs, groups[checked])
+   instrument.count(shapes=checked.sum(), pairs=len(pairs))
+   logger.info(f"Overlap QC: {len(pairs)} flagged pairs, {int(pairs['cross_well'].sum())} between different wells")
+   return pairs, summary
+
+
+def plate_csv(saw: dict, plate_type: str = "384") -> str:
+   """Returns the plate layout of the samples and wells as csv."""
+   return utils.sample_placement(saw=saw, plate_type=plate_type).to_csv(index=True)
+
+
+def check_samples_and_wells(classes: list, saw: dict, plate_type: str = "384") -> tuple[set, set]:
+   """Checks a samples and wells dictionary against the classes of a geodataframe.
+
+   Returns:
+      The classes missing from the dictionary and the wells that do not exist on the plate.
+
+   Raises:
+      ValueError: If `saw` is not a dictionary or is empty.
+   """
+   if not isinstance(saw, dict):
+      raise ValueError("samples and wells is not a dict")
+   if not saw:
+      raise ValueError("dictionary is empty, most likely typo, please double check")
+   missing = set(classes) - saw.keys()
+   invalid_wells = plates.PlateLayout(plate_type).invalid_wells(list(saw.values()))
+   return missing, invalid_wells
+
+
+@instrument.timed()
+def make_classes_unique(gdf: geopandas.GeoDataFrame, classes_to_modify: list) -> geopandas.GeoDataFrame:
+   """Returns `gdf` where every shape of the given classes gets a numbered class name.
+
+   The original names are kept in 'original_classification_name', so repeated runs number from the original.
+   Shapes are numbered per class in row order with a grouped cumulative count, and only the rows of the
+   given classes get a new 'classification' payload. The result shares unchanged columns with `gdf`.
+   """
+   gdf = gdf.copy(deep=False)
+
+   # Keep track of original names for the download
+   if 'original_classification_name' not in gdf.columns:
+      gdf['original_classification_name'] = gdf['classification_name']
+
+   # Important to match on the original name in case of multiple runs
+   original = gdf['original_classification_name']
+   selected = original.isin(classes_to_modify).to_numpy()
+   if not selected.any():
+      return gdf
+
+   base_names = original[selected].astype(object)
+   numbers = base_names.groupby(base_names, sort=False).cumcount() + 1
+   suffixes = numbers.astype(str).str.zfill(3)
+   new_names = (base_names + "_" + suffixes).to_numpy()
+
+   names = gdf['classification_name'].astype(object).to_numpy(copy=True)
+   names[selected] = new_names
+   gdf['classification_name'] = pandas.Categorical(names)
+
+   #replace old classification name inside classification dict
+   classification = gdf['classification'].to_numpy(dtype=object, copy=True)
+   classification[selected] = utils.numbered_classification_column(
+      gdf['classification'][selected], base_names, suffixes)
+   gdf['classification'] = classification
+   instrument.count(shapes=selected.sum())
+   logger.info(f"Numbered {int(selected.sum())} shapes of {len(classes_to_modify)} classes")
+   return gdf
+
+
+def _vertex_stats(lengths: numpy.ndarray) -> dict:
+   if len(lengths) == 0:
+      return {"Number of shapes": 0, "Number of vertices": 0}
+   return {
+      "Number of shapes": len(lengths),
+      "Number of vertices": int(lengths.sum()),
+      "Mean vertices": round(float(lengths.mean())),
+      "Min vertices": int(lengths.min()),
+      "5% percentile vertices": round(float(numpy.percentile(lengths, 5))),
+      "Median vertices": round(float(numpy.median(lengths))),
+      "95% percentile vertices": round(float(numpy.percentile(lengths, 95))),
+      "Max vertices": int(lengths.max()),
+   }
+
+
+def collection_stats(collection: "Collection") -> dict:
+   """Summarizes shape and vertex counts of a collection, as `Collection.stats` prints them."""
+   return _vertex_stats(numpy.array([len(shape.points) for shape in collection.shapes]))
+
+
+class CollectionArtifacts(NamedTuple):
+   """In-memory outputs of one collection export."""
+
+   xml: bytes | None
+   plate_csv: str
+   qc_png: bytes
+   stats: dict
+   preflight: stage.Preflight | None = None
+
+
+@instrument.timed()
+def export_collection(gdf: geopandas.GeoDataFrame, calib_array: numpy.ndarray, saw: dict,
+                      plate_type: str = "384", xml_sink=None, hifi_plot: bool = False,
+                      simplify_settings: simplify.SimplifySettings | None = None,
+                      optimize_order: bool = False, geometry_version: str | None = None,
+                      stage_range: tuple | None = None) -> CollectionArtifacts:
+   """Builds the collection and returns XML, plate csv, QC image and stats without touching shared state.
+
+   If `xml_sink` is given the XML is streamed into it and `xml` is None.
+   The QC image is the rasterized preview, `hifi_plot` renders the slower matplotlib plot instead.
+   The stats include the simplification report, and the stage travel if `optimize_order` is set.
+   Before anything is written, all vertices are transformed to stage coordinates and checked
+   against `stage_range` and the calibration triangle, see `stage.preflight`.
+
+   With a `geometry_version` (see `store.GeometryStore`), the simplified outlines, the serialized
+   vertices and the preview labels are kept in the intermediates cache, so exporting the same
+   shapes into other wells only redoes the well lookup, the XML assembly and the colouring.
+   The output is the same with and without the cache.
+   """
+   wells, skipped = _select_wells(gdf, saw)
+   jobs.progress("Simplifying outlines", 0, len(wells))
+   # adaptive budgets depend on which shapes are collected, so the selection is part of every key
+   selection = (simplify_settings, intermediates.digest(skipped)) if geometry_version is not None else ()
+   coords, offsets, simplify_report = intermediates.cached(
+      _intermediate_key(geometry_version, "outlines", *selection),
+      lambda: simplified_outlines(gdf.geometry[~skipped], simplify_settings),
+      lambda outlines: outlines.coords.nbytes + outlines.offsets.nbytes)
+   jobs.progress("Checking stage coordinates", 0, len(wells))
+   checks = stage.preflight(coords, offsets, wells, calib_array, ORIENTATION_TRANSFORM, LMD_SCALE, stage_range)
+   order = None
+   if optimize_order:
+      order, order_report = _order(coords, offsets, wells)
+      wells = wells.iloc[order]
+      simplify_report = {**simplify_report, **order_report}
+   jobs.progress("Rendering QC image", 0, len(wells))
+   with instrument.span("plot", shapes=len(wells)):
+      if hifi_plot:
+         # only the hifi plot needs a py-lmd Collection, the XML is assembled from the cached vertices
+         the_collection = _empty_collection(calib_array)
+         shapes.emit_shapes(the_collection, *_ordered(coords, offsets, order), wells)
+         qc_png = plotting.plot_collection(the_collection)
+      else:
+         # the label of a pixel is the last shape painted on it, so reordered shapes need their own labels
+         labels_key = None if order is not None else \
+            _intermediate_key(geometry_version, "preview_labels", *selection, intermediates.digest(calib_array))
+         labels = intermediates.cached(
+            labels_key, lambda: preview.label_preview(*_ordered(coords, offsets, order), calib_array),
+            lambda labels: labels.labels.nbytes)
+         qc_png = preview.to_png(preview.color_preview(labels, wells).image)
+   logger.debug("Rendered QC image")
+
+   xml = None
+   with instrument.span("save", shapes=len(wells)) as span:
+      blocks = intermediates.cached(
+         _intermediate_key(geometry_version, "point_blocks", *selection),
+         lambda: xml_writer.point_blocks(coords, offsets, ORIENTATION_TRANSFORM, LMD_SCALE),
+         lambda blocks: len(blocks.data) + blocks.offsets.nbytes + blocks.counts.nbytes)
+      sink = xml_sink if xml_sink is not None else io.BytesIO()
+      span.count(bytes=xml_writer.write_blocks_xml(sink, calib_array, ORIENTATION_TRANSFORM, LMD_SCALE, blocks, wells, order,
+                                                   progress=lambda n: jobs.progress("Writing XML", n, len(wells))))
+      if xml_sink is None:
+         xml = sink.getvalue()
+   logger.debug("Serialized collection to xml")
+
+   stats = {**_vertex_stats(numpy.diff(offsets)), **simplify_report, **checks.stats}
+   with instrument.span("plate_csv", wells=len(saw)):
+      csv = plate_csv(saw, plate_type)
+   return CollectionArtifacts(xml, csv, qc_png, stats, checks)
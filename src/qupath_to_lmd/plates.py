@@ -0,0 +1,126 @@
+import functools
+import string
+
+import numpy
+import pandas
+from loguru import logger
+
+# rows and columns of the supported plate types
+PLATE_SHAPES = {"96": (8, 12), "384": (16, 24), "1536": (32, 48)}
+
+
+def row_labels(n_rows: int) -> list[str]:
+   """Row letters A, B, ..., Z, AA, AB, ... as used by 1536 well plates."""
+   letters = string.ascii_uppercase
+   return [letters[i] if i < 26 else letters[i // 26 - 1] + letters[i % 26] for i in range(n_rows)]
+
+
+@functools.cache
+def well_names(plate_type: str) -> pandas.Index:
+   """Names of all wells of a plate in row-major order (A1, A2, ...), a hash index for well to position lookups."""
+   n_rows, n_cols = plate_shape(plate_type)
+   rows = numpy.repeat(numpy.array(row_labels(n_rows), dtype=object), n_cols)
+   columns = numpy.tile(numpy.arange(1, n_cols + 1).astype(str).astype(object), n_rows)
+   return pandas.Index(rows + columns, name="well")
+
+
+def plate_shape(plate_type: str) -> tuple[int, int]:
+   """Rows and columns of a plate type.
+
+   Raises:
+      ValueError: If the plate type is not supported.
+   """
+   if plate_type not in PLATE_SHAPES:
+      raise ValueError(f"Plate must be one of {', '.join(PLATE_SHAPES)}")
+   return PLATE_SHAPES[plate_type]
+
+
+class PlateLayout:
+   """A well plate as arrays: which wells are available, and which sample goes into every well.
+
+   `available` is a (rows, columns) boolean mask, `samples` an int32 array of the same shape with
+   the position of every well's sample in `sample_names`, -1 for empty wells. Wells are looked up
+   through the hash index of `well_names`, so validating or placing thousands of samples is a
+   single vectorized lookup.
+   """
+
+   def __init__(self, plate_type: str = "384", available: numpy.ndarray | None = None):
+      self.plate_type = plate_type
+      self.n_rows, self.n_cols = plate_shape(plate_type)
+      self.rows = row_labels(self.n_rows)
+      self.columns = list(range(1, self.n_cols + 1))
+      self.wells = well_names(plate_type)
+      self.available = numpy.ones((self.n_rows, self.n_cols), dtype=bool) if available is None else available
+      self.samples = numpy.full((self.n_rows, self.n_cols), -1, dtype=numpy.int32)
+      self.sample_names = pandas.Index([], dtype=object)
+
+   @classmethod
+   def with_margins(cls, plate_type: str = "384", margins: int = 0, step_row: int = 1, step_col: int = 1) -> "PlateLayout":
+      """Layout whose available wells leave `margins` wells free on every side and skip rows and columns by the steps.
+
+      Raises:
+         ValueError: If the plate type is not supported or the margins are not an integer.
+      """
+      if not isinstance(margins, int):
+         raise ValueError("margins must be an integer")
+      n_rows, n_cols = plate_shape(plate_type)
+      margins = max(margins, 0)
+      available = numpy.zeros((n_rows, n_cols), dtype=bool)
+      available[margins:n_rows - margins:step_row, margins:n_cols - margins:step_col] = True
+      return cls(plate_type, available)
+
+   def __len__(self) -> int:
+      return self.n_rows * self.n_cols
+
+   def positions(self, wells) -> numpy.ndarray:
+      """Row-major position of every well, -1 for names that are not wells of this plate."""
+      return self.wells.get_indexer(pandas.Index(wells, dtype=object))
+
+   def invalid_wells(self, wells) -> set:
+      """The given wells that do not exist on this plate."""
+      wells = pandas.Index(wells, dtype=object)
+      return set(wells[self.positions(wells) < 0])
+
+   def acceptable_wells(self) -> list[str]:
+      """Names of the available wells, row by row."""
+      return self.wells[self.available.ravel()].tolist()
+
+   def place(self, saw: dict) -> "PlateLayout":
+      """Puts the samples of a samples and wells dictionary into their wells; wells not on the plate are skipped."""
+      wells = pandas.Index(list(saw.values()), dtype=object)
+      positions = self.positions(wells)
+      valid = positions >= 0
+      if not valid.all():
+         logger.warning(f"Wells not existing in {self.plate_type}wp are left out: {set(wells[~valid])}")
+      self.sample_names = pandas.Index(list(saw), dtype=object)
+      self.samples.ravel()[positions[valid]] = numpy.flatnonzero(valid)
+      return self
+
+   def sample_frame(self) -> pandas.DataFrame:
+      """The samples as a plate, rows by letter and columns by number as strings, '' for empty wells."""
+      values = numpy.append(self.sample_names.to_numpy(dtype=object), "")[self.samples]
+      return pandas.DataFrame(values, index=self.rows, columns=[str(c) for c in self.columns])
+
+   def well_frame(self) -> pandas.DataFrame:
+      """The well names as a plate, e.g. to show which wells are available."""
+      return pandas.DataFrame(self.wells.to_numpy().reshape(self.n_rows, self.n_cols), index=self.rows,
+                              columns=self.columns)
+
+
+def frame_cells(df: pandas.DataFrame) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+   """Filled cells of a plate dataframe indexed by row, or by (plate, row) for several plates.
+
+   Returns:
+      Sample names, plates (1 without a plate level) and wells of the filled cells, row by row.
+   """
+   values = df.to_numpy(dtype=object)
+   filled = pandas.notna(values) & (values != "")
+   rows, cols = numpy.nonzero(filled)
+   if isinstance(df.index, pandas.MultiIndex):
+      plates = df.index.get_level_values(0).to_numpy()[rows].astype(int)
+      row_names = df.index.get_level_values(-1).to_numpy(dtype=object)[rows]
+   else:
+      plates = numpy.ones(len(rows), dtype=int)
+      row_names = df.index.to_numpy(dtype=object)[rows]
+   wells = row_names.astype(str).astype(object) + df.columns.to_numpy().astype(str).astype(object)[cols]
+   return values[rows, cols], plates, wells
@@ -0,0 +1,46 @@
+import io
+from typing import TYPE_CHECKING
+
+import numpy
+from loguru import logger
+
+if TYPE_CHECKING:
+   from lmd.lib import Collection
+
+
+def plot_collection(collection: "Collection", fig_size: tuple = (5, 5), dpi: int = 100) -> bytes:
+   """Renders the collection like `Collection.plot` and returns the PNG bytes.
+
+   Uses the object oriented matplotlib API instead of pyplot, so no global figure state is
+   shared and several sessions can plot at the same time.
+   """
+   # matplotlib takes a while to import, and only the hifi plot needs more than its colormaps
+   from matplotlib import rcParams
+   from matplotlib.collections import LineCollection
+   from matplotlib.figure import Figure
+
+   fig = Figure(figsize=fig_size, dpi=dpi)
+   ax = fig.subplots()
+
+   if collection.calibration_points is not None:
+      calibration = numpy.asarray(collection.calibration_points) @ collection.orientation_transform
+      ax.scatter(calibration[:, 0], calibration[:, 1], marker="x")
+
+   outlines = []
+   for shape in collection.shapes:
+      transform = shape.orientation_transform if shape.orientation_transform is not None else collection.orientation_transform
+      outlines.append(shape.points @ transform)
+   colors = rcParams["axes.prop_cycle"].by_key()["color"]
+   ax.add_collection(LineCollection(outlines, colors=[colors[i % len(colors)] for i in range(len(outlines))]))
+   ax.autoscale_view()
+
+   ax.grid(True)
+   ax.ticklabel_format(useOffset=False)
+   ax.set_xlabel('x-axis')
+   ax.set_ylabel('y-axis')
+   ax.axis('equal')
+
+   buffer = io.BytesIO()
+   fig.savefig(buffer, format="png")
+   logger.debug(f"Plotted {len(outlines)} shapes")
+   return buffer.getvalue()
@@ -0,0 +1,247 @@
+import io
+from typing import TYPE_CHECKING, NamedTuple
+
+import numpy
+import pandas
+from loguru import logger
+
+if TYPE_CHECKING:
+   from lmd.lib import Collection
+
+BACKGROUND = numpy.array([255, 255, 255], dtype=numpy.uint8)
+CALIBRATION_COLOR = numpy.array([0, 0, 0], dtype=numpy.uint8)
+
+
+class PreviewRaster(NamedTuple):
+   """Rasterized preview of a collection.
+
+   `image` is an (H, W, 3) uint8 array in QuPath orientation (y grows downwards),
+   pixel (row, col) covers x = xmin + col / scale, y = ymin + row / scale.
+   """
+
+   image: numpy.ndarray
+   xmin: float
+   ymin: float
+   scale: float
+
+
+def _well_palette(n: int) -> numpy.ndarray:
+   """One RGB colour per well, cycling through tab20."""
+   from matplotlib import colormaps
+
+   cmap = colormaps["tab20"]
+   return (numpy.array([cmap(i % cmap.N)[:3] for i in range(max(n, 1))]) * 255).astype(numpy.uint8)
+
+
+def _scanline_fill(px: numpy.ndarray, py: numpy.ndarray, offsets: numpy.ndarray, shape_ids: numpy.ndarray,
+                   height: int, width: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+   """Even-odd scanline fill of many rings at once.
+
+   Every edge is intersected with the pixel row centres it spans, crossings are sorted per shape
+   and row and paired into spans, and spans are expanded into pixel indices. Work is proportional
+   to the number of filled pixels plus crossings, never to a Python loop over shapes.
+
+   Returns:
+      Flat pixel indices and the shape id that covers each of them.
+   """
+   n_vertices = len(px)
+   shape_of_vertex = numpy.repeat(shape_ids, numpy.diff(offsets))
+   # edges between consecutive vertices of the same ring, plus the closing edge of every ring
+   starts = numpy.arange(n_vertices - 1)
+   same_ring = shape_of_vertex[:-1] == shape_of_vertex[1:]
+   starts, ends = starts[same_ring], starts[same_ring] + 1
+   starts = numpy.concatenate([starts, offsets[1:] - 1])
+   ends = numpy.concatenate([ends, offsets[:-1]])
+
+   x0, y0, x1, y1 = px[starts], py[starts], px[ends], py[ends]
+   edge_shape = shape_of_vertex[starts]
+   low, high = numpy.minimum(y0, y1), numpy.maximum(y0, y1)
+   first_row = numpy.maximum(numpy.ceil(low - 0.5), 0).astype(numpy.int64)
+   last_row = numpy.minimum(numpy.ceil(high - 0.5) - 1, height - 1).astype(numpy.int64)
+   n_rows = numpy.maximum(last_row - first_row + 1, 0)
+
+   edge_of_crossing = numpy.repeat(numpy.arange(len(starts)), n_rows)
+   row = first_row[edge_of_crossing] + (numpy.arange(len(edge_of_crossing)) -
+                                        numpy.repeat(numpy.cumsum(n_rows) - n_rows, n_rows))
+   e = edge_of_crossing
+   x = x0[e] + (row + 0.5 - y0[e]) * (x1[e] - x0[e]) / (y1[e] - y0[e])
+   crossing_shape = edge_shape[e]
+
+   order = numpy.lexsort((x, row, crossing_shape))
+   x, row, crossing_shape = x[order], row[order], crossing_shape[order]
+   span_start = numpy.maximum(numpy.ceil(x[0::2] - 0.5), 0).astype(numpy.int64)
+   span_end = numpy.minimum(numpy.floor(x[1::2] - 0.5), width - 1).astype(numpy.int64)
+   span_row, span_shape = row[0::2], crossing_shape[0::2]
+   span_length = numpy.maximum(span_end - span_start + 1, 0)
+
+   span_of_pixel = numpy.repeat(numpy.arange(len(span_length)), span_length)
+   col = span_start[span_of_pixel] + (numpy.arange(len(span_of_pixel)) -
+                                      numpy.repeat(numpy.cumsum(span_length) - span_length, span_length))
+   return span_row[span_of_pixel] * width + col, span_shape[span_of_pixel]
+
+
+def _outline_pixels(px: numpy.ndarray, py: numpy.ndarray, offsets: numpy.ndarray, shape_ids: numpy.ndarray,
+                    height: int, width: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+   """Samples every edge at sub-pixel steps and returns the touched flat pixel indices and shape ids."""
+   shape_of_vertex = numpy.repeat(shape_ids, numpy.diff(offsets))
+   same_ring = shape_of_vertex[:-1] == shape_of_vertex[1:]
+   starts = numpy.flatnonzero(same_ring)
+   dx, dy = px[starts + 1] - px[starts], py[starts + 1] - py[starts]
+   n_samples = numpy.ceil(numpy.hypot(dx, dy)).astype(numpy.int64) + 1
+   edge = numpy.repeat(numpy.arange(len(starts)), n_samples)
+   t = (numpy.arange(len(edge)) - numpy.repeat(numpy.cumsum(n_samples) - n_samples, n_samples)) / (n_samples[edge])
+   cols = numpy.clip((px[starts][edge] + t * dx[edge]).astype(numpy.int64), 0, width - 1)
+   rows = numpy.clip((py[starts][edge] + t * dy[edge]).astype(numpy.int64), 0, height - 1)
+   return rows * width + cols, shape_of_vertex[starts][edge]
+
+
+class PreviewLabels(NamedTuple):
+   """Which shape covers every pixel of a preview, before it is coloured by well.
+
+   `labels` holds, per flat pixel index, the shape index for fills, the shape index plus
+   `n_shapes` for outlines and -1 for background. It depends on the geometry only, so it can
+   be kept and coloured again when the wells change.
+   """
+
+   labels: numpy.ndarray
+   height: int
+   width: int
+   xmin: float
+   ymin: float
+   scale: float
+   n_shapes: int
+   calibration_points: numpy.ndarray | None
+
+
+def label_preview(coords: numpy.ndarray, offsets: numpy.ndarray, calibration_points=None,
+                  size: int = 1024, outline_min_px: float = 6.0) -> PreviewLabels:
+   """Rasterizes all contours into shape labels, see `render_preview` for the arguments."""
+   xs, ys = numpy.ascontiguousarray(coords[:, 0]), numpy.ascontiguousarray(coords[:, 1])
+   if calibration_points is not None:
+      calibration_points = numpy.asarray(calibration_points, dtype=float)
+      xs_all, ys_all = numpy.concatenate([xs, calibration_points[:, 0]]), numpy.concatenate([ys, calibration_points[:, 1]])
+   else:
+      xs_all, ys_all = xs, ys
+   n_shapes = len(offsets) - 1
+   if len(xs_all) == 0:
+      return PreviewLabels(numpy.full(size * size, -1, dtype=numpy.int32), size, size, 0.0, 0.0, 1.0, n_shapes, None)
+   xmin, xmax, ymin, ymax = xs_all.min(), xs_all.max(), ys_all.min(), ys_all.max()
+   scale = (size - 1) / max(xmax - xmin, ymax - ymin, 1e-9)
+   width = int((xmax - xmin) * scale) + 1
+   height = int((ymax - ymin) * scale) + 1
+   px = (xs - xmin) * scale
+   py = (ys - ymin) * scale
+
+   labels = numpy.full(height * width, -1, dtype=numpy.int64)
+   counts = numpy.diff(offsets)
+   nonempty = counts > 0
+   extent_px = numpy.zeros(n_shapes)
+   starts = offsets[:-1][nonempty]
+   extent_px[nonempty] = numpy.maximum(
+      numpy.maximum.reduceat(px, starts) - numpy.minimum.reduceat(px, starts),
+      numpy.maximum.reduceat(py, starts) - numpy.minimum.reduceat(py, starts))
+
+   # sub-pixel shapes: a single pixel at their first vertex
+   tiny = nonempty & (extent_px < 1)
+   first = offsets[:-1][tiny]
+   labels[py[first].astype(numpy.int64) * width + px[first].astype(numpy.int64)] = numpy.flatnonzero(tiny)
+
+   # the rest: vectorized scanline fill, selected vertices are gathered with one boolean mask
+   large = nonempty & ~tiny
+   if large.any():
+      vertex_mask = numpy.repeat(large, counts)
+      sub_offsets = numpy.concatenate([[0], numpy.cumsum(counts[large])])
+      sub_ids = numpy.flatnonzero(large)
+      pixels, shape_of_pixel = _scanline_fill(px[vertex_mask], py[vertex_mask], sub_offsets, sub_ids, height, width)
+      labels[pixels] = shape_of_pixel
+
+      outlined = large & (extent_px >= outline_min_px)
+      if outlined.any():
+         vertex_mask = numpy.repeat(outlined, counts)
+         sub_offsets = numpy.concatenate([[0], numpy.cumsum(counts[outlined])])
+         pixels, shape_of_pixel = _outline_pixels(
+            px[vertex_mask], py[vertex_mask], sub_offsets, numpy.flatnonzero(outlined), height, width)
+         labels[pixels] = shape_of_pixel + n_shapes
+
+   logger.debug(f"Rasterized {n_shapes} shapes into a {width}x{height} preview ({tiny.sum()} as single pixels)")
+   dtype = numpy.int32 if 2 * n_shapes < numpy.iinfo(numpy.int32).max else numpy.int64
+   return PreviewLabels(labels.astype(dtype), height, width, float(xmin), float(ymin), float(scale), n_shapes,
+                        calibration_points)
+
+
+def color_preview(labels: PreviewLabels, wells) -> PreviewRaster:
+   """Colours shape labels by the well of every shape, outlines in a darker shade of the well colour."""
+   well_codes, well_names = pandas.factorize(numpy.asarray(wells, dtype=object), sort=True)
+   palette = _well_palette(len(well_names))
+   colors = numpy.vstack([palette, (palette * 0.55).astype(numpy.uint8), BACKGROUND[None]])
+   # label -> colour index; the last entry is picked by the background label -1
+   lookup = numpy.concatenate([well_codes, well_codes + len(well_names), [len(colors) - 1]])
+   image = colors[lookup[labels.labels]].reshape(labels.height, labels.width, 3)
+
+   if labels.calibration_points is not None:
+      for x, y in labels.calibration_points:
+         col, row = int((x - labels.xmin) * labels.scale), int((y - labels.ymin) * labels.scale)
+         image[max(row - 4, 0):row + 5, col] = CALIBRATION_COLOR
+         image[row, max(col - 4, 0):col + 5] = CALIBRATION_COLOR
+   return PreviewRaster(image, labels.xmin, labels.ymin, labels.scale)
+
+
+def render_preview(coords: numpy.ndarray, offsets: numpy.ndarray, wells, calibration_points=None,
+                   size: int = 1024, outline_min_px: float = 6.0) -> PreviewRaster:
+   """Rasterizes all contours into an image of at most `size` pixels per side, coloured by well.
+
+   Level of detail: shapes smaller than a pixel are drawn as a single pixel, larger shapes are
+   filled, and shapes of at least `outline_min_px` pixels also get a darker outline. Work is
+   bounded by the image size for the fill and by the vertex count for cheap array operations,
+   so render time stays roughly flat as the number of shapes grows.
+
+   Args:
+      coords: (N, 2) vertex array as returned by `shapes.flat_coordinates`.
+      offsets: Offsets of each shape into `coords`.
+      wells: Well of each shape, used for colouring.
+      calibration_points: Optional (3, 2) array drawn as black crosses.
+      size: Longest side of the output image in pixels.
+      outline_min_px: Minimum shape extent in pixels to draw an outline.
+   """
+   return color_preview(label_preview(coords, offsets, calibration_points, size, outline_min_px), wells)
+
+
+def render_collection_preview(collection: "Collection", size: int = 1024) -> PreviewRaster:
+   """Rasterizes the shapes of a py-lmd Collection (in QuPath coordinates) coloured by well."""
+   points = [shape.points for shape in collection.shapes]
+   counts = [len(p) for p in points]
+   coords = numpy.concatenate(points) if points else numpy.empty((0, 2))
+   offsets = numpy.concatenate([[0], numpy.cumsum(counts)]).astype(numpy.int64)
+   wells = [shape.well for shape in collection.shapes]
+   return render_preview(coords, offsets, wells, calibration_points=collection.calibration_points, size=size)
+
+
+def preview_tiles(image: numpy.ndarray, tile_size: int = 256) -> list[dict]:
+   """Cuts an image pyramid into tiles for zooming.
+
+   Level 0 is the full resolution image, every following level halves the resolution
+   (2x2 block mean) until the image fits into a single tile.
+
+   Returns:
+      One dict per level mapping (tile_row, tile_col) to an RGB tile array.
+   """
+   levels = []
+   while True:
+      tiles = {}
+      for r in range(0, image.shape[0], tile_size):
+         for c in range(0, image.shape[1], tile_size):
+            tiles[(r // tile_size, c // tile_size)] = image[r:r + tile_size, c:c + tile_size]
+      levels.append(tiles)
+      if max(image.shape[:2]) <= tile_size:
+         return levels
+      padded = numpy.pad(image, ((0, image.shape[0] % 2), (0, image.shape[1] % 2), (0, 0)), mode="edge").astype(numpy.uint16)
+      image = ((padded[0::2, 0::2] + padded[1::2, 0::2] + padded[0::2, 1::2] + padded[1::2, 1::2]) // 4).astype(numpy.uint8)
+
+
+def to_png(image: numpy.ndarray) -> bytes:
+   """Encodes an RGB array as PNG."""
+   from matplotlib.image import imsave
+
+   buffer = io.BytesIO()
+   imsave(buffer, image, format="png")
+   return buffer.getvalue()
@@ -0,0 +1,328 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pandas
+import shapely
+from loguru import logger
+
+TRIANGLE_STATUS = ["inside", "intersecting", "outside"]
+# shapes per batch of vertices in the bulk distance to the triangle, bounds the temporary arrays
+DISTANCE_CHUNK_SIZE = 1 << 15
+
+
+def _as_geometry_array(geometries) -> numpy.ndarray:
+   """Returns a plain numpy object array of shapely geometries from a GeoSeries, list or array."""
+   if hasattr(geometries, "array"):
+      geometries = geometries.array
+   return numpy.asarray(geometries, dtype=object)
+
+
+def _pandas_index(geometries) -> pandas.Index | None:
+   """The index of a GeoSeries, None for lists and arrays (whose `index` is a method)."""
+   index = getattr(geometries, "index", None)
+   return index if isinstance(index, pandas.Index) else None
+
+
+def _box_range(bounds: numpy.ndarray, a: float, b: float, c: float) -> tuple[numpy.ndarray, numpy.ndarray]:
+   """Min and max of the linear function a*x + b*y + c over every bounding box, they sit at its corners."""
+   xmin, ymin, xmax, ymax = bounds.T
+   low = (xmin if a >= 0 else xmax) * a + (ymin if b >= 0 else ymax) * b + c
+   high = (xmax if a >= 0 else xmin) * a + (ymax if b >= 0 else ymin) * b + c
+   return low, high
+
+
+def _orientation(triangle: numpy.ndarray) -> float:
+   """1 for a counter-clockwise triangle, -1 for a clockwise one and 0 if its points are collinear."""
+   (ux, uy), (vx, vy) = triangle[1] - triangle[0], triangle[2] - triangle[0]
+   return numpy.sign(ux * vy - uy * vx)
+
+
+def _bbox_triangle_status(bounds: numpy.ndarray, triangle: numpy.ndarray) -> numpy.ndarray:
+   """Classifies bounding boxes against a triangle with half-plane tests.
+
+   Returns 0 where the box lies inside the triangle, 2 where box and triangle are separated
+   (separating axis theorem on the triangle edge normals and the x/y axes) and -1 where only
+   an exact test can decide. The extremes of a linear function over a box sit at its corners,
+   so each edge only needs the min and max of the signed side over the box.
+   Collinear or repeated calibration points span no triangle, every box is then outside.
+   """
+   xmin, ymin, xmax, ymax = bounds.T
+   orientation = _orientation(triangle)
+   if orientation == 0:
+      return numpy.full(len(bounds), 2, dtype=numpy.int8)
+   all_inside = numpy.ones(len(bounds), dtype=bool)
+   separated = ((xmax < triangle[:, 0].min()) | (xmin > triangle[:, 0].max()) |
+                (ymax < triangle[:, 1].min()) | (ymin > triangle[:, 1].max()))
+   for start, end in ((0, 1), (1, 2), (2, 0)):
+      # side(x, y) = a*x + b*y + c is positive on the inner side of the edge
+      ex, ey = triangle[end] - triangle[start]
+      a, b = -orientation * ey, orientation * ex
+      low, high = _box_range(bounds, a, b, -(a * triangle[start, 0] + b * triangle[start, 1]))
+      all_inside &= low >= 0
+      separated |= high < 0
+   return numpy.where(all_inside, 0, numpy.where(separated, 2, -1)).astype(numpy.int8)
+
+
+def _min_over_vertices(geoms: numpy.ndarray, vertex_values, chunk_size: int = DISTANCE_CHUNK_SIZE) -> numpy.ndarray:
+   """Per shape minimum of `vertex_values`, a function of an (n, 2) coordinate array, in batches of shapes."""
+   minimum = numpy.empty(len(geoms))
+   for first in range(0, len(geoms), chunk_size):
+      coords, owner = shapely.get_coordinates(geoms[first:first + chunk_size], return_index=True)
+      # owners are sorted and every shape has vertices, so a shape starts where the owner changes
+      shape_starts = numpy.flatnonzero(numpy.diff(owner, prepend=-1))
+      minimum[first:first + chunk_size] = numpy.minimum.reduceat(vertex_values(coords), shape_starts)
+   return minimum
+
+
+def _box_distance_squared(bounds: numpy.ndarray, point: numpy.ndarray) -> numpy.ndarray:
+   """Squared distance of a point to every bounding box, 0 inside the box."""
+   dx = numpy.maximum(numpy.maximum(bounds[:, 0] - point[0], point[0] - bounds[:, 2]), 0)
+   dy = numpy.maximum(numpy.maximum(bounds[:, 1] - point[1], point[1] - bounds[:, 3]), 0)
+   return dx * dx + dy * dy
+
+
+def _distance_to_triangle(geoms: numpy.ndarray, bounds: numpy.ndarray, triangle: numpy.ndarray) -> numpy.ndarray:
+   """Distances of shapes disjoint from a (non-degenerate) triangle, computed in bulk from their vertices.
+
+   Between disjoint shapes the distance is reached at a vertex of one of them. A shape whose
+   bounding box lies beside a single edge, outside it and within its length, is closest to that
+   edge, its distance is the smallest distance of its vertices to the edge line. For the other
+   shapes every vertex is measured against all three edges, and only those whose bounding box
+   comes closer to a triangle corner than that are measured by shapely.
+   """
+   orientation = _orientation(triangle)
+   region = numpy.full(len(geoms), -1, dtype=numpy.int8)
+   lines = []
+   for edge, (start, end) in enumerate(((0, 1), (1, 2), (2, 0))):
+      (sx, sy), (ex, ey) = triangle[start], triangle[end] - triangle[start]
+      length_sq = ex * ex + ey * ey
+      # distance to the edge line, positive outside of the triangle
+      a, b = orientation * ey / numpy.sqrt(length_sq), -orientation * ex / numpy.sqrt(length_sq)
+      lines.append((a, b, -(a * sx + b * sy)))
+      # position along the edge, 0 at its start and 1 at its end
+      outside_low, _ = _box_range(bounds, *lines[-1])
+      along_low, along_high = _box_range(bounds, ex / length_sq, ey / length_sq, -(ex * sx + ey * sy) / length_sq)
+      region[(outside_low > 0) & (along_low >= 0) & (along_high <= 1)] = edge
+
+   distance = numpy.empty(len(geoms))
+   for edge, (a, b, c) in enumerate(lines):
+      beside = region == edge
+      distance[beside] = _min_over_vertices(geoms[beside], lambda coords, a=a, b=b: coords @ [a, b]) + c
+
+   def squared_distance_to_edges(coords: numpy.ndarray) -> numpy.ndarray:
+      x, y = coords.T
+      nearest = numpy.full(len(coords), numpy.inf)
+      for (sx, sy), (ex, ey) in zip(triangle, numpy.roll(triangle, -1, axis=0) - triangle, strict=True):
+         # closest point on the edge: start + t * edge, t clipped to the edge
+         t = numpy.clip(((x - sx) * ex + (y - sy) * ey) / (ex * ex + ey * ey), 0, 1)
+         dx, dy = x - sx - t * ex, y - sy - t * ey
+         numpy.minimum(nearest, dx * dx + dy * dy, out=nearest)
+      return nearest
+
+   rest = numpy.flatnonzero(region == -1)
+   rest_sq = _min_over_vertices(geoms[rest], squared_distance_to_edges)
+   corner_closer = numpy.zeros(len(rest), dtype=bool)
+   for corner in triangle:
+      corner_closer |= _box_distance_squared(bounds[rest], corner) < rest_sq
+   distance[rest] = numpy.sqrt(rest_sq)
+   distance[rest[corner_closer]] = shapely.distance(shapely.Polygon(triangle), geoms[rest[corner_closer]])
+   return distance
+
+
+def triangle_qc(geometries, calib_array: numpy.ndarray) -> pandas.DataFrame:
+   """Classifies every shape against the triangle spanned by the calibration points.
+
+   Bounding boxes settle most shapes with vectorized half-plane tests, exact shapely
+   predicates are only evaluated for shapes whose box straddles a triangle edge.
+   Distances are computed in bulk from the vertices of the shapes outside the triangle.
+   On one core, classifying 1M single cells takes about 0.12 s (half of it `shapely.bounds`),
+   and the distances add about 1 s per million shapes outside.
+
+   Args:
+      geometries: GeoSeries or array of shapely geometries.
+      calib_array: Array of shape (3, 2) with the selected calibration points.
+
+   Returns:
+      DataFrame aligned with `geometries` with a categorical `triangle_status`
+      (inside, intersecting or outside) and `distance_outside`, the distance to the triangle
+      for shapes outside of it and 0 otherwise.
+   """
+   index = _pandas_index(geometries)
+   geoms = _as_geometry_array(geometries)
+   calib_array = numpy.asarray(calib_array, dtype=float)
+   triangle = shapely.Polygon(calib_array)
+   shapely.prepare(triangle)
+
+   bounds = shapely.bounds(geoms)
+   missing = numpy.isnan(bounds[:, 0])  # missing and empty geometries have NaN bounds
+   status = _bbox_triangle_status(bounds, calib_array)
+   status[missing] = 2
+
+   undecided = numpy.flatnonzero(status == -1)
+   intersects = shapely.intersects(triangle, geoms[undecided])
+   contains = shapely.contains(triangle, geoms[undecided[intersects]])
+   status[undecided] = 2
+   status[undecided[intersects]] = numpy.where(contains, 0, 1)
+
+   distance = numpy.zeros(len(geoms))
+   outside = (status == 2) & ~missing
+   if _orientation(calib_array) != 0:
+      # the outside shapes of a proper triangle were tested, so they are disjoint from it
+      distance[outside] = _distance_to_triangle(geoms[outside], bounds[outside], calib_array)
+   else:
+      distance[outside] = shapely.distance(triangle, geoms[outside])
+   distance[missing] = numpy.nan
+
+   logger.debug(f"Triangle QC: {numpy.bincount(status, minlength=3).tolist()} inside/intersecting/outside, "
+                f"{len(undecided)} needed an exact test")
+   return pandas.DataFrame(
+      {
+         "triangle_status": pandas.Categorical.from_codes(status, categories=TRIANGLE_STATUS),
+         "distance_outside": distance,
+      },
+      index=index,
+   )
+
+
+PAIR_KINDS = ["duplicate", "overlap", "too close"]
+# intersection over union above which two overlapping shapes count as the same contour drawn twice
+DUPLICATE_IOU = 0.9
+PAIR_CHUNK_SIZE = 1 << 16
+
+
+def _pairwise(func, a: numpy.ndarray, b: numpy.ndarray, *args) -> numpy.ndarray:
+   """Evaluates a vectorized shapely function over pairs in chunks on a thread pool.
+
+   Shapely releases the GIL inside its vectorized functions, so the chunks run in parallel.
+   """
+   if len(a) <= PAIR_CHUNK_SIZE:
+      return func(a, b, *args)
+   starts = range(0, len(a), PAIR_CHUNK_SIZE)
+   with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+      chunks = pool.map(lambda start: func(a[start:start + PAIR_CHUNK_SIZE], b[start:start + PAIR_CHUNK_SIZE], *args), starts)
+      return numpy.concatenate(list(chunks))
+
+
+def _duplicate_candidates(a: numpy.ndarray, b: numpy.ndarray, area_a: numpy.ndarray, area_b: numpy.ndarray,
+                          duplicate_iou: float) -> numpy.ndarray:
+   """Pairs whose intersection over union can reach `duplicate_iou`.
+
+   The intersection is at most the smaller area and the overlap of the bounding boxes, the
+   union at least the larger area, so most overlapping pairs are ruled out without an overlay.
+   """
+   bounds_a, bounds_b = shapely.bounds(a), shapely.bounds(b)
+   box_overlap = (numpy.clip(numpy.minimum(bounds_a[:, 2], bounds_b[:, 2]) - numpy.maximum(bounds_a[:, 0], bounds_b[:, 0]), 0, None)
+                  * numpy.clip(numpy.minimum(bounds_a[:, 3], bounds_b[:, 3]) - numpy.maximum(bounds_a[:, 1], bounds_b[:, 1]), 0, None))
+   larger = numpy.maximum(area_a, area_b)
+   with numpy.errstate(divide="ignore", invalid="ignore"):
+      return (larger > 0) & (numpy.minimum(numpy.minimum(area_a, area_b), box_overlap) / larger >= duplicate_iou)
+
+
+def proximity_qc(geometries, wells=None, min_distance: float = 0.0,
+                 duplicate_iou: float = DUPLICATE_IOU) -> pandas.DataFrame:
+   """Finds pairs of shapes that overlap, duplicate each other or are closer than `min_distance`.
+
+   One bulk `STRtree` query with the bounding boxes grown by `min_distance` returns the
+   candidate pairs, the exact predicates then run vectorized over the pairs. Shapes that touch
+   or lie within `min_distance` (e.g. the laser kerf) are "too close". Shapes sharing more
+   than their boundary overlap, a LineString crossing a shape included, as the laser cuts
+   through it. Overlapping Polygons are a "duplicate" once their intersection over union
+   reaches `duplicate_iou`, the overlay is only computed for pairs that can get there.
+
+   Args:
+      geometries: GeoSeries or array of shapely geometries.
+      wells: Optional well (or class) of every shape, to flag pairs between different wells.
+      min_distance: Shapes closer than this are reported, 0 only reports touching shapes.
+      duplicate_iou: Intersection over union from which two Polygons are the same contour.
+
+   Returns:
+      DataFrame with one row per pair: the index labels `first` and `second`, the categorical
+      `kind` and the `distance` (0 for overlaps), and with `wells` given `well_first`,
+      `well_second` and `cross_well`.
+   """
+   index = _pandas_index(geometries)
+   if index is None:
+      index = pandas.RangeIndex(len(geometries))
+   geoms = _as_geometry_array(geometries)
+   valid = numpy.flatnonzero(~(shapely.is_missing(geoms) | shapely.is_empty(geoms)))
+   grown = shapely.bounds(geoms[valid]) + numpy.array([-1, -1, 1, 1]) * min_distance
+   first, second = shapely.STRtree(geoms[valid]).query(shapely.box(*grown.T))
+   keep = first < second
+   first, second = valid[first[keep]], valid[second[keep]]
+
+   intersects = _pairwise(shapely.intersects, geoms[first], geoms[second])
+   distance = numpy.zeros(len(first))
+   distance[~intersects] = _pairwise(shapely.distance, geoms[first[~intersects]], geoms[second[~intersects]])
+   close = intersects | (distance <= min_distance)
+   first, second, intersects, distance = first[close], second[close], intersects[close], distance[close]
+
+   hit = numpy.flatnonzero(intersects)
+   overlapping = numpy.zeros(len(first), dtype=bool)
+   overlapping[hit] = ~_pairwise(shapely.touches, geoms[first[hit]], geoms[second[hit]])
+
+   kind = numpy.where(overlapping, 1, 2).astype(numpy.int8)
+   is_polygon = shapely.get_type_id(geoms) == shapely.GeometryType.POLYGON
+   both = numpy.flatnonzero(overlapping & is_polygon[first] & is_polygon[second])
+   a, b = geoms[first[both]], geoms[second[both]]
+   area_a, area_b = shapely.area(a), shapely.area(b)
+   candidates = _duplicate_candidates(a, b, area_a, area_b, duplicate_iou)
+   overlap = shapely.area(shapely.intersection(a[candidates], b[candidates]))
+   with numpy.errstate(divide="ignore", invalid="ignore"):
+      iou = overlap / (area_a[candidates] + area_b[candidates] - overlap)
+   kind[both[candidates][iou >= duplicate_iou]] = 0
+
+   pairs = pandas.DataFrame({
+      "first": index[first],
+      "second": index[second],
+      "kind": pandas.Categorical.from_codes(kind, categories=PAIR_KINDS),
+      "distance": distance,
+   })
+   if wells is not None:
+      wells = numpy.asarray(wells, dtype=object)
+      pairs["well_first"], pairs["well_second"] = wells[first], wells[second]
+      pairs["cross_well"] = pairs["well_first"].to_numpy() != pairs["well_second"].to_numpy()
+   logger.debug(f"Proximity QC: {len(pairs)} pairs, {numpy.bincount(kind, minlength=3).tolist()} "
+                f"duplicate/overlap/too close, {int(candidates.sum())} needed an overlay")
+   return pairs
+
+
+def well_contamination_summary(pairs: pandas.DataFrame, wells) -> pandas.DataFrame:
+   """Per well, how many of its shapes are in a flagged pair and how many pairs reach into other wells.
+
+   Args:
+      pairs: Output of `proximity_qc` with wells.
+      wells: The well of every shape, as passed to `proximity_qc`.
+
+   Returns:
+      DataFrame indexed by well with `shapes`, `flagged_shapes`, the number of pairs of every
+      kind with shapes of other wells, and `contaminating_wells`, the other wells involved.
+   """
+   codes, names = pandas.factorize(numpy.asarray(wells, dtype=object))
+   names = pandas.Index(names, dtype=object)
+   n_wells = len(names)
+   code_first = names.get_indexer(pairs["well_first"].to_numpy())
+   code_second = names.get_indexer(pairs["well_second"].to_numpy())
+
+   summary = pandas.DataFrame({"shapes": numpy.bincount(codes[codes >= 0], minlength=n_wells)},
+                              index=names.rename("well"))
+
+   # a shape belongs to one well, so count every shape once over both sides of the pairs
+   shape_codes = numpy.concatenate([code_first, code_second])
+   first_seen = ~pandas.Index(numpy.concatenate([pairs["first"].to_numpy(), pairs["second"].to_numpy()])).duplicated()
+   flagged = shape_codes[first_seen]
+   summary["flagged_shapes"] = numpy.bincount(flagged[flagged >= 0], minlength=n_wells)
+
+   cross = (code_first != code_second) & (code_first >= 0) & (code_second >= 0)
+   kind = pairs["kind"].cat.codes.to_numpy()[cross]
+   own = numpy.concatenate([code_first[cross], code_second[cross]])
+   other = numpy.concatenate([code_second[cross], code_first[cross]])
+   per_kind = numpy.bincount(own * len(PAIR_KINDS) + numpy.tile(kind, 2), minlength=n_wells * len(PAIR_KINDS))
+   for i, pair_kind in enumerate(PAIR_KINDS):
+      summary[f"cross_well_{pair_kind.replace(' ', '_')}"] = per_kind.reshape(n_wells, len(PAIR_KINDS))[:, i]
+
+   contaminating = [[] for _ in range(n_wells)]
+   for key in numpy.unique(own.astype(numpy.int64) * n_wells + other).tolist():
+      contaminating[key // n_wells].append(str(names[key % n_wells]))
+   summary["contaminating_wells"] = [", ".join(sorted(other_wells)) for other_wells in contaminating]
+   return summary
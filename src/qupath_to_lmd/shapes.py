@@ -0,0 +1,61 @@
+from typing import TYPE_CHECKING
+
+import numpy
+import shapely
+from loguru import logger
+
+if TYPE_CHECKING:
+   from lmd.lib import Collection
+
+SUPPORTED_TYPES = {shapely.GeometryType.POLYGON: "Polygon", shapely.GeometryType.LINESTRING: "LineString"}
+
+
+def flat_coordinates(geometries) -> tuple[numpy.ndarray, numpy.ndarray]:
+   """Extracts the outline vertices of all shapes in one call.
+
+   Polygons contribute their exterior ring, LineStrings their own vertices.
+
+   Args:
+      geometries: GeoSeries or array of Polygon/LineString geometries.
+
+   Returns:
+      A float array of shape (N, 2) with every vertex, and an int64 offsets array of length
+      n_shapes + 1 so that shape i owns `coords[offsets[i]:offsets[i + 1]]`.
+
+   Raises:
+      ValueError: If any geometry is not a Polygon or LineString.
+   """
+   if hasattr(geometries, "array"):
+      geometries = geometries.array
+   geoms = numpy.asarray(geometries, dtype=object)
+
+   type_ids = shapely.get_type_id(geoms)
+   unsupported = ~numpy.isin(type_ids, list(SUPPORTED_TYPES))
+   if unsupported.any():
+      bad_types = sorted({str(geom.geom_type) if geom is not None else "None" for geom in geoms[unsupported]})
+      raise ValueError(f"Geometry type {', '.join(bad_types)} not supported, please convert to Polygon or LineString in Qupath")
+
+   outlines = geoms.copy()
+   is_polygon = type_ids == shapely.GeometryType.POLYGON
+   outlines[is_polygon] = shapely.get_exterior_ring(geoms[is_polygon])
+
+   coords, shape_index = shapely.get_coordinates(outlines, return_index=True)
+   offsets = numpy.zeros(len(geoms) + 1, dtype=numpy.int64)
+   numpy.cumsum(numpy.bincount(shape_index, minlength=len(geoms)), out=offsets[1:])
+   logger.debug(f"Extracted {len(coords)} vertices from {len(geoms)} shapes")
+   return coords, offsets
+
+
+def emit_shapes(collection: "Collection", coords: numpy.ndarray, offsets: numpy.ndarray, wells) -> "Collection":
+   """Appends one py-lmd Shape per offsets slice to the collection.
+
+   Shapes inherit the collection's current orientation transform, as with `Collection.new_shape`.
+   """
+   from lmd.lib import Shape
+
+   transform = collection.orientation_transform
+   collection.shapes.extend(
+      Shape(coords[start:end], well=well, orientation_transform=transform)
+      for start, end, well in zip(offsets[:-1].tolist(), offsets[1:].tolist(), wells, strict=True)
+   )
+   return collection
@@ -0,0 +1,109 @@
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from random import sample
+
+import geopandas
+import numpy
+import pandas
+from loguru import logger
+
+import qupath_to_lmd.instrument as instrument
+import qupath_to_lmd.intermediates as intermediates
+import qupath_to_lmd.jobs as jobs
+import qupath_to_lmd.pipeline as pipeline
+import qupath_to_lmd.plates as plates
+
+MANIFEST_COLUMNS = ["class", "plate", "well"]
+
+
+def assign_plates(classes: list, acceptable_wells: list, randomize: bool = False) -> pandas.DataFrame:
+   """Places every class into a well, filling as many plates as needed.
+
+   Plates are filled one after the other with the acceptable wells (margins and row/column
+   steps already applied), in the order of `classes`. With `randomize` the well order is
+   shuffled on every plate.
+
+   Returns:
+      The manifest, one row per class with its plate (starting at 1) and well.
+
+   Raises:
+      ValueError: If there are classes but no acceptable wells.
+   """
+   classes = list(dict.fromkeys(classes))
+   if classes and not acceptable_wells:
+      raise ValueError("No acceptable wells to place the classes into")
+   wells_per_plate = len(acceptable_wells)
+   n_plates = -(-len(classes) // wells_per_plate) if classes else 0
+   wells = []
+   for _ in range(n_plates):
+      wells.extend(sample(acceptable_wells, wells_per_plate) if randomize else acceptable_wells)
+   manifest = pandas.DataFrame({
+      "class": classes,
+      "plate": numpy.arange(len(classes)) // max(wells_per_plate, 1) + 1,
+      "well": wells[:len(classes)],
+   })
+   if n_plates > 1:
+      logger.info(f"{len(classes)} classes need {n_plates} plates of {wells_per_plate} wells")
+   return manifest
+
+
+def manifest_from_saw(saw: dict) -> pandas.DataFrame:
+   """Manifest of a single plate samples and wells dictionary."""
+   return pandas.DataFrame([(name, 1, well) for name, well in saw.items()], columns=MANIFEST_COLUMNS)
+
+
+def manifest_from_dataframe(df: pandas.DataFrame) -> pandas.DataFrame:
+   """Manifest of a plate layout dataframe, indexed by row or by (plate, row) for several plates."""
+   names, plate_numbers, wells = plates.frame_cells(df)
+   return pandas.DataFrame({"class": names, "plate": plate_numbers, "well": wells}, columns=MANIFEST_COLUMNS)
+
+
+def plate_saws(manifest: pandas.DataFrame) -> dict[int, dict]:
+   """Splits a manifest into one samples and wells dictionary per plate."""
+   return {int(plate): dict(zip(rows["class"], rows["well"], strict=True))
+           for plate, rows in manifest.groupby("plate", sort=True)}
+
+
+@instrument.timed()
+def export_plates(gdf: geopandas.GeoDataFrame, calib_array: numpy.ndarray, manifest: pandas.DataFrame,
+                  plate_type: str = "384", workers: int | None = None, geometry_version: str | None = None,
+                  **export_options) -> tuple[dict[int, pipeline.CollectionArtifacts], pandas.DataFrame]:
+   """Builds one collection per plate, every shard independently on a thread pool.
+
+   Each shard only gets the shapes of its own classes. `export_options` are passed on to
+   `pipeline.export_collection`, except `xml_sink`, as every plate has its own XML. With a
+   `geometry_version` of `gdf`, every shard caches its intermediates under a version of its own.
+
+   Returns:
+      The artifacts per plate and the manifest with the number of shapes of every class.
+   """
+   saws = plate_saws(manifest)
+   class_names = gdf["classification_name"]
+
+   def export(plate: int) -> pipeline.CollectionArtifacts:
+      saw = saws[plate]
+      selected = class_names.isin(list(saw)).to_numpy()
+      shard = gdf[selected]
+      # the shard's geometries are those of `gdf` under the mask, the mask versions them
+      shard_version = None if geometry_version is None else f"{geometry_version}:{intermediates.digest(selected)}"
+      logger.debug(f"Plate {plate}: {len(saw)} classes, {len(shard)} shapes")
+      # plates run side by side, so a job reports finished plates rather than the stages of each
+      with instrument.span(f"plate_{plate}", shapes=len(shard), wells=len(saw)), jobs.silenced():
+         artifacts = pipeline.export_collection(shard, calib_array, saw, plate_type=plate_type,
+                                                geometry_version=shard_version, **export_options)
+      jobs.advance("Exporting plates", total=len(saws), unit="plates")
+      return artifacts
+
+   workers = workers or min(len(saws), os.cpu_count() or 1) or 1
+   jobs.progress("Exporting plates", 0, len(saws), unit="plates")
+   with ThreadPoolExecutor(max_workers=workers) as pool:
+      # every shard runs in a copy of this context, so its spans land in the caller's report
+      futures = [pool.submit(contextvars.copy_context().run, export, plate) for plate in saws]
+      artifacts = dict(zip(saws, (future.result() for future in futures), strict=True))
+   instrument.count(plates=len(artifacts), shapes=len(gdf))
+
+   counts = class_names.value_counts()
+   manifest = manifest.assign(shapes=manifest["class"].map(counts).fillna(0).astype(int))
+   logger.info(f"Exported {len(artifacts)} plates")
+   return artifacts, manifest
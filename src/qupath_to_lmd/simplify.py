@@ -0,0 +1,161 @@
+from typing import NamedTuple
+
+import numpy
+import shapely
+from loguru import logger
+
+FIXED_TOLERANCE = 1
+# tolerances tried per shape, in pixels, 0 keeps the shape as drawn
+TOLERANCE_LADDER = (0.0, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0)
+
+
+class SimplifySettings(NamedTuple):
+   """Vertex budgets for adaptive simplification.
+
+   `vertex_budget` caps the vertices of every shape, `collection_budget` the vertices of all
+   shapes together. Shapes never change their area (length for LineStrings) by more than the
+   fraction `max_area_deviation`, even if that leaves them over budget.
+   """
+
+   vertex_budget: int | None = None
+   collection_budget: int | None = None
+   max_area_deviation: float = 0.02
+
+
+def _outline_vertex_counts(geoms: numpy.ndarray) -> numpy.ndarray:
+   """Vertices that end up in the XML: the exterior ring of Polygons, all points of LineStrings."""
+   is_polygon = shapely.get_type_id(geoms) == shapely.GeometryType.POLYGON
+   outlines = geoms.copy()
+   outlines[is_polygon] = shapely.get_exterior_ring(geoms[is_polygon])
+   return shapely.get_num_coordinates(outlines)
+
+
+def _measure(geoms: numpy.ndarray) -> numpy.ndarray:
+   """Area of Polygons and length of LineStrings, the quantity whose deviation is bounded."""
+   is_polygon = shapely.get_type_id(geoms) == shapely.GeometryType.POLYGON
+   return numpy.where(is_polygon, shapely.area(geoms), shapely.length(geoms))
+
+
+def _relative_deviation(original: numpy.ndarray, simplified: numpy.ndarray, original_measure=None) -> numpy.ndarray:
+   """Relative change of area (length for LineStrings), 0 for shapes without area or length."""
+   if original_measure is None:
+      original_measure = _measure(original)
+   with numpy.errstate(divide="ignore", invalid="ignore"):
+      relative = numpy.abs(_measure(simplified) - original_measure) / original_measure
+   return numpy.nan_to_num(relative, nan=0.0, posinf=numpy.inf)
+
+
+def fixed_simplify(geometries, tolerance: float = FIXED_TOLERANCE) -> tuple[numpy.ndarray, dict]:
+   """Simplifies every shape with the same tolerance and reports vertex counts and area deviation."""
+   geoms = numpy.asarray(geometries.array if hasattr(geometries, "array") else geometries, dtype=object)
+   simplified = shapely.simplify(geoms, tolerance)
+   deviation = _relative_deviation(geoms, simplified)
+   report = {
+      "Simplification": f"fixed tolerance {tolerance}",
+      "Vertices before simplification": int(_outline_vertex_counts(geoms).sum()),
+      "Vertices after simplification": int(_outline_vertex_counts(simplified).sum()),
+      "Max area deviation (%)": round(100 * float(deviation.max(initial=0)), 3),
+      "Mean area deviation (%)": round(100 * float(deviation.mean()) if len(geoms) else 0.0, 3),
+   }
+   return simplified, report
+
+
+def _levels_for_cap(counts: numpy.ndarray, allowed: numpy.ndarray, cap: numpy.ndarray) -> numpy.ndarray:
+   """Per shape, the first ladder level within `cap` vertices, else the allowed level with the fewest vertices."""
+   fits = allowed & (counts <= cap)
+   fallback = numpy.where(allowed, counts, numpy.iinfo(numpy.int64).max).argmin(axis=0)
+   return numpy.where(fits.any(axis=0), fits.argmax(axis=0), fallback)
+
+
+def _fast_simplify(geoms: numpy.ndarray, tolerance) -> numpy.ndarray:
+   """Douglas-Peucker simplification, redone with topology preservation where it breaks a shape.
+
+   Plain Douglas-Peucker is an order of magnitude faster on large outlines, but can leave
+   self-intersecting or collapsed polygons behind.
+   """
+   simplified = shapely.simplify(geoms, tolerance, preserve_topology=False)
+   broken = ~shapely.is_valid(simplified) | shapely.is_empty(simplified)
+   if broken.any():
+      tolerance = tolerance[broken] if numpy.ndim(tolerance) else tolerance
+      simplified[broken] = shapely.simplify(geoms[broken], tolerance, preserve_topology=True)
+   return simplified
+
+
+def adaptive_simplify(geometries, settings: SimplifySettings,
+                      tolerances: tuple = TOLERANCE_LADDER) -> tuple[numpy.ndarray, dict]:
+   """Picks a simplification tolerance per shape so that the vertex budgets are met.
+
+   Every rung of the tolerance ladder is one vectorized simplification over the shapes that can
+   still lose vertices. Each shape then takes the smallest tolerance that fits its budget within
+   the allowed area deviation. A collection budget is turned into the largest uniform per-shape
+   cap that fits, so large regions give up vertices before small cells do.
+
+   Returns:
+      The simplified geometries and a report with vertices before and after, the tolerances used
+      and the geometric error: the relative area deviation, and the largest tolerance used, which
+      bounds the distance between original and simplified outline.
+
+   Raises:
+      ValueError: If neither a vertex budget nor a collection budget is given.
+   """
+   if settings.vertex_budget is None and settings.collection_budget is None:
+      raise ValueError("Adaptive simplification needs a vertex budget or a collection budget")
+   geoms = numpy.asarray(geometries.array if hasattr(geometries, "array") else geometries, dtype=object)
+   tolerances = numpy.asarray(tolerances, dtype=float)
+   n_levels, n_shapes = len(tolerances), len(geoms)
+   shapes = numpy.arange(n_shapes)
+
+   original_measure = _measure(geoms)
+   counts = numpy.empty((n_levels, n_shapes), dtype=numpy.int64)
+   deviation = numpy.zeros((n_levels, n_shapes))
+   counts[0] = _outline_vertex_counts(geoms)
+   # a closed triangle (4) or a segment (2) cannot lose more vertices
+   minimal = numpy.where(shapely.get_type_id(geoms) == shapely.GeometryType.POLYGON, 4, 2)
+   for level in range(1, n_levels):
+      counts[level], deviation[level] = counts[level - 1], deviation[level - 1]
+      active = numpy.flatnonzero(counts[level - 1] > minimal)
+      if len(active) == 0:
+         continue
+      candidates = shapely.simplify(geoms[active], tolerances[level], preserve_topology=False)
+      counts[level, active] = _outline_vertex_counts(candidates)
+      deviation[level, active] = _relative_deviation(geoms[active], candidates, original_measure[active])
+   allowed = deviation <= settings.max_area_deviation
+
+   cap = numpy.full(n_shapes, numpy.iinfo(numpy.int64).max)
+   if settings.vertex_budget is not None:
+      cap[:] = settings.vertex_budget
+   if settings.collection_budget is not None:
+      low, high = 2, max(int(counts[0].max(initial=2)), 2)
+      while low < high:
+         uniform = (low + high + 1) // 2
+         if counts[_levels_for_cap(counts, allowed, numpy.minimum(cap, uniform)), shapes].sum() <= settings.collection_budget:
+            low = uniform
+         else:
+            high = uniform - 1
+      cap = numpy.minimum(cap, low)
+   levels = _levels_for_cap(counts, allowed, cap)
+
+   simplified = geoms.copy()
+   changed = numpy.flatnonzero(levels > 0)
+   simplified[changed] = _fast_simplify(geoms[changed], tolerances[levels[changed]])
+   final_counts = _outline_vertex_counts(simplified)
+   final_deviation = numpy.zeros(n_shapes)
+   final_deviation[changed] = _relative_deviation(geoms[changed], simplified[changed], original_measure[changed])
+
+   tolerance_counts = numpy.bincount(levels, minlength=n_levels)
+   report = {
+      "Simplification": "adaptive",
+      "Vertices before simplification": int(counts[0].sum()),
+      "Vertices after simplification": int(final_counts.sum()),
+      "Max area deviation (%)": round(100 * float(final_deviation.max(initial=0)), 3),
+      "Mean area deviation (%)": round(100 * float(final_deviation.mean()) if n_shapes else 0.0, 3),
+      "Max distance error": float(tolerances[levels].max(initial=0)),
+      "Shapes per tolerance": {float(t): int(c) for t, c in zip(tolerances, tolerance_counts, strict=True) if c},
+   }
+   if settings.vertex_budget is not None:
+      report["Shapes over vertex budget"] = int((final_counts > settings.vertex_budget).sum())
+   if settings.collection_budget is not None:
+      report["Collection budget met"] = bool(final_counts.sum() <= settings.collection_budget)
+   logger.info(f"Adaptive simplification: {report['Vertices before simplification']} -> "
+               f"{report['Vertices after simplification']} vertices")
+   return simplified, report
@@ -0,0 +1,132 @@
+from typing import NamedTuple
+
+import numpy
+import pandas
+from loguru import logger
+
+import qupath_to_lmd.instrument as instrument
+
+# the LMD reads the coordinates of the XML as 32-bit integers
+INT32_RANGE = (-2**31, -2**31, 2**31 - 1, 2**31 - 1)
+# shapes whose calibration error is amplified more than this are flagged, 1 inside the triangle
+MAX_AMPLIFICATION = 3.0
+# calibration triangles with a smaller angle (degrees) are close to a line, they extrapolate badly
+MIN_TRIANGLE_ANGLE = 5.0
+
+
+def to_stage(points: numpy.ndarray, transform: numpy.ndarray, scale: int) -> numpy.ndarray:
+   """Applies the orientation transform and scale like py-lmd and floors to integers, one matrix product for all points."""
+   return numpy.floor(points @ transform * scale).astype(numpy.int64)
+
+
+def smallest_angle(points: numpy.ndarray) -> float:
+   """Smallest angle in degrees of the triangle of three (calibration) points, 0 if two coincide."""
+   points = numpy.asarray(points, dtype=float)
+   angles = []
+   for i in range(3):
+      a, b = points[(i + 1) % 3] - points[i], points[(i + 2) % 3] - points[i]
+      norm = numpy.linalg.norm(a) * numpy.linalg.norm(b)
+      angles.append(0.0 if norm == 0 else numpy.degrees(numpy.arccos(numpy.clip(a @ b / norm, -1, 1))))
+   return float(min(angles))
+
+
+class StageTransform:
+   """Maps QuPath coordinates to the integer stage coordinates written into the LMD XML.
+
+   The XML coordinates are `floor(points @ orientation * scale)`, as py-lmd writes them. The LMD
+   maps them to the stage with the affine transform that takes the three calibration points to
+   where they are found on the stage, so an error in finding them is carried into every vertex,
+   weighted by the vertex's barycentric coordinates in the calibration triangle.
+   """
+
+   def __init__(self, calib_array: numpy.ndarray, orientation: numpy.ndarray, scale: int):
+      self.orientation = numpy.asarray(orientation)
+      self.scale = scale
+      self.calibration = self.to_stage(numpy.asarray(calib_array, dtype=float))
+      edges = (self.calibration[1:] - self.calibration[0]).astype(float)
+      self.degenerate = abs(numpy.linalg.det(edges)) < 1e-9
+      # (v - c1) @ frame gives the barycentric coordinates of v for the second and third calibration point
+      self.frame = None if self.degenerate else numpy.linalg.inv(edges)
+
+   def to_stage(self, coords: numpy.ndarray) -> numpy.ndarray:
+      """Integer stage coordinates of an (n, 2) array of vertices."""
+      return to_stage(coords, self.orientation, self.scale)
+
+   def amplification(self, stage_coords: numpy.ndarray) -> numpy.ndarray:
+      """Factor by which a calibration error grows at every vertex: 1 inside the triangle, more outside, inf if degenerate."""
+      if self.frame is None:
+         return numpy.full(len(stage_coords), numpy.inf)
+      weights = (stage_coords - self.calibration[0]) @ self.frame
+      return numpy.abs(1 - weights.sum(axis=1)) + numpy.abs(weights).sum(axis=1)
+
+class Preflight(NamedTuple):
+   """What the stage coordinates of a collection look like before it reaches the microscope.
+
+   `stats` holds the counts for the collection stats, `wells` the stage bounding box of every
+   well, and `flagged` one row per shape out of the stage range or far outside the calibration triangle.
+   """
+
+   stats: dict
+   wells: pandas.DataFrame
+   flagged: pandas.DataFrame
+
+
+def _per_shape(func, values: numpy.ndarray, offsets: numpy.ndarray) -> numpy.ndarray:
+   """Reduces per-vertex values to one per shape, shapes own `values[offsets[i]:offsets[i + 1]]`."""
+   if len(offsets) < 2:
+      return numpy.empty((0,) + values.shape[1:], dtype=values.dtype)
+   return func.reduceat(values, offsets[:-1], axis=0)
+
+
+@instrument.timed()
+def preflight(coords: numpy.ndarray, offsets: numpy.ndarray, wells: pandas.Series, calib_array: numpy.ndarray,
+              orientation: numpy.ndarray, scale: int, stage_range: tuple | None = None,
+              max_amplification: float = MAX_AMPLIFICATION) -> Preflight:
+   """Transforms all vertices to stage coordinates and checks them before the XML is written.
+
+   Args:
+      coords: Vertices of all shapes, see `shapes.flat_coordinates`.
+      offsets: Shape i owns `coords[offsets[i]:offsets[i + 1]]`, every shape has at least one vertex.
+      wells: Well of every shape, its index labels the shapes in `flagged`.
+      calib_array: (3, 2) calibration points in QuPath coordinates.
+      orientation: Orientation transform of the collection.
+      scale: Scale of the collection.
+      stage_range: (xmin, ymin, xmax, ymax) the stage coordinates must lie in, the 32-bit integer range by default.
+      max_amplification: Shapes whose calibration error is amplified more are flagged.
+   """
+   transform = StageTransform(calib_array, orientation, scale)
+   stage_coords = transform.to_stage(coords)
+   xmin, ymin, xmax, ymax = stage_range or INT32_RANGE
+   outside = ((stage_coords[:, 0] < xmin) | (stage_coords[:, 0] > xmax) |
+              (stage_coords[:, 1] < ymin) | (stage_coords[:, 1] > ymax))
+
+   lows = _per_shape(numpy.minimum, stage_coords, offsets)
+   highs = _per_shape(numpy.maximum, stage_coords, offsets)
+   out_of_range = _per_shape(numpy.logical_or, outside, offsets)
+   amplification = _per_shape(numpy.maximum, transform.amplification(stage_coords), offsets)
+   far = amplification > max_amplification
+
+   shapes = pandas.DataFrame({"well": wells.to_numpy(), "vertices": numpy.diff(offsets),
+                              "xmin": lows[:, 0], "ymin": lows[:, 1], "xmax": highs[:, 0], "ymax": highs[:, 1],
+                              "amplification": amplification, "out_of_range": out_of_range, "far": far},
+                             index=wells.index)
+   well_table = shapes.groupby("well", sort=True).agg(
+      shapes=("vertices", "size"), vertices=("vertices", "sum"), xmin=("xmin", "min"), ymin=("ymin", "min"),
+      xmax=("xmax", "max"), ymax=("ymax", "max"), max_amplification=("amplification", "max"),
+      out_of_range=("out_of_range", "sum"), far_from_calibration=("far", "sum")).round({"max_amplification": 2}).reset_index()
+
+   flagged = shapes[out_of_range | far]
+   reasons = numpy.where(flagged["out_of_range"], "outside the stage range", "far outside the calibration triangle")
+   flagged = pandas.DataFrame({"shape": flagged.index, "well": flagged["well"].to_numpy(), "reason": reasons,
+                               "amplification": flagged["amplification"].round(2).to_numpy()})
+
+   stats = {
+      "Calibration triangle smallest angle (deg)": round(smallest_angle(transform.calibration), 2),
+      "Max calibration error amplification": round(float(amplification.max(initial=0)), 2),
+      "Shapes outside the stage range": int(out_of_range.sum()),
+      "Shapes far outside the calibration triangle": int(far.sum()),
+   }
+   instrument.count(shapes=len(shapes), vertices=len(coords), flagged=len(flagged))
+   if len(flagged) or stats["Calibration triangle smallest angle (deg)"] < MIN_TRIANGLE_ANGLE:
+      logger.warning(f"Preflight: {stats}")
+   return Preflight(stats, well_table, flagged)
@@ -0,0 +1,278 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from pathlib import Path
+
+import geopandas
+import numpy
+import pandas
+import pyarrow
+import pyarrow.ipc
+import shapely
+from loguru import logger
+
+import qupath_to_lmd.intermediates as intermediates
+
+SESSION_BUDGET_MB_ENV = "QUPATH_TO_LMD_SESSION_BUDGET_MB"
+SESSION_IDLE_MINUTES_ENV = "QUPATH_TO_LMD_SESSION_IDLE_MINUTES"
+DEFAULT_BUDGET_MB = 1024
+DEFAULT_IDLE_MINUTES = 10
+# Python object, GEOS geometry and rings of a shapely shape on top of its coordinates, measured on QuPath cells
+GEOMETRY_OVERHEAD_BYTES = 480
+
+_stores = weakref.WeakSet()
+_stores_lock = threading.Lock()
+
+
+def session_budget_bytes() -> int:
+   """Memory budget of one session's shapes in bytes, from QUPATH_TO_LMD_SESSION_BUDGET_MB."""
+   return int(float(os.environ.get(SESSION_BUDGET_MB_ENV, DEFAULT_BUDGET_MB)) * 2**20)
+
+
+def idle_seconds() -> float:
+   """Seconds without use after which `sweep_idle` moves a session's shapes to disk, from QUPATH_TO_LMD_SESSION_IDLE_MINUTES."""
+   return float(os.environ.get(SESSION_IDLE_MINUTES_ENV, DEFAULT_IDLE_MINUTES)) * 60
+
+
+def frame_bytes(gdf: geopandas.GeoDataFrame) -> int:
+   """Estimated memory of a GeoDataFrame: its columns, plus coordinates and shapely overhead of its geometries."""
+   columns = gdf.drop(columns=gdf.geometry.name).memory_usage(deep=True, index=True).sum()
+   coordinates = shapely.get_num_coordinates(gdf.geometry.array).sum() * 16
+   return int(columns + coordinates + len(gdf) * GEOMETRY_OVERHEAD_BYTES)
+
+
+def _release_arrow_memory():
+   # Arrow's allocator keeps freed pages for reuse, hand them back so that evicting actually lowers the RSS
+   pyarrow.default_memory_pool().release_unused()
+
+
+class _Compact:
+   """GeoArrow-style form of a GeoDataFrame: flat coordinates with offsets per geometry type and an Arrow table.
+
+   The attribute table keeps the index and dtypes (e.g. categorical classes) through its pandas metadata.
+   Arrays are either in memory or memory-mapped from a spill directory.
+   """
+
+   def __init__(self, table: pyarrow.Table, parts: list[tuple], length: int, columns: list, geometry: str, crs):
+      self.table = table
+      self.parts = parts  # (geometry type, row positions, coordinates, offsets)
+      self.length = length
+      self.columns = columns
+      self.geometry = geometry
+      self.crs = crs
+      self.schema = table.schema
+      self.directory = None
+
+   @classmethod
+   def from_frame(cls, gdf: geopandas.GeoDataFrame) -> "_Compact":
+      geoms = gdf.geometry.to_numpy()
+      type_ids = shapely.get_type_id(geoms)
+      parts = []
+      for type_id in numpy.unique(type_ids[type_ids >= 0]).tolist():
+         positions = numpy.flatnonzero(type_ids == type_id)
+         geometry_type, coords, offsets = shapely.to_ragged_array(geoms[positions])
+         parts.append((geometry_type, positions, coords, offsets))
+      table = pyarrow.Table.from_pandas(pandas.DataFrame(gdf.drop(columns=gdf.geometry.name)), preserve_index=True)
+      compact = cls(_dictionary_encode(table), parts, len(gdf), list(gdf.columns), gdf.geometry.name, gdf.crs)
+      compact.schema = table.schema
+      return compact
+
+   def to_frame(self) -> geopandas.GeoDataFrame:
+      df = self.table.cast(self.schema).to_pandas()
+      geoms = numpy.full(self.length, None, dtype=object)
+      for geometry_type, positions, coords, offsets in self.parts:
+         geoms[positions] = shapely.from_ragged_array(geometry_type, numpy.asarray(coords),
+                                                      tuple(numpy.asarray(o) for o in offsets))
+      gdf = geopandas.GeoDataFrame(df, geometry=geopandas.GeoSeries(geoms, index=df.index, crs=self.crs,
+                                                                    name=self.geometry))
+      return gdf[self.columns]
+
+   def nbytes(self) -> int:
+      arrays = sum(positions.nbytes + coords.nbytes + sum(o.nbytes for o in offsets)
+                   for _, positions, coords, offsets in self.parts)
+      return int(self.table.nbytes + arrays)
+
+   def spill(self, directory: Path):
+      """Writes the arrays to `directory` and memory-maps them, so they leave the process memory."""
+      directory.mkdir(parents=True, exist_ok=True)
+      with pyarrow.OSFile(str(directory / "attributes.arrow"), "wb") as sink, \
+            pyarrow.ipc.new_file(sink, self.table.schema) as writer:
+         writer.write_table(self.table)
+      self.table = pyarrow.ipc.open_file(pyarrow.memory_map(str(directory / "attributes.arrow"))).read_all()
+      parts = []
+      for k, (geometry_type, positions, coords, offsets) in enumerate(self.parts):
+         arrays = [positions, coords, *offsets]
+         for j, array in enumerate(arrays):
+            numpy.save(directory / f"part{k}_{j}.npy", array)
+         mapped = [numpy.load(directory / f"part{k}_{j}.npy", mmap_mode="r") for j in range(len(arrays))]
+         parts.append((geometry_type, mapped[0], mapped[1], tuple(mapped[2:])))
+      self.parts = parts
+      self.directory = directory
+
+   def disk_bytes(self) -> int:
+      if self.directory is None:
+         return 0
+      return sum(path.stat().st_size for path in self.directory.iterdir())
+
+
+def _dictionary_encode(table: pyarrow.Table) -> pyarrow.Table:
+   """Dictionary-encodes string columns with few distinct values, e.g. the classification JSON of every shape."""
+   for i, field in enumerate(table.schema):
+      if pyarrow.types.is_string(field.type) or pyarrow.types.is_large_string(field.type):
+         encoded = table.column(i).dictionary_encode()
+         if len(encoded.chunk(0).dictionary if encoded.num_chunks else []) * 4 <= len(table):
+            table = table.set_column(i, field.name, encoded)
+   return table
+
+
+class GeometryStore:
+   """The shapes of one session, kept within a memory budget.
+
+   A store holds either the GeoDataFrame ("frame") or its compact form ("compact"), never both,
+   and moves to memory-mapped files ("disk") when even the compact form exceeds the budget or the
+   session is idle. `frame()` rebuilds the GeoDataFrame on demand and keeps it only while it fits
+   the budget. The class names are always kept in memory, as categorical, for the widgets.
+
+   `geometry_version` changes whenever the geometries change, and keys what the intermediates
+   cache keeps of them.
+   """
+
+   def __init__(self, gdf: geopandas.GeoDataFrame, budget: int | None = None):
+      self.budget = session_budget_bytes() if budget is None else budget
+      self._lock = threading.RLock()
+      self._frame = None
+      self._frame_bytes = 0
+      self._compact = None
+      self._transient = None  # weak reference to a rebuilt frame over budget, shared while anyone still uses it
+      self._spill_root = None
+      self._finalizer = None
+      self.geometry_version = None
+      self.replace(gdf)
+      with _stores_lock:
+         _stores.add(self)
+
+   def __len__(self) -> int:
+      return len(self.classes)
+
+   @property
+   def state(self) -> str:
+      """Where the shapes are: "frame", "compact", "disk" or "closed"."""
+      if self._frame is not None:
+         return "frame"
+      if self._compact is None:
+         return "closed"
+      return "compact" if self._compact.directory is None else "disk"
+
+   def replace(self, gdf: geopandas.GeoDataFrame, keep_geometry: bool = False):
+      """Stores `gdf` in place of the current shapes.
+
+      With `keep_geometry` the geometries must be those of the current shapes, in the same order
+      (e.g. after classes were renamed), and their cached intermediates stay valid.
+      """
+      with self._lock:
+         if not keep_geometry or self.geometry_version is None:
+            self._discard_intermediates()
+            self.geometry_version = uuid.uuid4().hex
+         self._drop_compact()
+         self._transient = None
+         self.classes = gdf["classification_name"].astype("category")
+         self.last_used = time.monotonic()
+         self._frame, self._frame_bytes = gdf, frame_bytes(gdf)
+         if self._frame_bytes > self.budget:
+            self._to_compact()
+         logger.debug(f"Stored {len(gdf)} shapes as {self.state}, {self.memory()['memory_mb']} MB")
+
+   def class_names(self) -> list:
+      """Unique class names in order of appearance."""
+      self.last_used = time.monotonic()
+      return self.classes.unique().tolist()
+
+   def frame(self) -> geopandas.GeoDataFrame:
+      """The shapes as GeoDataFrame. Do not modify it in place, use `replace` with a modified copy."""
+      with self._lock:
+         self.last_used = time.monotonic()
+         if self._frame is not None:
+            return self._frame
+         if self._transient is not None and (gdf := self._transient()) is not None:
+            return gdf
+         start = time.perf_counter()
+         gdf = self._compact.to_frame()
+         size = frame_bytes(gdf)
+         _release_arrow_memory()
+         logger.debug(f"Rebuilt {len(gdf)} shapes from {self.state} in {time.perf_counter() - start:.2f} s")
+         if size <= self.budget:
+            self._drop_compact()
+            self._frame, self._frame_bytes = gdf, size
+         else:
+            self._transient = weakref.ref(gdf)
+         return gdf
+
+   def evict(self, to_disk: bool = False):
+      """Drops the GeoDataFrame for the compact form, and with `to_disk` moves that to memory-mapped files."""
+      with self._lock:
+         if self._frame is not None:
+            self._to_compact()
+         if to_disk and self.state == "compact":
+            self._spill()
+
+   def memory(self) -> dict:
+      """Memory and disk use of the store in MB, its state and budget."""
+      with self._lock:
+         memory = {"frame": self._frame_bytes, "compact": self._compact.nbytes() if self._compact else 0}.get(self.state, 0)
+         # the frame includes the classes, the other forms keep them next to it
+         memory += self.classes.memory_usage(deep=True) if self.state != "frame" else 0
+         disk = self._compact.disk_bytes() if self._compact is not None else 0
+      return {"state": self.state, "memory_mb": round(memory / 2**20, 1), "disk_mb": round(disk / 2**20, 1),
+              "budget_mb": round(self.budget / 2**20, 1)}
+
+   def close(self):
+      """Frees memory and removes spilled files."""
+      with self._lock:
+         self._frame, self._transient = None, None
+         self._drop_compact()
+         self._discard_intermediates()
+         if self._finalizer is not None:
+            self._finalizer()
+      with _stores_lock:
+         _stores.discard(self)
+
+   def _to_compact(self):
+      self._compact = _Compact.from_frame(self._frame)
+      self._frame, self._frame_bytes = None, 0
+      if self._compact.nbytes() > self.budget:
+         self._spill()
+      _release_arrow_memory()
+
+   def _spill(self):
+      if self._spill_root is None:
+         self._spill_root = Path(tempfile.mkdtemp(prefix="qupath_to_lmd_session_"))
+         self._finalizer = weakref.finalize(self, shutil.rmtree, self._spill_root, ignore_errors=True)
+      self._compact.spill(self._spill_root / f"{time.monotonic_ns()}")
+      _release_arrow_memory()
+      logger.debug(f"Spilled {len(self)} shapes to {self._compact.directory}")
+
+   def _discard_intermediates(self):
+      cache = intermediates.default_cache()
+      if cache is not None and self.geometry_version is not None:
+         cache.discard(self.geometry_version)
+
+   def _drop_compact(self):
+      if self._compact is not None and self._compact.directory is not None:
+         shutil.rmtree(self._compact.directory, ignore_errors=True)
+      self._compact = None
+
+
+def sweep_idle(max_idle: float | None = None):
+   """Moves the shapes of all sessions idle for longer than `max_idle` seconds to disk."""
+   max_idle = idle_seconds() if max_idle is None else max_idle
+   now = time.monotonic()
+   with _stores_lock:
+      stores = list(_stores)
+   for store in stores:
+      if store.state in ("frame", "compact") and now - store.last_used > max_idle:
+         logger.info(f"Session idle for {(now - store.last_used) / 60:.0f} minutes, moving its {len(store)} shapes to disk")
+         store.evict(to_disk=True)
@@ -1,16 +1,31 @@
 import ast
 import itertools
+import json
 import re
-import string
-from random import sample
+import shutil
+import tempfile
+import uuid
+from pathlib import Path
 
 import geopandas
 import numpy as np
 import pandas
 import pandas as pd
-import streamlit as st
+import shapely
 from loguru import logger
 
+import qupath_to_lmd.instrument as instrument
+import qupath_to_lmd.plates as plates
+
+HIGHLIGHT_SELECTED = 'background-color: #77dd77; color: black;' # Green
+HIGHLIGHT_OTHER = 'background-color: #f0f2f6;' # Light gray
+# file suffix of the processed shapes in every export format
+PROCESSED_FORMATS = {"geojson": ".geojson", "geoparquet": ".parquet", "flatgeobuf": ".fgb"}
+# FlatGeobuf with a spatial index stores features in spatial order, this column keeps the original one
+FEATURE_ORDER_COLUMN = "feature_order"
+# features serialized at a time when writing GeoJSON
+GEOJSON_CHUNK_SIZE = 65536
+
 def generate_combinations(list1, list2, num) -> list:
    """Generate dictionary from all combinations of two lists and a range, assigning arbitrary values."""
    logger.info("Created combinations")
@@ -27,56 +42,25 @@ def create_list_of_acceptable_wells(
       step_col:int=1):
    """Creates wells according to user parameters."""
    logger.info("Creating list of acceptable wells")
-   if plate not in ["384","96"]:
-      raise ValueError("Plate must be either 384 or 96")
-   if not isinstance(margins,int):
-      raise ValueError("margins must be an integer")
-
-   min_row = 1
-   min_col = 1
-
-   if plate == "384":
-      max_row = 16
-      max_col = 24
-   else:
-      max_row = 8
-      max_col = 12
-
-   if margins>0 :
-      max_col += -(margins)
-      max_row += -(margins)
-      min_col += margins
-      min_row += margins
-
-   list_of_acceptable_wells = []
-   for row in list(string.ascii_uppercase[min_row-1 : max_row : step_row]):
-      for column in range(min_col , max_col+1, step_col):
-         list_of_acceptable_wells.append(str(row) + str(column))
-
-   return list_of_acceptable_wells
-
-def sample_placement():
-   """Sample placement into plate csv."""
-   logger.info("Sample placement for 384wp")
-
-   plate_type = "384"  # Default to 384-well plate
-   if 'plate_gen_params' in st.session_state and isinstance(st.session_state.plate_gen_params, dict):
-      plate_type = st.session_state.plate_gen_params.get('plate_type', "384")
-
-   if plate_type == "384":
-      max_row = 16
-      max_col = 24
-   else:
-      max_row = 8
-      max_col = 12
-
-   rows= [i for i in string.ascii_uppercase[:max_row]]
-   columns = [str(i) for i in range(1,max_col+1)]
-   df = pandas.DataFrame('',columns=columns, index=rows)
-
-   for i in st.session_state.saw.keys():
-      location = st.session_state.saw[i]
-      df.at[location[0],location[1:]] = i
+   return plates.PlateLayout.with_margins(plate, margins, step_row, step_col).acceptable_wells()
+
+def sample_placement(saw: dict = None, plate_type: str = None):
+   """Sample placement into plate csv.
+
+   Samples and wells and plate type default to the ones in the Streamlit session.
+   """
+   logger.info(f"Sample placement for {plate_type or ''}wp")
+
+   if saw is None or plate_type is None:
+      import streamlit as st  # only the webapp relies on the session defaults
+   if saw is None:
+      saw = st.session_state.saw
+   if plate_type is None:
+      plate_type = "384"  # Default to 384-well plate
+      if 'plate_gen_params' in st.session_state and isinstance(st.session_state.plate_gen_params, dict):
+         plate_type = st.session_state.plate_gen_params.get('plate_type', "384")
+
+   df = plates.PlateLayout(plate_type).place(saw).sample_frame()
 
    logger.success("Sample placement done")
    return df
@@ -87,64 +71,59 @@ def create_dataframe_samples_wells(
       plate_string:str = "384",
       ):
    """Creates a dataframe to be displayed."""
-   if plate_string == "384":
-      rows, cols = 16, 24
-   elif plate_string == "96":
-      rows, cols = 8, 12
+   import streamlit as st  # the headless modules import utils, so streamlit is only loaded by the webapp helpers
 
-   if st.session_state.view_mode == "default":
-      row_labels = list(string.ascii_uppercase[:rows])
-      col_labels = list(range(1, cols + 1))
+   layout = plates.PlateLayout(plate_string)
 
-      plate_data = []
-      for r in row_labels:
-         row_data = [f"{r}{c}" for c in col_labels]
-         plate_data.append(row_data)
-      df = pd.DataFrame(plate_data, index=row_labels, columns=col_labels)
+   if st.session_state.view_mode == "default":
+      df = layout.well_frame()
 
    elif st.session_state.view_mode == "samples": 
-      if st.session_state.gdf is None:
+      if st.session_state.shapes is None:
          st.error("GeoDataFrame not found in session state. Please upload and process a GeoJSON file first.")
          st.stop()
 
-      list_of_classes = set(st.session_state.gdf['classification_name'].values)
-      df = pd.DataFrame(np.nan, index=list(string.ascii_uppercase[:rows]), columns=range(1, cols + 1), dtype=object)
+      import qupath_to_lmd.sharding as sharding  # imported here, sharding depends on utils through pipeline
 
-      if len(list_of_classes) > len(acceptable_wells_list):
-         logger.warning("More classes than allowed wells")
-         st.warning("More classes than allowed wells")
-         # list_of_classes = list_of_classes[:len(acceptable_wells_list)]
+      list_of_classes = st.session_state.shapes.class_names()
+      try:
+         manifest = sharding.assign_plates(list_of_classes, acceptable_wells_list, randomize=randomize)
+      except ValueError as e:
+         logger.error(str(e))
+         st.error(f"{e}, please reduce the margins or the space between wells")
+         st.stop()
+      n_plates = int(manifest['plate'].max()) if len(manifest) else 1
 
-      if randomize:
-         logger.info("Randomizing sample locations")
-         acceptable_wells_list = sample(acceptable_wells_list, len(acceptable_wells_list))
+      row_labels = layout.rows
+      if n_plates > 1:
+         logger.warning(f"More classes than allowed wells, splitting them across {n_plates} plates")
+         st.warning(f"More classes than allowed wells, the classes are split across {n_plates} plates")
+         row_labels = pd.MultiIndex.from_product([range(1, n_plates + 1), row_labels], names=["plate", "row"])
 
-      for s, well in zip(list_of_classes, acceptable_wells_list, strict=False):
-         row = well[0]
-         col = int(well[1:])
-         df.at[row, col] = s
+      # plates are stacked row blocks, so every class lands at one (row, column) of a single array
+      positions = layout.positions(manifest['well'])
+      rows = (manifest['plate'].to_numpy() - 1) * layout.n_rows + positions // layout.n_cols
+      values = np.full((n_plates * layout.n_rows, layout.n_cols), np.nan, dtype=object)
+      values[rows, positions % layout.n_cols] = manifest['class'].to_numpy(dtype=object)
+      df = pd.DataFrame(values, index=row_labels, columns=layout.columns)
 
    logger.success("Created dataframe for viewing samples and wells")
    return df
 
 def provide_highlighting_for_df(acceptable_wells_set:set = None):
-   """Creates map to color dataframe."""
-   if st.session_state.view_mode == "default":
-      def highlight_selected(well_name):
-         if well_name in acceptable_wells_set:
-            return 'background-color: #77dd77; color: black;' # Green
-         else:
-            return 'background-color: #f0f2f6;' # Light gray
-      return highlight_selected
-
-   elif st.session_state.view_mode == "samples":
-      list_of_classes = set(st.session_state.gdf['classification_name'].values)
-      def highlight_selected(well_name):
-            if well_name in list_of_classes:
-               return 'background-color: #77dd77; color: black;' # Green
-            else:
-               return 'background-color: #f0f2f6;' # Light gray
-      return highlight_selected
+   """Creates a function that colours a whole plate dataframe at once, for `Styler.apply(..., axis=None)`.
+
+   In the default view available wells are green, in the samples view wells with a sample.
+   """
+   import streamlit as st
+
+   def highlight_selected(df):
+      if st.session_state.view_mode == "default":
+         selected = df.isin(acceptable_wells_set).to_numpy()
+      else:
+         selected = df.notna().to_numpy()
+      return pd.DataFrame(np.where(selected, HIGHLIGHT_SELECTED, HIGHLIGHT_OTHER), index=df.index, columns=df.columns)
+   return highlight_selected
 
 def parse_dictionary_from_file(file_input) -> dict:
    """Reads a file supposed to contain a Python dictionary and parses it."""
@@ -187,46 +166,103 @@ def extract_coordinates(geometry):
       elif geometry.geom_type == 'LineString':
          return [list(coord) for coord in geometry.coords]
       else:
-         st.write(f'Geometry type {geometry.geom_type} not supported, please convert to Polygon or LineString in Qupath')
-         st.stop()
+         raise ValueError(f'Geometry type {geometry.geom_type} not supported, please convert to Polygon or LineString in Qupath')
 
 def dataframe_to_saw_dict(df: pd.DataFrame) -> dict:
     """Converts the plate layout DataFrame to a samples-and-wells dictionary."""
     logger.info("Converting desired dataframe to samples and wells dictionary")
-    saw_dict = {}
-    for well_row, series in df.iterrows():
-        for well_col, sample_name in series.items():
-            if sample_name and pd.notna(sample_name):
-                well_coordinate = f"{well_row}{well_col}"
-                saw_dict[sample_name] = well_coordinate
-    return saw_dict
+    # multi-plate layouts are indexed by (plate, row), the plate is kept in the manifest
+    names, _, wells = plates.frame_cells(df)
+    return dict(zip(names, wells, strict=True))
+
+def parse_classification(raw) -> dict:
+   """Parses a single QuPath classification payload (dict, JSON string or python dict string)."""
+   if isinstance(raw, dict):
+      return raw
+   try:
+      return json.loads(raw)
+   except json.JSONDecodeError:
+      return ast.literal_eval(raw)
+
+def _factorize_classification(classification: pandas.Series) -> tuple[np.ndarray, list]:
+   """Factorizes the raw classification column, so that each distinct payload is parsed only once."""
+   try:
+      codes, uniques = pandas.factorize(classification)
+   except TypeError:
+      # dict payloads are unhashable, intern them by their serialized value
+      keys = classification.map(lambda x: json.dumps(x, sort_keys=True) if isinstance(x, dict) else x)
+      codes, uniques = pandas.factorize(keys)
+   return codes, [parse_classification(raw) for raw in uniques]
+
+def parse_classification_names(classification: pandas.Series) -> pandas.Series:
+   """Returns the class name of every object as a pandas Categorical.
+
+   Each distinct classification payload is parsed once, rows are then mapped by their codes.
+   """
+   logger.info("Parsing classification names")
+   codes, payloads = _factorize_classification(classification)
+   names = pandas.Index([payload.get("name") for payload in payloads], dtype=object)
+   categories = names.dropna().unique()
+   name_codes = np.append(categories.get_indexer(names), -1)  # last entry catches NaN rows (code -1)
+   return pandas.Series(
+      pandas.Categorical.from_codes(name_codes[codes], categories=categories),
+      index=classification.index,
+      name="classification_name")
 
 def update_classification_column(gdf:geopandas.GeoDataFrame) -> geopandas.GeoDataFrame:
    """Updates the 'classification' dictionary for every row.
 
    It replaces the value associated with the 'name' key inside the
    'classification' dictionary with the string value from the
-   'classification_name' column.
+   'classification_name' column. The new payload is built once per
+   distinct (classification, classification_name) pair and assigned in bulk.
    """
    logger.info("Updating classification of objects according to class split")
 
-   def update_row_dict(row):
-      if isinstance(row['classification'],dict):
-         class_dict = row['classification']
-      elif isinstance(row['classification'],str):
-         class_dict = ast.literal_eval(row['classification'])
+   raw_codes, payloads = _factorize_classification(gdf['classification'])
+   name_codes, names = pandas.factorize(gdf['classification_name'])
 
-      class_dict['name'] = row['classification_name']
+   # shift by one so that missing values (code -1) get their own slot
+   n_names = len(names) + 1
+   pair_codes, pairs = pandas.factorize((raw_codes + 1) * n_names + (name_codes + 1))
 
-      row['classification'] = str(class_dict)
+   new_values = np.empty(len(pairs), dtype=object)
+   for i, pair in enumerate(pairs):
+      raw_code, name_code = divmod(int(pair), n_names)
+      if raw_code == 0:
+         new_values[i] = np.nan
+         continue
+      class_dict = dict(payloads[raw_code - 1])
+      class_dict['name'] = names[name_code - 1] if name_code else None
+      new_values[i] = str(class_dict)
 
-      return row['classification']
-
-   gdf['classification'] = gdf.apply(update_row_dict, axis=1)
+   gdf['classification'] = new_values[pair_codes]
 
    return gdf
 
 
+def numbered_classification_column(classification: pandas.Series, base_names: pandas.Series,
+                                   suffixes: pandas.Series) -> np.ndarray:
+   """Returns the 'classification' payloads renamed to '<base_name>_<suffix>'.
+
+   One template is serialized per distinct (payload, base name) pair, the per-row
+   strings are then assembled by array concatenation instead of a dict per row.
+   """
+   raw_codes, payloads = _factorize_classification(classification)
+   name_codes, names = pandas.factorize(base_names)
+   pair_codes, pairs = pandas.factorize(raw_codes.astype(np.int64) * len(names) + name_codes)
+
+   placeholder = uuid.uuid4().hex
+   prefixes = np.empty(len(pairs), dtype=object)
+   postfixes = np.empty(len(pairs), dtype=object)
+   for i, pair in enumerate(pairs):
+      raw_code, name_code = divmod(int(pair), len(names))
+      class_dict = dict(payloads[raw_code])
+      class_dict['name'] = f"{names[name_code]}_{placeholder}"
+      prefixes[i], postfixes[i] = str(class_dict).split(placeholder)
+
+   return prefixes[pair_codes] + np.asarray(suffixes, dtype=object) + postfixes[pair_codes]
+
 def sanitize_gdf(gdf):
    """Ensure compatibility with QuPath."""
    logger.info("Dropping columns with NaNs in the geodataframe")
@@ -244,3 +280,50 @@ def sanitize_gdf(gdf):
 
    return gdf[cols_to_keep]
 
+
+def write_processed(gdf, sink, file_format: str = "geojson"):
+   """Writes the sanitized gdf into a writable binary sink, e.g. an entry of the output bundle.
+
+   `file_format` is one of PROCESSED_FORMATS. QuPath imports GeoJSON; GeoParquet (with a bbox
+   covering column) and FlatGeobuf (with a spatial index and FEATURE_ORDER_COLUMN) are smaller and
+   much faster to read back.
+
+   GeoJSON and GeoParquet are written straight into the sink; only FlatGeobuf goes through a
+   temporary file, GDAL needs a path to build its spatial index.
+   """
+   if file_format not in PROCESSED_FORMATS:
+      raise ValueError(f"Format must be one of {', '.join(PROCESSED_FORMATS)}")
+   with instrument.span(f"write_{file_format}", shapes=len(gdf)):
+      processed = sanitize_gdf(gdf)
+      if file_format == "geojson":
+         _write_geojson(processed, sink)
+      elif file_format == "geoparquet":
+         processed.to_parquet(sink, write_covering_bbox=True)
+      else:
+         with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / f"processed{PROCESSED_FORMATS[file_format]}"
+            processed.assign(**{FEATURE_ORDER_COLUMN: np.arange(len(processed))}).to_file(path, driver="FlatGeobuf")
+            with open(path, "rb") as f:
+               shutil.copyfileobj(f, sink, 1 << 20)
+
+
+def _write_geojson(gdf, sink, chunk_size: int = GEOJSON_CHUNK_SIZE):
+   """Writes a sanitized gdf as a GeoJSON FeatureCollection in chunks, one feature per line.
+
+   The classification is written as an object, as QuPath exports it; each distinct payload is
+   parsed and serialized once.
+   """
+   codes, payloads = _factorize_classification(gdf["classification"])
+   classifications = np.array([json.dumps(payload) for payload in payloads], dtype=object)
+   sink.write(b'{\n"type": "FeatureCollection",\n"features": [\n')
+   for start in range(0, len(gdf), chunk_size):
+      chunk = slice(start, start + chunk_size)
+      geometries = shapely.to_geojson(gdf.geometry.array[chunk])
+      features = [f'{{ "type": "Feature", "properties": {{ "id": {json.dumps(id_)}, "objectType": {json.dumps(object_type)}, '
+                  f'"classification": {classification} }}, "geometry": {geometry} }}'
+                  for id_, object_type, classification, geometry in zip(
+                     gdf["id"].iloc[chunk], gdf["objectType"].iloc[chunk], classifications[codes[chunk]], geometries,
+                     strict=True)]
+      sink.write((("," if start else "") + ",\n".join(features) + "\n").encode())
+   sink.write(b"]\n}\n")
+
@@ -0,0 +1,156 @@
+from collections.abc import Callable
+from typing import TYPE_CHECKING, NamedTuple
+from xml.sax.saxutils import escape
+
+import numpy
+from loguru import logger
+
+import qupath_to_lmd.stage as stage
+
+if TYPE_CHECKING:
+   from lmd.lib import Collection
+
+XML_DECLARATION = "<?xml version='1.0' encoding='UTF-8'?>\n"
+
+
+def _to_stage_integers(points: numpy.ndarray, transform: numpy.ndarray, scale: int) -> tuple[list, list]:
+   """Applies the orientation transform and scale like py-lmd and floors to integers."""
+   transformed = stage.to_stage(points, transform, scale)
+   return transformed[:, 0].tolist(), transformed[:, 1].tolist()
+
+
+def _points_xml(xs: list, ys: list) -> str:
+   return "".join(f"    <X_{i}>{x}</X_{i}>\n    <Y_{i}>{y}</Y_{i}>\n" for i, (x, y) in enumerate(zip(xs, ys, strict=True), start=1))
+
+
+def _shape_head(shape_id: int, well, point_count: int) -> str:
+   head = f"  <Shape_{shape_id}>\n    <PointCount>{point_count}</PointCount>\n"
+   return head if well is None else f"{head}    <CapID>{escape(well)}</CapID>\n"
+
+
+def _shape_xml(shape_id: int, well, xs: list, ys: list) -> str:
+   return f"{_shape_head(shape_id, well, len(xs))}{_points_xml(xs, ys)}  </Shape_{shape_id}>\n"
+
+
+def _header_xml(calibration_points, transform: numpy.ndarray, scale: int, shape_count: int) -> str:
+   header = [XML_DECLARATION, "<ImageData>\n", "  <GlobalCoordinates>1</GlobalCoordinates>\n"]
+   calib_x, calib_y = _to_stage_integers(numpy.asarray(calibration_points), transform, scale)
+   for i, (x, y) in enumerate(zip(calib_x, calib_y, strict=True), start=1):
+      header.append(f"  <X_CalibrationPoint_{i}>{x}</X_CalibrationPoint_{i}>\n")
+      header.append(f"  <Y_CalibrationPoint_{i}>{y}</Y_CalibrationPoint_{i}>\n")
+   header.append(f"  <ShapeCount>{shape_count}</ShapeCount>\n")
+   return "".join(header)
+
+
+def write_collection_xml(collection: "Collection", sink, chunk_shapes: int = 500) -> int:
+   """Streams a py-lmd Collection as Leica LMD XML into a writable binary sink.
+
+   The output is byte-identical to `Collection.save`, but shapes are serialized and written
+   in chunks of `chunk_shapes`, so neither a temporary file nor the full document is needed.
+
+   Args:
+      collection: The collection to serialize.
+      sink: Any object with a `write(bytes)` method, e.g. a file, a zip entry or a socket file.
+      chunk_shapes: Number of shapes serialized per write.
+
+   Returns:
+      Number of bytes written.
+   """
+   transform = collection.orientation_transform
+   scale = collection.scale
+   written = 0
+
+   def flush(parts):
+      nonlocal written
+      data = "".join(parts).encode("utf-8")
+      sink.write(data)
+      written += len(data)
+
+   flush([_header_xml(collection.calibration_points, transform, scale, len(collection.shapes))])
+
+   chunk = []
+   for shape_id, shape in enumerate(collection.shapes, start=1):
+      shape_transform = shape.orientation_transform if shape.orientation_transform is not None else transform
+      xs, ys = _to_stage_integers(shape.points, shape_transform, scale)
+      chunk.append(_shape_xml(shape_id, shape.well, xs, ys))
+      if len(chunk) == chunk_shapes:
+         flush(chunk)
+         chunk = []
+   chunk.append("</ImageData>\n")
+   flush(chunk)
+
+   logger.debug(f"Wrote {len(collection.shapes)} shapes as LMD XML ({written} bytes)")
+   return written
+
+
+class PointBlocks(NamedTuple):
+   """The serialized vertices (`<X_i>`/`<Y_i>` elements) of many shapes in one buffer.
+
+   Shape i owns `data[offsets[i]:offsets[i + 1]]` and has `counts[i]` vertices. The blocks do not
+   depend on the wells, so they can be kept and reused when only the well assignment changes.
+   """
+
+   data: bytes
+   offsets: numpy.ndarray
+   counts: numpy.ndarray
+
+
+def point_blocks(coords: numpy.ndarray, offsets: numpy.ndarray, transform: numpy.ndarray, scale: int) -> PointBlocks:
+   """Serializes the vertices of all shapes given as flat coordinates and offsets (see `shapes.flat_coordinates`)."""
+   xs, ys = _to_stage_integers(coords, transform, scale)
+   bounds = offsets.tolist()
+   blocks = [_points_xml(xs[start:end], ys[start:end]) for start, end in zip(bounds[:-1], bounds[1:], strict=True)]
+   block_offsets = numpy.zeros(len(blocks) + 1, dtype=numpy.int64)
+   numpy.cumsum([len(block) for block in blocks], out=block_offsets[1:])
+   # all characters are ASCII, so string and byte offsets agree
+   return PointBlocks("".join(blocks).encode("ascii"), block_offsets, numpy.diff(offsets))
+
+
+def write_blocks_xml(sink, calibration_points, transform: numpy.ndarray, scale: int, blocks: PointBlocks,
+                     wells, order: numpy.ndarray | None = None, chunk_shapes: int = 500,
+                     progress: Callable[[int], None] | None = None) -> int:
+   """Streams Leica LMD XML of serialized point blocks, byte-identical to `write_collection_xml`.
+
+   Args:
+      sink: Any object with a `write(bytes)` method.
+      calibration_points: (3, 2) calibration points in QuPath coordinates.
+      transform: Orientation transform of the collection.
+      scale: Scale of the collection.
+      blocks: Serialized vertices of every shape.
+      wells: Well of every written shape, in output order.
+      order: Indices of the blocks in output order, all blocks in their order if None.
+      chunk_shapes: Number of shapes assembled per write.
+      progress: Called with the number of shapes written after every write.
+
+   Returns:
+      Number of bytes written.
+   """
+   order = numpy.arange(len(blocks.counts)) if order is None else numpy.asarray(order)
+   written = 0
+
+   def flush(parts):
+      nonlocal written
+      data = b"".join(parts)
+      sink.write(data)
+      written += len(data)
+
+   flush([_header_xml(calibration_points, transform, scale, len(order)).encode("utf-8")])
+
+   view = memoryview(blocks.data)
+   starts, ends, counts = blocks.offsets[:-1].tolist(), blocks.offsets[1:].tolist(), blocks.counts.tolist()
+   chunk = []
+   for shape_id, (i, well) in enumerate(zip(order.tolist(), wells, strict=True), start=1):
+      chunk.extend((_shape_head(shape_id, well, counts[i]).encode("utf-8"), view[starts[i]:ends[i]],
+                    f"  </Shape_{shape_id}>\n".encode("ascii")))
+      if shape_id % chunk_shapes == 0:
+         flush(chunk)
+         chunk = []
+         if progress is not None:
+            progress(shape_id)
+   chunk.append(b"</ImageData>\n")
+   flush(chunk)
+   if progress is not None:
+      progress(len(order))
+
+   logger.debug(f"Wrote {len(order)} shapes as LMD XML ({written} bytes)")
+   return written
@@ -1,15 +1,19 @@
-import io
 import json
 import sys
 import tempfile
 import uuid
-import zipfile
 from pathlib import Path
 
 import streamlit as st
 from loguru import logger
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 import qupath_to_lmd.core as core
+import qupath_to_lmd.instrument as instrument
+import qupath_to_lmd.jobs as jobs
+import qupath_to_lmd.sharding as sharding
+import qupath_to_lmd.simplify as simplify
+import qupath_to_lmd.store as store
 import qupath_to_lmd.utils as utils
 
 ####################
@@ -20,8 +24,8 @@ if 'session_id' not in st.session_state:
     st.session_state.session_id = str(uuid.uuid4())
 if 'view_mode' not in st.session_state:
    st.session_state.view_mode = 'default'
-if 'gdf' not in st.session_state:
-   st.session_state.gdf = None
+if 'shapes' not in st.session_state:
+   st.session_state.shapes = None  # store.GeometryStore of the uploaded shapes
 if 'calibs' not in st.session_state:
    st.session_state.calibs = None
 if 'calib_array' not in st.session_state:
@@ -32,29 +36,55 @@ if "use_plate_wells" not in st.session_state:
    st.session_state.use_plate_wells = True
 if 'file_name' not in st.session_state:
    st.session_state.file_name = None
+if 'upload_id' not in st.session_state:
+   st.session_state.upload_id = None
 if 'available_points_dict' not in st.session_state:
    st.session_state.available_points_dict = None
-if 'xml_content' not in st.session_state:
-   st.session_state.xml_content = None
 if 'csv_content' not in st.session_state:
    st.session_state.csv_content = None
-if 'zip_buffer' not in st.session_state:
-    st.session_state.zip_buffer = None
+if 'bundle' not in st.session_state:
+   st.session_state.bundle = None
+if 'job' not in st.session_state:
+   st.session_state.job = None  # jobs.Job of the running "Process files"
 if 'plate_df' not in st.session_state:
    st.session_state.plate_df = None
+if 'plate_manifest' not in st.session_state:
+   st.session_state.plate_manifest = None
 if 'plate_gen_params' not in st.session_state:
    st.session_state.plate_gen_params = None
 if 'show_saw_uploader' not in st.session_state:
    st.session_state.show_saw_uploader = False
+if 'run_report' not in st.session_state:
+   st.session_state.run_report = instrument.RunRecorder(st.session_state.session_id)
+# every rerun may run on another thread, so the recorder of this session is activated each time
+instrument.activate(st.session_state.run_report)
+store.sweep_idle()
 
 # Configure logging
+LOG_FORMAT = "<green>{time:HH:mm:ss.SS}</green> | <level>{level}</level> | {message}"
+
+@st.cache_resource
+def configure_console_logging():
+   """Replaces the default sink once per server process, not on every rerun of every session."""
+   logger.remove()
+   logger.add(sys.stdout, colorize=True, format=LOG_FORMAT, level="DEBUG")
+   return True
+
+def only_this_session(streamlit_session_id: str):
+   """Loguru filter that keeps records emitted from the given Streamlit session's script thread or its jobs."""
+   def session_filter(record):
+      if record["extra"].get("streamlit_session") == streamlit_session_id:
+         return True
+      ctx = get_script_run_ctx(suppress_warning=True)
+      return ctx is not None and ctx.session_id == streamlit_session_id
+   return session_filter
+
+configure_console_logging()
 if "log_file_path" not in st.session_state or st.session_state.log_file_path is None:
    temp_log_file = tempfile.NamedTemporaryFile(delete=False, suffix=".log")
    st.session_state.log_file_path = temp_log_file.name
-
-logger.remove()
-logger.add(st.session_state.log_file_path, format="<green>{time:HH:mm:ss.SS}</green> | <level>{level}</level> | {message}")
-logger.add(sys.stdout, colorize=True, format="<green>{time:HH:mm:ss.SS}</green> | <level>{level}</level> | {message}", level="DEBUG")
+   logger.add(st.session_state.log_file_path, format=LOG_FORMAT,
+              filter=only_this_session(get_script_run_ctx().session_id))
 
 ####################
 ### Introduction ###
@@ -76,15 +106,24 @@ st.markdown("""
             Upload your .geojson file from qupath, order of calibration points is important
             """)
 
-uploaded_file = st.file_uploader(label="Choose a file", type="geojson", accept_multiple_files=False)
+uploaded_file = st.file_uploader(label="Choose a file", type=["geojson", "parquet", "fgb"], accept_multiple_files=False,
+                                 help="QuPath GeoJSON, or the same converted to GeoParquet or FlatGeobuf (much faster for "
+                                      "whole-slide single cell exports)")
+streaming_ingest = st.toggle("Low-memory streaming ingest (for large single-cell exports)", value=False)
 
 if uploaded_file:
-   # process and QC geojson automatically if new file
-   if st.session_state.file_name != uploaded_file.name or st.session_state.gdf is None:
+   # process and QC geojson automatically if new file, every upload gets a new file_id even when the name is the same
+   if st.session_state.upload_id != uploaded_file.file_id or st.session_state.shapes is None:
       logger.info(f"New file detected: {uploaded_file.name}")
       st.session_state.file_name = uploaded_file.name
+      st.session_state.upload_id = uploaded_file.file_id
       # process and QC geojson
-      st.session_state.gdf, st.session_state.available_points_dict = core.load_and_QC_geojson_file(geojson_path=uploaded_file)
+      gdf, st.session_state.available_points_dict = core.load_and_QC_geojson_file(
+         geojson_path=uploaded_file, streaming=streaming_ingest)
+      if st.session_state.shapes is not None:
+         st.session_state.shapes.close()
+      st.session_state.shapes = store.GeometryStore(gdf)
+      del gdf
 
    if st.session_state.available_points_dict:
       calib_options = list(st.session_state.available_points_dict.keys())
@@ -99,7 +138,7 @@ if uploaded_file:
       # Perform triangle QC
       if all(st.session_state.calibs):
          st.session_state.calib_array = core.perform_triangle_qc(
-            st.session_state.gdf,
+            st.session_state.shapes.frame(),
             st.session_state.available_points_dict,
             st.session_state.calibs
          )
@@ -109,7 +148,10 @@ if uploaded_file:
 else:
    if st.session_state.file_name is not None:
       st.session_state.file_name = None
-      st.session_state.gdf = None
+      st.session_state.upload_id = None
+      if st.session_state.shapes is not None:
+         st.session_state.shapes.close()
+      st.session_state.shapes = None
       st.session_state.available_points_dict = None
       st.session_state.calibs = None
       st.session_state.calib_array = None
@@ -120,7 +162,7 @@ st.divider()
 ## Step 1.1 (Optional): Split a class into many classes ##
 ##########################################################
 
-if st.session_state.gdf is not None:
+if st.session_state.shapes is not None:
    st.markdown("## Step 1.1 (Optional): Split a class into many classes")
    st.markdown(
       "For one or more classes below. For every shape belonging to a selected class, "
@@ -128,7 +170,7 @@ if st.session_state.gdf is not None:
       "This is useful for single-cell collection."
    )
 
-   all_classes = st.session_state.gdf['classification_name'].unique().tolist()
+   all_classes = st.session_state.shapes.class_names()
    classes_to_make_unique = st.multiselect("Select classes to make unique:", options=all_classes)
 
    if st.button("Generate Unique Names"):
@@ -138,10 +180,11 @@ if st.session_state.gdf is not None:
          logger.warning("No classes selected to make unique")
       else:
          logger.debug(f"Classes to make unique: {classes_to_make_unique}")
-         # This function modifies st.session_state.gdf
+         # This function replaces the shapes in st.session_state.shapes
          core.make_classes_unique(classes_to_make_unique)
          st.session_state.saw = None
          st.session_state.plate_df = None
+         st.session_state.plate_manifest = None
          st.info("Chosen classes were split up, check below.")
 
 st.divider()
@@ -151,7 +194,7 @@ st.divider()
 ########################################
 
 st.markdown("""
-            ## Step 2: Decide which plate to collect into, either 384 or 96 well plate.  
+            ## Step 2: Decide which plate to collect into, a 384, 96 or 1536 well plate.  
             Decide how many wells to make unavailable as a margin (for 384wp we suggest a margin of 2).  
             Decide how many wells to leave blank in between, for easier pipetting.  
             """)
@@ -160,7 +203,7 @@ st.write("You can increase plate size by dragging bottom right corner")
 
 plate, margin, step_row, step_col = st.columns(4)
 with plate:
-   plate_string = st.selectbox('Select a plate type',('384 well plate', '96 well plate'))
+   plate_string = st.selectbox('Select a plate type',('384 well plate', '96 well plate', '1536 well plate'))
 with margin:
    margin_int = st.number_input('Margin (integer)', min_value=0, max_value=10, value=1)
 with step_row:
@@ -212,14 +255,14 @@ df_missing = 'plate_df' not in st.session_state or st.session_state.plate_df is
 if st.session_state.view_mode == 'default':
    df = utils.create_dataframe_samples_wells(plate_string=plate_type)
    mapping = utils.provide_highlighting_for_df(acceptable_wells_set=acceptable_wells_set)
-   st.dataframe(df.style.map(mapping), width="stretch" )
+   st.dataframe(df.style.apply(mapping, axis=None), width="stretch" )
 
 elif st.session_state.view_mode == 'samples':
    if uploaded_file is None:
       st.warning("File no longer available. Please upload a file or switch to the default view.")
    else:
       # Only regenerate the dataframe if parameters have changed or it doesn't exist
-      if (params_have_changed or df_missing) and st.session_state.gdf is not None:
+      if (params_have_changed or df_missing) and st.session_state.shapes is not None:
          st.session_state.plate_gen_params = plate_gen_params # Store the new params
          st.session_state.plate_df = utils.create_dataframe_samples_wells(
             randomize = randomize_toggle,
@@ -227,13 +270,16 @@ elif st.session_state.view_mode == 'samples':
             acceptable_wells_list = acceptable_wells_list)
       if st.session_state.plate_df is not None:
          mapping = utils.provide_highlighting_for_df()
-         st.dataframe(st.session_state.plate_df.style.map(mapping), width="stretch")
+         st.dataframe(st.session_state.plate_df.style.apply(mapping, axis=None), width="stretch")
 
 if st.button("Confirm and use this plate layout"):
    logger.info("Confirm and use this plate layout -- ButtonPress")
    if st.session_state.view_mode == 'samples' and st.session_state.plate_df is not None:
       saw_from_df = utils.dataframe_to_saw_dict(st.session_state.plate_df)
       st.session_state.saw = saw_from_df
+      manifest = sharding.manifest_from_dataframe(st.session_state.plate_df)
+      # a single plate keeps the single xml export
+      st.session_state.plate_manifest = manifest if manifest['plate'].nunique() > 1 else None
       core.load_and_QC_SamplesandWells(st.session_state.saw)
       st.session_state.use_plate_wells = True # To indicate we are using a plate layout
       st.success("Samples and wells layout confirmed, you are ready for Step 3!")
@@ -272,6 +318,7 @@ if st.session_state.show_saw_uploader:
       logger.debug(uploaded_saw)
       core.load_and_QC_SamplesandWells(st.session_state.saw)
       st.session_state.use_plate_wells = False
+      st.session_state.plate_manifest = None
       st.success("Custom samples and wells dictionary loaded and checked.")
       st.session_state.show_saw_uploader = False
 
@@ -285,45 +332,114 @@ st.markdown("""
             Please download the QC image, and plate scheme for future reference.  
             """)
 
-if st.button("Process files"):
+hifi_plot = st.toggle("High fidelity QC plot (matplotlib, slow for many contours)", value=False)
+optimize_order = st.toggle("Optimize cutting order (group by well, minimise stage travel)", value=False)
+processed_format = st.selectbox("Format of the processed shapes", ["geojson", "geoparquet", "flatgeobuf"],
+                                format_func={"geojson": "GeoJSON (imports into QuPath)", "geoparquet": "GeoParquet",
+                                             "flatgeobuf": "FlatGeobuf"}.get)
+
+simplify_settings = None
+with st.expander("Adaptive simplification"):
+   st.write("By default every contour is simplified with a tolerance of 1 pixel. "
+            "Vertex budgets instead simplify large regions more and keep small cells as drawn.")
+   if st.toggle("Use vertex budgets", value=False):
+      budget_col, total_col, deviation_col = st.columns(3)
+      with budget_col:
+         vertex_budget = st.number_input("Max vertices per contour (0 = no limit)", min_value=0, value=200, step=10)
+      with total_col:
+         collection_budget = st.number_input("Max vertices in total (0 = no limit)", min_value=0, value=0, step=1000)
+      with deviation_col:
+         max_area_deviation = st.number_input("Max area change (%)", min_value=0.0, max_value=100.0, value=2.0, step=0.5)
+      if vertex_budget or collection_budget:
+         simplify_settings = simplify.SimplifySettings(
+            vertex_budget=vertex_budget or None, collection_budget=collection_budget or None,
+            max_area_deviation=max_area_deviation / 100)
+      else:
+         st.warning("Set at least one vertex budget, otherwise the fixed tolerance is used.")
+
+with st.expander("Overlap and proximity QC"):
+   st.write("Finds contours that overlap, are drawn twice, or are closer than the laser cut width. "
+            "Such contours get cut twice or carry material into neighbouring wells.")
+   min_distance = st.number_input("Minimum distance between contours (pixels, e.g. the laser kerf)",
+                                  min_value=0.0, value=0.0, step=1.0)
+   if st.button("Check overlaps"):
+      logger.info("Check overlaps -- ButtonPress")
+      core.check_overlaps(min_distance=min_distance)
+
+@st.fragment(run_every=1.0)
+def show_job_progress():
+   """Polls the running job, and reruns the whole page once it finished to show its results."""
+   job = st.session_state.job
+   if job is None or job.finished:
+      st.rerun()
+   if job.state == jobs.QUEUED:
+      st.info(f"Waiting for a free worker, {jobs.default_queue().ahead(job)} jobs ahead.")
+   st.progress(job.fraction, text=f"{job.describe()} ({job.elapsed:.0f} s)")
+   if st.button("Cancel processing", disabled=job.cancel_requested):
+      logger.info("Cancel processing -- ButtonPress")
+      job.cancel()
+
+
+job_running = st.session_state.job is not None and not st.session_state.job.finished
+if st.button("Process files", disabled=job_running):
    logger.info("Process files button clicked")
-   if st.session_state.gdf is not None and st.session_state.saw is not None:
-      logger.debug(st.session_state.gdf)
+   if st.session_state.shapes is not None and st.session_state.saw is not None:
+      logger.debug(st.session_state.shapes.memory())
       logger.debug(st.session_state.saw)
       logger.debug(st.session_state.calibs)
-      xml_content, csv_content, image_path = core.create_collection()
-      st.session_state.xml_content = xml_content
-      st.session_state.csv_content = csv_content
-
-      zip_buffer = io.BytesIO()
-      with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-         zip_file.writestr(f'{Path(st.session_state.file_name).stem}.xml', xml_content)
-         zip_file.writestr(f'{Path(st.session_state.file_name).stem}_384_wellplate.csv', csv_content)
-         zip_file.writestr('samples_and_wells.json', json.dumps(st.session_state.saw, indent=4))
-         with tempfile.NamedTemporaryFile(suffix=".geojson") as tmp_geojson:
-            tmp_gdf = utils.sanitize_gdf(st.session_state.gdf)
-            tmp_gdf.to_file(tmp_geojson.name, driver="GeoJSON")
-            zip_file.write(tmp_geojson.name, f'{Path(st.session_state.file_name).stem}_processed.geojson')
-         with open(image_path, "rb") as f:
-            zip_file.writestr("collection.png", f.read())
-         if "log_file_path" in st.session_state and st.session_state.log_file_path:
-            zip_file.write(st.session_state.log_file_path, f"log_{st.session_state.session_id}.log")
-
-      st.session_state.zip_buffer = zip_buffer
-      st.image(image_path, caption='Your Contours', width='content')
-      st.success("All files have been processed and are ready for download.")
-      logger.info("All files processed and zipped successfully")
+      if st.session_state.bundle is not None:
+         st.session_state.bundle.close()
+         st.session_state.bundle = None
+      # the job runs off the script thread, so its records are tagged to reach this session's log
+      with logger.contextualize(streamlit_session=get_script_run_ctx().session_id):
+         try:
+            st.session_state.job = core.submit_processing(
+               hifi_plot=hifi_plot, simplify_settings=simplify_settings, optimize_order=optimize_order,
+               processed_format=processed_format)
+            job_running = not st.session_state.job.finished
+         except jobs.QueueFull as e:
+            st.warning(f"The server is busy processing other files ({e}).")
+            logger.warning(f"Process files rejected: {e}")
    else:
       st.warning("Please ensure you have loaded a GeoJSON and provided a samples-and-wells scheme.")
       logger.warning("GeoJSON or samples-and-wells scheme not found")
 
-if st.session_state.zip_buffer:
-   st.download_button(
-      label="Download files",
-      data=st.session_state.zip_buffer.getvalue(),
-      file_name=f"{Path(st.session_state.file_name).stem}_collection.zip",
-      mime="application/zip"
-   )
+if job_running:
+   show_job_progress()
+elif st.session_state.job is not None:
+   # the finished job hands its artifacts over to the session
+   job, st.session_state.job = st.session_state.job, None
+   if job.state == jobs.DONE:
+      processed = job.result
+      st.session_state.bundle = processed.bundle
+      st.session_state.csv_content = processed.csv_content
+      st.write(processed.stats)
+      if processed.flagged is not None and len(processed.flagged):
+         st.warning(f"{len(processed.flagged)} shapes lie outside the stage range or far outside the calibration "
+                    "triangle, where errors in finding the calibration points are magnified. They are listed in "
+                    "the flagged shapes csv of the zip.")
+         st.dataframe(processed.flagged, hide_index=True)
+      for image_name, qc_png in processed.qc_images.items():
+         st.image(qc_png, caption=f'Your Contours ({image_name})' if len(processed.qc_images) > 1 else 'Your Contours',
+                  width='content')
+      st.success(f"All files have been processed in {job.elapsed:.0f} s and are ready for download.")
+      logger.info("All files processed and zipped successfully")
+   elif job.state == jobs.CANCELLED:
+      st.info("Processing was cancelled.")
+   else:
+      st.error(f"Processing failed: {job.error}")
+
+if st.session_state.bundle is not None:
+   output = st.session_state.bundle
+   # a zip spooled to disk is only read into memory when it is asked for, not on every rerun
+   if output.in_memory or st.button("Prepare download", help=f"The zip ({output.size / 2**20:.0f} MB) is kept on disk until then"):
+      st.download_button(
+         label="Download files",
+         data=output.read(),
+         file_name=f"{Path(st.session_state.file_name).stem}_collection.zip",
+         mime="application/zip",
+         on_click="ignore",
+      )
 
 st.divider()
 st.divider()
@@ -377,13 +493,12 @@ if st.button("Create class names for QuPath"):
          "name": name,
          "color": java_colors[i % len(java_colors)]
       })
-   with open("classes.json", "w") as f:
-      json.dump(json_data, f, indent=2)
-
    st.download_button("Download Samples and Wells file for Qupath", 
-                     data=Path('./classes.json').read_text(), 
+                     data=json.dumps(json_data, indent=2), 
                      file_name="classes.json")
 
 st.image(image="./assets/sample_names_example.png",
          caption="Example of class names for QuPath")
 st.divider()
+
+core.show_session_memory()
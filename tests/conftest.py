@@ -0,0 +1,16 @@
+from pathlib import Path
+
+import pytest
+
+import qupath_to_lmd.pipeline as pipeline
+import qupath_to_lmd.utils as utils
+
+DEMO = Path(__file__).resolve().parents[1] / "demo_Qupath_project"
+
+
+@pytest.fixture(scope="session")
+def demo_slide():
+   """The single cell demo export: cleaned shapes, calibration array and samples and wells."""
+   gdf, available_points = pipeline.load_geojson(DEMO / "Single_cells.geojson")
+   saw = utils.parse_dictionary_from_file(str(DEMO / "demo_samples_and_wells.txt"))
+   return gdf, pipeline.calibration_array(available_points), saw
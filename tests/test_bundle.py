@@ -0,0 +1,69 @@
+import zipfile
+
+import pytest
+
+import qupath_to_lmd.bundle as bundle
+
+
+def _archive(output: bundle.Bundle) -> zipfile.ZipFile:
+   output.file.seek(0)
+   return zipfile.ZipFile(output.file)
+
+
+@pytest.mark.parametrize("spool_max", [0, 1 << 10, 64 << 20], ids=["on disk", "rolled over", "in memory"])
+def test_bundle_round_trips_through_zipfile(tmp_path, spool_max):
+   source = tmp_path / "log.txt"
+   source.write_text("line\n" * 1000)
+   with bundle.BundleWriter(spool_max=spool_max) as writer:
+      writer.add("samples_and_wells.json", '{"a": "C3"}')
+      writer.add("collection.png", b"\x89PNG" + bytes(range(256)) * 100, compress=False)
+      writer.add_file("log_ümlaut.txt", source)
+      writer.add_task("slide_processed.geojson", lambda sink: sink.write(b"{}" * 100000))
+      with writer.open("slide.xml") as sink:
+         sink.write("<ImageData>\n")
+   output = writer.bundle
+   assert output.in_memory == (spool_max > output.size)
+   with _archive(output) as archive:
+      assert archive.testzip() is None
+      assert archive.namelist() == ["samples_and_wells.json", "collection.png", "log_ümlaut.txt",
+                                    "slide_processed.geojson", "slide.xml"]
+      assert archive.read("samples_and_wells.json") == b'{"a": "C3"}'
+      assert archive.getinfo("collection.png").compress_type == zipfile.ZIP_STORED
+      assert archive.read("log_ümlaut.txt") == source.read_bytes()
+      assert archive.read("slide_processed.geojson") == b"{}" * 100000
+   assert b"".join(output.iter_chunks(1000)) == output.read()
+
+
+def test_failed_entry_is_dropped():
+   with bundle.BundleWriter() as writer:
+      writer.add("samples_and_wells.json", "{}")
+      with pytest.raises(RuntimeError), writer.open("slide.xml") as sink:
+         sink.write("<ImageData>")
+         raise RuntimeError("collection failed")
+      writer.add("collection.png", b"png", compress=False)
+   assert sink.data.closed
+   with _archive(writer.bundle) as archive:
+      assert archive.namelist() == ["samples_and_wells.json", "collection.png"]
+
+
+@pytest.mark.slow
+def test_bundle_writes_zip64_entries_over_4_gib():
+   chunk = bytes(16 << 20)
+   size = (4 << 30) + len(chunk)
+
+   def produce(sink):
+      for _ in range(size // len(chunk)):
+         sink.write(chunk)
+
+   with bundle.BundleWriter(spool_max=0, level=1) as writer:
+      writer.add("before.txt", "before")
+      writer.add_task("large.bin", produce)
+      writer.add("after.txt", "after")
+   with _archive(writer.bundle) as archive:
+      assert archive.getinfo("large.bin").file_size == size
+      assert archive.read("after.txt") == b"after"
+      with archive.open("large.bin") as f:
+         read = 0
+         while data := f.read(64 << 20):  # zipfile checks the CRC at the end of the entry
+            read += len(data)
+      assert read == size
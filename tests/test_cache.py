@@ -0,0 +1,73 @@
+import io
+import os
+
+import pytest
+
+import qupath_to_lmd.cache as cache
+
+
+def test_key_follows_content_not_name(tmp_path):
+   upload = tmp_path / "slide.geojson"
+   upload.write_bytes(b'{"type": "FeatureCollection", "features": []}')
+   key = cache.content_key(upload, parser="streaming")
+   # a file-like with the same content, e.g. a Streamlit upload, gets the same key and is rewound
+   buffer = io.BytesIO(upload.read_bytes())
+   assert cache.content_key(buffer, parser="streaming") == key and buffer.tell() == 0
+
+   upload.write_bytes(b'{"type": "FeatureCollection", "features": [] }')
+   assert cache.content_key(upload, parser="streaming") != key
+
+
+def test_key_changes_with_parser_and_cache_version(tmp_path, monkeypatch):
+   upload = tmp_path / "slide.geojson"
+   upload.write_bytes(b"{}")
+   key = cache.content_key(upload, parser="streaming")
+   assert cache.content_key(upload, parser="geopandas") != key
+   monkeypatch.setattr(cache, "CACHE_VERSION", cache.CACHE_VERSION + 1)
+   assert cache.content_key(upload, parser="streaming") != key
+
+
+def test_round_trip_and_miss(demo_slide, tmp_path):
+   gdf = demo_slide[0]
+   parsed = cache.ParsedCache(tmp_path)
+   assert parsed.get("missing") is None
+   parsed.put("key", gdf, {"calib_1": [1.0, 2.0]}, {"Number of shapes": len(gdf)})
+   cached, points, report = parsed.get("key")
+   assert cached.geometry.geom_equals_exact(gdf.geometry, tolerance=0).all()
+   assert cached.drop(columns="geometry").equals(gdf.drop(columns="geometry"))
+   assert points == {"calib_1": [1.0, 2.0]} and report == {"Number of shapes": len(gdf)}
+
+
+def test_unreadable_entry_is_a_miss(demo_slide, tmp_path):
+   parsed = cache.ParsedCache(tmp_path)
+   parsed.put("key", demo_slide[0], {})
+   (tmp_path / "key.parquet").write_bytes(b"not parquet")
+   assert parsed.get("key") is None
+
+
+def test_least_recently_used_entries_are_evicted(demo_slide, tmp_path):
+   gdf = demo_slide[0]
+   parsed = cache.ParsedCache(tmp_path)
+   for age, key in enumerate(["old", "used", "new"]):
+      parsed.put(key, gdf, {})
+      os.utime(tmp_path / f"{key}.parquet", (1000 + age, 1000 + age))
+   # reading an entry makes it the most recently used
+   assert parsed.get("old") is not None
+   entry = sum(path.stat().st_size for path in tmp_path.glob("new.*"))
+   parsed.max_bytes = 2 * entry
+   parsed.evict()
+   assert sorted(path.stem for path in tmp_path.glob("*.parquet")) == ["new", "old"]
+
+
+@pytest.mark.parametrize(("max_mb", "enabled"), [("0", False), ("1", True)])
+def test_default_cache_is_configured_by_environment(tmp_path, monkeypatch, max_mb, enabled):
+   monkeypatch.setenv(cache.CACHE_DIR_ENV, str(tmp_path))
+   monkeypatch.setenv(cache.CACHE_MAX_MB_ENV, max_mb)
+   cache.default_cache.cache_clear()
+   try:
+      parsed = cache.default_cache()
+   finally:
+      cache.default_cache.cache_clear()
+   assert (parsed is not None) == enabled
+   if enabled:
+      assert parsed.directory == tmp_path and parsed.max_bytes == 2**20
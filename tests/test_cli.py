@@ -0,0 +1,43 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import qupath_to_lmd.cli as cli
+
+
+class BrokenPool:
+   """Stands in for a process pool whose workers died."""
+
+   def __init__(self, *args, **kwargs):
+      pass
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc):
+      return False
+
+   def submit(self, *args, **kwargs):
+      future = Future()
+      future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+      return future
+
+
+def test_batch_rejects_inputs_with_the_same_stem(tmp_path):
+   for name in ("slide.geojson", "slide.parquet", "other.fgb"):
+      (tmp_path / name).touch()
+   with pytest.raises(ValueError, match="slide"):
+      cli.run_batch(tmp_path, tmp_path / "out")
+   assert not (tmp_path / "out").exists()
+
+
+def test_broken_pool_fails_the_slides_and_writes_the_summary(tmp_path, monkeypatch):
+   for name in ("a.geojson", "b.parquet"):
+      (tmp_path / name).touch()
+   monkeypatch.setattr(cli, "ProcessPoolExecutor", BrokenPool)
+   summary = cli.run_batch(tmp_path, tmp_path / "out")
+   assert summary["slide"].tolist() == ["a", "b"]
+   assert (summary["status"] == "error").all()
+   assert summary["error"].str.startswith("BrokenProcessPool").all()
+   assert (tmp_path / "out" / "batch_summary.csv").exists()
@@ -0,0 +1,29 @@
+import string
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import qupath_to_lmd.pipeline as pipeline
+
+SESSIONS = 8
+WELLS = [f"{row}{col}" for row in string.ascii_uppercase[2:14] for col in range(3, 23)]
+
+
+@pytest.mark.parametrize("geometry_version", [None, "demo"], ids=["uncached", "intermediates cache"])
+def test_concurrent_exports_match_sequential(demo_slide, geometry_version):
+   gdf, calib_array, _ = demo_slide
+   gdf = pipeline.make_classes_unique(gdf, ["single_cells_demo"])
+   classes = sorted(gdf["classification_name"].unique())
+   # every session puts the classes into other wells, so a mixed-up output shows
+   layouts = [{name: WELLS[(i + session) % len(WELLS)] for i, name in enumerate(classes)} for session in range(SESSIONS)]
+
+   def export(saw):
+      artifacts = pipeline.export_collection(gdf, calib_array, saw, geometry_version=geometry_version)
+      return artifacts.xml, artifacts.plate_csv, artifacts.qc_png
+
+   sequential = [export(saw) for saw in layouts]
+   with ThreadPoolExecutor(max_workers=SESSIONS) as pool:
+      concurrent = list(pool.map(export, layouts))
+   for session, (expected, got) in enumerate(zip(sequential, concurrent, strict=True)):
+      assert got == expected, f"session {session} differs from its sequential run"
+   assert len({xml for xml, _, _ in sequential}) == SESSIONS
@@ -0,0 +1,15 @@
+import io
+import zipfile
+
+import pytest
+
+import qupath_to_lmd.core as core
+
+
+@pytest.mark.parametrize("plate_type", ["96", "384"])
+def test_process_files_names_plate_csv_by_plate_type(demo_slide, plate_type):
+   gdf, calib, saw = demo_slide
+   processed = core.process_files(gdf, calib, saw, "slide", plate_type=plate_type)
+   names = zipfile.ZipFile(io.BytesIO(processed.bundle.read())).namelist()
+   assert f"slide_{plate_type}_wellplate.csv" in names
+   assert "slide.xml" in names
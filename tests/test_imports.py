@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+# import budget (ms) of the headless entry points, about half of it is pandas and geopandas
+BUDGET_MS = float(os.environ.get("QUPATH_TO_LMD_IMPORT_BUDGET_MS", 1000))
+DEFERRED = ["streamlit", "lmd", "matplotlib", "scipy"]
+
+
+def import_time(module: str) -> tuple[float, list]:
+   """Best of three cumulative import times of `module` in a fresh interpreter (ms), and the deferred packages it loaded."""
+   check = f"import sys, {module}; print(','.join(m for m in {DEFERRED!r} if m in sys.modules))"
+   runs = []
+   for _ in range(3):
+      result = subprocess.run([sys.executable, "-X", "importtime", "-c", check], capture_output=True, text=True,
+                              check=True, env={**os.environ, "PYTHONPATH": str(SRC)})
+      line = next(line for line in result.stderr.splitlines() if line.rstrip().endswith(f"| {module}"))
+      runs.append(int(line.split("|")[1]) / 1000)
+   return min(runs), [name for name in result.stdout.strip().split(",") if name]
+
+
+@pytest.mark.parametrize("module", ["qupath_to_lmd.pipeline", "qupath_to_lmd.cli"])
+def test_headless_entry_points_import_within_budget(module):
+   import_ms, deferred = import_time(module)
+   assert import_ms <= BUDGET_MS, f"import {module} took {import_ms:.0f} ms, budget {BUDGET_MS:.0f} ms"
+   assert not deferred, f"{module} loads {', '.join(deferred)} at import"
+
+
+@pytest.mark.parametrize("module", ["qupath_to_lmd.sharding", "qupath_to_lmd.ingest", "qupath_to_lmd.stage",
+                                    "qupath_to_lmd.utils"])
+def test_headless_modules_defer_heavy_imports(module):
+   _, deferred = import_time(module)
+   assert not deferred, f"{module} loads {', '.join(deferred)} at import"
@@ -0,0 +1,76 @@
+import json
+import warnings
+
+import geopandas
+import pytest
+import shapely
+
+import qupath_to_lmd.ingest as ingest
+import qupath_to_lmd.utils as utils
+
+CLASSIFICATIONS = {
+   "dict": {"name": "c1", "color": [1, 2, 3]},
+   "json string": json.dumps({"name": "c1", "color": [1, 2, 3]}),
+   "repr string": str({"name": "c1", "color": [1, 2, 3]}),
+}
+
+
+def _feature(geometry: dict, properties: dict) -> dict:
+   return {"type": "Feature", "geometry": geometry, "properties": properties}
+
+
+@pytest.mark.parametrize("classification", CLASSIFICATIONS.values(), ids=CLASSIFICATIONS.keys())
+def test_streaming_reader_matches_geopandas(tmp_path, classification):
+   square = {"type": "Polygon", "coordinates": [[[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]]}
+   features = [_feature({"type": "Point", "coordinates": [i, i]}, {"name": f"calib{i}"}) for i in range(3)]
+   features += [_feature(square, {"objectType": "annotation", "classification": classification}),
+                _feature(square, {"objectType": "annotation"})]
+   path = tmp_path / "slide.geojson"
+   path.write_text(json.dumps({"type": "FeatureCollection", "features": features}))
+
+   streamed, points, _ = ingest.read_geojson_streaming(path)
+   df = geopandas.read_file(path)
+   df = df[(df.geometry.geom_type != "Point") & df["classification"].notna()]
+   assert streamed["classification_name"].astype(str).tolist() == ["c1"]
+   assert streamed["classification_name"].astype(str).tolist() == \
+      utils.parse_classification_names(df["classification"]).astype(str).tolist()
+   assert list(points) == ["calib0", "calib1", "calib2"]
+
+
+def _flatgeobuf(path, order_column: bool, spatial_index: bool = True):
+   """A slide whose calibration points and shapes are not in spatial order."""
+   names = ["calib_far", "calib_origin", "calib_middle"]
+   points = [shapely.Point(9000, 9000), shapely.Point(0, 0), shapely.Point(4000, 100)]
+   boxes = [shapely.box(x, 8000 - x, x + 5, 8005 - x) for x in range(0, 8000, 500)]
+   gdf = geopandas.GeoDataFrame({"name": names + [None] * len(boxes),
+                                 "classification": [None] * 3 + [json.dumps({"name": f"c{i}"}) for i in range(len(boxes))]},
+                                geometry=points + boxes)
+   if order_column:
+      gdf[utils.FEATURE_ORDER_COLUMN] = range(len(gdf))
+   with warnings.catch_warnings():
+      # QuPath exports have no CRS
+      warnings.filterwarnings("ignore", "'crs' was not provided")
+      gdf.to_file(path, driver="FlatGeobuf", SPATIAL_INDEX="YES" if spatial_index else "NO")
+   return names, [f"c{i}" for i in range(len(boxes))]
+
+
+@pytest.mark.parametrize("bbox", [None, (0, 0, 3000, 8100)], ids=["whole", "region"])
+def test_flatgeobuf_keeps_the_written_order(tmp_path, bbox):
+   names, classes = _flatgeobuf(tmp_path / "slide.fgb", order_column=True)
+   assert geopandas.read_file(tmp_path / "slide.fgb")["name"].dropna().tolist() != names
+   df, points, _ = ingest.read_columnar(tmp_path / "slide.fgb", bbox=bbox)
+   assert list(points) == names
+   expected = [name for name, x in zip(classes, range(0, 8000, 500), strict=True) if bbox is None or x <= 3000]
+   assert df["classification_name"].astype(str).tolist() == expected
+   assert utils.FEATURE_ORDER_COLUMN not in df.columns
+
+
+def test_flatgeobuf_without_spatial_index_is_in_file_order(tmp_path):
+   names, _ = _flatgeobuf(tmp_path / "slide.fgb", order_column=False, spatial_index=False)
+   assert list(ingest.read_columnar(tmp_path / "slide.fgb")[1]) == names
+
+
+def test_flatgeobuf_with_lost_calibration_order_fails(tmp_path):
+   _flatgeobuf(tmp_path / "slide.fgb", order_column=False)
+   with pytest.raises(ValueError, match="SPATIAL_INDEX=NO"):
+      ingest.read_columnar(tmp_path / "slide.fgb")
@@ -0,0 +1,29 @@
+import threading
+import time
+
+import numpy
+
+import qupath_to_lmd.instrument as instrument
+
+
+def _sampler_threads() -> list:
+   return [thread for thread in threading.enumerate() if thread.name == "rss-sampler"]
+
+
+def test_rss_sampler_runs_only_while_spans_are_open():
+   with instrument.recording("test") as recorder:
+      with instrument.span("allocate"):
+         assert instrument._sampler.running
+         data = numpy.ones(64 << 20, dtype=numpy.uint8)
+         time.sleep(5 * instrument.RSS_INTERVAL)
+         del data
+   assert not instrument._sampler.running
+   for thread in _sampler_threads():
+      thread.join(timeout=1)
+   assert not _sampler_threads()
+   # the array is freed inside the span, so only the sampler sees the peak
+   assert recorder.spans[0]["peak_rss_delta_mb"] >= 32
+
+   with instrument.span("again"):
+      assert instrument._sampler.running
+   assert not instrument._sampler.running
@@ -0,0 +1,90 @@
+import contextvars
+import threading
+import time
+
+import pytest
+
+import qupath_to_lmd.jobs as jobs
+
+
+def wait_until(condition, timeout: float = 5.0):
+   deadline = time.monotonic() + timeout
+   while not condition():
+      assert time.monotonic() < deadline, "timed out"
+      time.sleep(0.005)
+
+
+def blocking(release: threading.Event, steps: int = 3):
+   """A job that reports its steps, then waits for `release` before it reports the end."""
+   for step in range(steps):
+      jobs.progress("Working", step, steps, "steps")
+   release.wait(5)
+   jobs.progress("Finishing", steps, steps, "steps")
+   return "result"
+
+
+def test_progress_is_reported_and_the_result_kept():
+   release = threading.Event()
+   queue = jobs.JobQueue(max_jobs=1, max_queued=0)
+   job = queue.submit("job", blocking, release)
+   wait_until(lambda: job.done == 2)
+   assert job.state == jobs.RUNNING
+   assert job.describe() == "Working: 2 / 3 steps"
+   assert job.fraction == pytest.approx(2 / 3)
+   release.set()
+   wait_until(lambda: job.finished)
+   assert (job.state, job.result, job.error) == (jobs.DONE, "result", None)
+
+
+def test_advance_counts_items_from_several_threads():
+   def work():
+      # threads of the job run in a copy of its context, as the pipeline's thread pools do
+      threads = [threading.Thread(target=contextvars.copy_context().run,
+                                  args=(lambda: [jobs.advance("Items", 400, "items") for _ in range(100)],))
+                 for _ in range(4)]
+      for thread in threads:
+         thread.start()
+      for thread in threads:
+         thread.join()
+
+   job = jobs.JobQueue(max_jobs=0).submit("job", work)
+   assert job.state == jobs.DONE
+   assert (job.done, job.total) == (400, 400)
+
+
+def test_full_queue_rejects_jobs_until_one_finishes():
+   release = threading.Event()
+   queue = jobs.JobQueue(max_jobs=1, max_queued=1)
+   running = queue.submit("running", blocking, release)
+   queued = queue.submit("queued", blocking, release)
+   with pytest.raises(jobs.QueueFull):
+      queue.submit("rejected", blocking, release)
+   assert queue.ahead(queued) == 0 and queued.state == jobs.QUEUED
+   release.set()
+   wait_until(lambda: running.finished and queued.finished)
+   assert queue.submit("accepted", blocking, release).name == "accepted"
+
+
+def test_cancel_stops_a_running_job_and_drops_a_queued_one():
+   release = threading.Event()
+   queue = jobs.JobQueue(max_jobs=1, max_queued=1)
+   running = queue.submit("running", blocking, release)
+   queued = queue.submit("queued", blocking, release)
+   wait_until(lambda: running.done == 2)
+   queued.cancel()
+   assert queued.state == jobs.CANCELLED
+   running.cancel()
+   assert running.cancel_requested and running.state == jobs.RUNNING
+   # the job stops at its next progress report
+   release.set()
+   wait_until(lambda: running.finished)
+   assert running.state == jobs.CANCELLED and running.result is None
+
+
+def test_a_failing_job_keeps_its_error():
+   def fail():
+      raise ValueError("bad input")
+
+   job = jobs.JobQueue(max_jobs=0).submit("job", fail)
+   assert job.state == jobs.FAILED
+   assert isinstance(job.error, ValueError)
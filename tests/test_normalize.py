@@ -0,0 +1,51 @@
+import geopandas
+import pytest
+import shapely
+
+import qupath_to_lmd.normalize as normalize
+import qupath_to_lmd.qc as qc
+
+TOUCHING = shapely.MultiPolygon([shapely.box(0, 0, 10, 10), shapely.box(10.5, 0, 20, 10)])
+
+
+def frame(**columns):
+   return geopandas.GeoDataFrame({"id": ["a", "b", "c"], "classification_name": ["x", "x", "y"], **columns},
+                                 geometry=[shapely.box(100, 100, 110, 110), TOUCHING, shapely.box(300, 0, 310, 10)],
+                                 index=[7, 8, 9])
+
+
+def test_exploded_parts_get_unique_labels_and_ids():
+   normalized, summary = normalize.normalize_geometries(frame())
+
+   assert summary["Parts added by exploding"] == 1
+   assert summary["Parts given a new id"] == 1
+   assert [issue["label"] for issue in summary["issues"]] == [8]
+   assert normalized.index.is_unique and normalized.index.tolist() == [0, 1, 2, 3]
+   assert normalized[normalize.SOURCE_COLUMN].tolist() == [7, 8, 8, 9]
+   assert normalized[normalize.PART_COLUMN].tolist() == [0, 0, 1, 0]
+   ids = normalized["id"].tolist()
+   assert ids[:2] == ["a", "b"] and ids[3] == "c" and ids[2] not in ("a", "b", "c")
+   # the id of a later part is derived from its row, the same file gets the same ids
+   assert normalize.normalize_geometries(frame())[0]["id"].tolist() == ids
+   # the two parts of row 8 are reported as a pair of different shapes
+   pairs = qc.proximity_qc(normalized.geometry, min_distance=1.0)
+   assert pairs[["first", "second"]].values.tolist() == [[1, 2]]
+
+
+def test_user_columns_named_row_and_part_are_kept():
+   normalized, _ = normalize.normalize_geometries(frame(row=[1, 2, 3], part=["p", "q", "r"]))
+   assert normalized["row"].tolist() == [1, 2, 2, 3]
+   assert normalized["part"].tolist() == ["p", "q", "q", "r"]
+
+
+def test_existing_part_columns_are_not_overwritten():
+   with pytest.raises(ValueError, match=normalize.PART_COLUMN):
+      normalize.normalize_geometries(frame(**{normalize.PART_COLUMN: [0, 0, 0]}))
+
+
+def test_labels_are_kept_without_new_parts():
+   gdf = geopandas.GeoDataFrame({"id": ["a", "b"]}, geometry=[shapely.box(0, 0, 1, 1), shapely.Point(5, 5)], index=[3, 4])
+   normalized, summary = normalize.normalize_geometries(gdf)
+   assert normalized.index.tolist() == [3]
+   assert normalize.PART_COLUMN not in normalized.columns
+   assert [issue["label"] for issue in summary["issues"]] == [4]
@@ -0,0 +1,62 @@
+import numpy
+import pandas
+import pytest
+
+import qupath_to_lmd.ordering as ordering
+
+
+def random_contours(n_shapes, seed=0):
+   """Closed triangles at random places, as the flat coordinate buffer and offsets."""
+   rng = numpy.random.default_rng(seed)
+   centres = rng.uniform(0, 10_000, size=(n_shapes, 2))
+   triangle = numpy.array([[0, 0], [5, 0], [0, 5], [0, 0]], dtype=float)
+   coords = (centres[:, None, :] + triangle).reshape(-1, 2)
+   offsets = numpy.arange(n_shapes + 1, dtype=numpy.int64) * len(triangle)
+   return coords, offsets
+
+
+def test_travel_distance_runs_from_contour_ends_to_starts():
+   coords = numpy.array([[0, 0], [1, 0], [4, 4], [5, 5]], dtype=float)
+   offsets = numpy.array([0, 2, 4])
+   assert ordering.travel_distance(coords, offsets) == 5.0
+   assert ordering.travel_distance(coords, offsets, numpy.array([1, 0])) == pytest.approx(numpy.hypot(5, 5))
+
+
+@pytest.mark.parametrize("n_wells", [1, 3])
+def test_order_is_a_permutation_grouped_by_well_with_less_travel(n_wells):
+   coords, offsets = random_contours(500)
+   wells = numpy.array(["C5", "A1", "B2"])[numpy.random.default_rng(1).integers(0, n_wells, 500)]
+   order, report = ordering.order_shapes(coords, offsets, wells)
+
+   assert numpy.array_equal(numpy.sort(order), numpy.arange(500))
+   # every well is cut in one go, wells in the order they first appear
+   runs = pandas.unique(wells[order])
+   assert list(runs) == list(pandas.unique(wells))
+   assert (wells[order][1:] != wells[order][:-1]).sum() == n_wells - 1
+   assert report["Stage travel after ordering"] < report["Stage travel before ordering"] / 5
+   assert report["Stage travel after ordering"] == round(ordering.travel_distance(coords, offsets, order), 1)
+
+
+def test_two_opt_never_lengthens_the_tour():
+   points = numpy.random.default_rng(2).uniform(0, 100, size=(300, 2))
+   tour = ordering._nearest_neighbour_tour(points, 0)
+   improved = ordering._two_opt(points, tour)
+   length = lambda t: numpy.hypot(*numpy.diff(points[t], axis=0).T).sum()
+   assert sorted(improved) == list(range(300))
+   assert improved[0] == 0 and length(improved) <= length(tour)
+
+
+def test_reorder_moves_whole_contours():
+   # contours of 3 to 6 vertices
+   offsets = numpy.concatenate([[0], numpy.cumsum(numpy.arange(20) % 4 + 3)])
+   coords = numpy.random.default_rng(4).uniform(0, 100, size=(offsets[-1], 2))
+   order = numpy.random.default_rng(3).permutation(20)
+   new_coords, new_offsets = ordering.reorder(coords, offsets, order)
+   for position, shape in enumerate(order):
+      numpy.testing.assert_array_equal(new_coords[new_offsets[position]:new_offsets[position + 1]],
+                                       coords[offsets[shape]:offsets[shape + 1]])
+
+
+def test_no_shapes():
+   order, report = ordering.order_shapes(numpy.zeros((0, 2)), numpy.zeros(1, dtype=numpy.int64), [])
+   assert len(order) == 0 and report["Stage travel after ordering"] == 0.0
@@ -0,0 +1,46 @@
+import ast
+
+import numpy
+import pytest
+
+import qupath_to_lmd.pipeline as pipeline
+
+
+def numbered_row_by_row(gdf, classes_to_modify):
+   """The original row-by-row numbering, kept as the reference."""
+   gdf = gdf.copy()
+   if 'original_classification_name' not in gdf.columns:
+      gdf['original_classification_name'] = gdf['classification_name']
+   names = gdf['classification_name'].astype(object)
+   for class_name in classes_to_modify:
+      matching_indices = gdf[gdf['original_classification_name'] == class_name].index
+      for i, idx in enumerate(matching_indices):
+         names.loc[idx] = f"{class_name}_{str(i+1).zfill(3)}"
+   classification = []
+   for payload, name in zip(gdf['classification'], names, strict=True):
+      payload = ast.literal_eval(payload)
+      payload['name'] = name
+      classification.append(payload)
+   return names.tolist(), classification
+
+
+@pytest.mark.parametrize("classes", [["single_cells_demo"], ["circles", "two_circles", "class_1"], ["not_a_class"]])
+def test_numbering_matches_the_row_by_row_reference(demo_slide, classes):
+   # shuffled rows, so that numbering follows row order and not the index
+   gdf = demo_slide[0].sample(frac=1, random_state=0)
+   expected_names, expected_classification = numbered_row_by_row(gdf, classes)
+   numbered = pipeline.make_classes_unique(gdf, classes)
+   assert numbered.index.equals(gdf.index)
+   assert numbered['classification_name'].astype(object).tolist() == expected_names
+   assert [ast.literal_eval(payload) for payload in numbered['classification']] == expected_classification
+
+
+def test_repeated_numbering_starts_from_the_original_names(demo_slide):
+   gdf = demo_slide[0]
+   once = pipeline.make_classes_unique(gdf, ["circles"])
+   twice = pipeline.make_classes_unique(once, ["circles", "two_circles"])
+   expected_names, _ = numbered_row_by_row(once, ["circles", "two_circles"])
+   assert twice['classification_name'].astype(object).tolist() == expected_names
+   circles = twice['original_classification_name'] == "circles"
+   assert numpy.array_equal(twice.loc[circles, 'classification_name'].astype(object),
+                            [f"circles_{i:03d}" for i in range(1, circles.sum() + 1)])
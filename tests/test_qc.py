@@ -0,0 +1,52 @@
+import numpy
+import pytest
+import shapely
+
+import qupath_to_lmd.qc as qc
+
+BOXES = [shapely.box(10, 10, 20, 20), shapely.box(500, 500, 510, 510), shapely.box(40, -1, 60, 1)]
+
+
+def test_triangle_qc_classifies_boxes():
+   table = qc.triangle_qc(numpy.array(BOXES, dtype=object), [[0, 0], [100, 0], [0, 100]])
+   assert table["triangle_status"].tolist() == ["inside", "outside", "intersecting"]
+   assert table["distance_outside"].iloc[1] > 0
+
+
+@pytest.mark.parametrize("calib", [[[0, 0], [100, 0], [200, 0]], [[0, 0], [0, 0], [200, 5]], [[3, 3], [3, 3], [3, 3]]],
+                         ids=["collinear", "duplicate", "single point"])
+def test_triangle_qc_degenerate_calibration_is_outside(calib):
+   table = qc.triangle_qc(numpy.array(BOXES, dtype=object), calib)
+   assert (table["triangle_status"] == "outside").all()
+
+
+def test_qc_accepts_a_list_of_geometries():
+   table = qc.triangle_qc(list(BOXES), [[0, 0], [100, 0], [0, 100]])
+   assert table.index.tolist() == [0, 1, 2]
+   pairs = qc.proximity_qc([shapely.box(0, 0, 10, 10), shapely.box(5, 5, 15, 15), shapely.box(100, 100, 101, 101)])
+   assert pairs[["first", "second"]].values.tolist() == [[0, 1]]
+
+
+@pytest.mark.parametrize("calib", [[[0, 0], [100, 0], [0, 100]], [[10, 5], [40, 95], [90, 30]]], ids=["ccw", "cw"])
+def test_triangle_qc_distances_match_shapely(calib):
+   rng = numpy.random.default_rng(0)
+   centres = rng.uniform(-100, 200, (2000, 2))
+   geoms = numpy.concatenate([
+      shapely.buffer(shapely.points(centres), rng.uniform(0.5, 20, len(centres)), quad_segs=3),
+      shapely.linestrings(numpy.stack([centres[:100], centres[100:200]], axis=1)),
+      shapely.points(centres[:50]),
+      # a frame around the triangle, disjoint from it with the triangle in its hole
+      [shapely.box(-50, -50, 150, 150).difference(shapely.box(-5, -5, 105, 105))],
+   ])
+   table = qc.triangle_qc(geoms, calib)
+   outside = (table["triangle_status"] == "outside").to_numpy()
+   assert outside.sum() > 1000 and outside[-1]
+   numpy.testing.assert_allclose(table["distance_outside"].to_numpy()[outside],
+                                 shapely.distance(shapely.Polygon(calib), geoms[outside]), rtol=0, atol=1e-9)
+   assert (table["distance_outside"].to_numpy()[~outside] == 0).all()
+
+
+def test_min_over_vertices_in_batches():
+   geoms = shapely.buffer(shapely.points(numpy.arange(20.0), numpy.zeros(20)), 1 + numpy.arange(20) % 3, quad_segs=2)
+   expected = [shapely.get_coordinates(geom)[:, 0].min() for geom in geoms]
+   assert qc._min_over_vertices(geoms, lambda coords: coords[:, 0], chunk_size=7).tolist() == expected
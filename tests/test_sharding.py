@@ -0,0 +1,46 @@
+import pytest
+
+import qupath_to_lmd.pipeline as pipeline
+import qupath_to_lmd.sharding as sharding
+
+
+def test_plates_are_filled_one_after_the_other():
+   manifest = sharding.assign_plates(["a", "b", "c", "b", "d", "e"], ["A1", "A2"])
+   assert manifest["class"].tolist() == ["a", "b", "c", "d", "e"]
+   assert manifest["plate"].tolist() == [1, 1, 2, 2, 3]
+   assert manifest["well"].tolist() == ["A1", "A2", "A1", "A2", "A1"]
+
+
+def test_randomized_plates_use_every_well_once():
+   wells = [f"B{i}" for i in range(1, 11)]
+   manifest = sharding.assign_plates([f"class_{i}" for i in range(25)], wells, randomize=True)
+   assert manifest.groupby("plate")["well"].apply(lambda well: well.is_unique and well.isin(wells).all()).all()
+   assert manifest["plate"].value_counts().sort_index().tolist() == [10, 10, 5]
+
+
+def test_no_classes_and_no_wells():
+   assert sharding.assign_plates([], []).empty
+   with pytest.raises(ValueError, match="No acceptable wells"):
+      sharding.assign_plates(["a"], [])
+
+
+def test_plate_saws_split_the_manifest():
+   manifest = sharding.assign_plates(["a", "b", "c"], ["C3", "C5"])
+   assert sharding.plate_saws(manifest) == {1: {"a": "C3", "b": "C5"}, 2: {"c": "C3"}}
+   single = {"a": "C3", "b": "C5"}
+   assert sharding.plate_saws(sharding.manifest_from_saw(single)) == {1: single}
+
+
+def test_every_plate_exports_only_its_own_classes(demo_slide):
+   gdf, calib, _ = demo_slide
+   classes = gdf["classification_name"].unique().tolist()
+   manifest = sharding.assign_plates(classes, ["C3", "C5", "C7"])
+   artifacts, counted = sharding.export_plates(gdf, calib, manifest, plate_type="384", workers=2)
+
+   assert sorted(artifacts) == [1, 2]
+   for plate, saw in sharding.plate_saws(manifest).items():
+      shard = gdf[gdf["classification_name"].isin(list(saw))]
+      alone = pipeline.export_collection(shard, calib, saw, plate_type="384")
+      assert artifacts[plate].xml == alone.xml
+      assert artifacts[plate].plate_csv == alone.plate_csv
+   assert counted["shapes"].tolist() == gdf["classification_name"].value_counts()[classes].tolist()
@@ -0,0 +1,59 @@
+import numpy
+import pandas
+import pytest
+
+import qupath_to_lmd.stage as stage
+
+CALIBRATION = numpy.array([[0, 0], [100, 0], [0, 100]], dtype=float)
+IDENTITY = numpy.eye(2)
+
+
+def shapes_at(corners):
+   """Unit squares with their lower left corner at `corners`, as flat coordinates and offsets."""
+   square = numpy.array([[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]], dtype=float)
+   coords = (numpy.asarray(corners, dtype=float)[:, None, :] + square).reshape(-1, 2)
+   return coords, numpy.arange(len(corners) + 1) * len(square)
+
+
+def test_stage_coordinates_are_floored_after_orientation_and_scale():
+   orientation = numpy.array([[1, 0], [0, -1]])
+   points = numpy.array([[1.25, 2.5], [-0.5, 0.25]])
+   numpy.testing.assert_array_equal(stage.to_stage(points, orientation, 100), [[125, -250], [-50, -25]])
+
+
+def test_amplification_is_one_inside_the_calibration_triangle():
+   transform = stage.StageTransform(CALIBRATION, IDENTITY, 1)
+   amplification = transform.amplification(numpy.array([[10, 10], [0, 0], [300, 300]]))
+   assert amplification[:2] == pytest.approx([1, 1])
+   assert amplification[2] == pytest.approx(11)
+
+
+def test_out_of_range_and_far_shapes_are_flagged():
+   coords, offsets = shapes_at([[10, 10], [20, 30], [1000, 1000], [-50, 10]])
+   wells = pandas.Series(["A1", "A1", "B2", "B2"], index=[7, 8, 9, 10])
+   result = stage.preflight(coords, offsets, wells, CALIBRATION, IDENTITY, scale=1,
+                            stage_range=(0, 0, 5000, 5000), max_amplification=3)
+
+   assert result.flagged["shape"].tolist() == [9, 10]
+   assert result.flagged["reason"].tolist() == ["far outside the calibration triangle", "outside the stage range"]
+   assert result.stats["Shapes outside the stage range"] == 1
+   assert result.stats["Shapes far outside the calibration triangle"] == 1
+   assert result.stats["Calibration triangle smallest angle (deg)"] == 45
+
+   wells_table = result.wells.set_index("well")
+   assert wells_table.loc["A1", ["shapes", "vertices", "xmin", "ymin", "xmax", "ymax"]].tolist() == [2, 10, 10, 10, 21, 31]
+   assert wells_table.loc["B2", ["out_of_range", "far_from_calibration"]].tolist() == [1, 1]
+
+
+def test_degenerate_calibration_flags_every_shape():
+   coords, offsets = shapes_at([[10, 10], [20, 20]])
+   collinear = numpy.array([[0, 0], [50, 50], [100, 100]], dtype=float)
+   result = stage.preflight(coords, offsets, pandas.Series(["A1", "A1"]), collinear, IDENTITY, scale=1)
+   assert len(result.flagged) == 2
+   assert result.stats["Calibration triangle smallest angle (deg)"] == 0
+
+
+def test_no_shapes():
+   result = stage.preflight(numpy.zeros((0, 2)), numpy.zeros(1, dtype=numpy.int64), pandas.Series([], dtype=object),
+                            CALIBRATION, IDENTITY, scale=1)
+   assert result.flagged.empty and result.wells.empty
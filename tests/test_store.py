@@ -0,0 +1,76 @@
+import time
+
+import pandas
+import pytest
+
+import qupath_to_lmd.store as store
+
+
+def assert_same_shapes(rebuilt, gdf):
+   assert rebuilt.index.equals(gdf.index)
+   assert list(rebuilt.columns) == list(gdf.columns)
+   assert rebuilt.geometry.geom_equals_exact(gdf.geometry, tolerance=0).all()
+   pandas.testing.assert_series_equal(rebuilt["classification_name"], gdf["classification_name"])
+
+
+def test_frame_within_budget_is_kept(demo_slide):
+   gdf = demo_slide[0]
+   shapes = store.GeometryStore(gdf, budget=1 << 30)
+   assert shapes.state == "frame"
+   assert shapes.frame() is gdf
+   shapes.close()
+   assert shapes.state == "closed"
+
+
+def test_over_budget_frame_is_compacted_and_rebuilt(demo_slide):
+   # a fresh index, the hash table that lookups of other tests built counts towards the shared one's memory
+   gdf = demo_slide[0].set_axis(pandas.Index(demo_slide[0].index.to_numpy()))
+   shapes = store.GeometryStore(gdf, budget=store.frame_bytes(gdf) - 1)
+   assert shapes.state == "compact"
+   rebuilt = shapes.frame()
+   assert_same_shapes(rebuilt, gdf)
+   # the rebuilt frame is over budget, it is shared while in use but not kept
+   assert shapes.state == "compact" and shapes.frame() is rebuilt
+   assert shapes.class_names() == gdf["classification_name"].unique().tolist()
+   shapes.close()
+
+
+def test_spilled_shapes_are_memory_mapped_and_removed_on_close(demo_slide):
+   gdf = demo_slide[0]
+   shapes = store.GeometryStore(gdf, budget=1)
+   assert shapes.state == "disk"
+   directory = shapes._compact.directory
+   assert any(directory.iterdir()) and shapes.memory()["disk_mb"] >= 0
+   assert_same_shapes(shapes.frame(), gdf)
+   shapes.close()
+   assert not directory.exists()
+
+
+def test_evicted_shapes_come_back_as_frame_when_they_fit(demo_slide):
+   gdf = demo_slide[0]
+   shapes = store.GeometryStore(gdf, budget=1 << 30)
+   shapes.evict(to_disk=True)
+   assert shapes.state == "disk"
+   assert_same_shapes(shapes.frame(), gdf)
+   assert shapes.state == "frame"
+   shapes.close()
+
+
+def test_sweep_moves_only_idle_sessions_to_disk(demo_slide):
+   gdf = demo_slide[0]
+   idle, active = store.GeometryStore(gdf, budget=1 << 30), store.GeometryStore(gdf, budget=1 << 30)
+   idle.last_used = time.monotonic() - 3600
+   store.sweep_idle(max_idle=600)
+   assert (idle.state, active.state) == ("disk", "frame")
+   idle.close()
+   active.close()
+
+
+@pytest.mark.parametrize("keep_geometry", [True, False])
+def test_geometry_version_changes_only_with_the_geometries(demo_slide, keep_geometry):
+   gdf = demo_slide[0]
+   shapes = store.GeometryStore(gdf, budget=1 << 30)
+   version = shapes.geometry_version
+   shapes.replace(gdf.copy(), keep_geometry=keep_geometry)
+   assert (shapes.geometry_version == version) == keep_geometry
+   shapes.close()
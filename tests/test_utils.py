@@ -0,0 +1,36 @@
+import io
+import json
+import zipfile
+
+import geopandas
+import pytest
+
+import qupath_to_lmd.bundle as bundle
+import qupath_to_lmd.utils as utils
+
+
+def test_geojson_matches_the_gdal_writer(demo_slide, tmp_path):
+   gdf = demo_slide[0]
+   sink = io.BytesIO()
+   utils._write_geojson(utils.sanitize_gdf(gdf), sink, chunk_size=50)
+   utils.sanitize_gdf(gdf).to_file(tmp_path / "gdal.geojson", driver="GeoJSON")
+   assert json.loads(sink.getvalue())["features"] == json.loads((tmp_path / "gdal.geojson").read_text())["features"]
+
+
+@pytest.mark.parametrize("file_format", ["geojson", "geoparquet"])
+def test_processed_shapes_are_written_straight_into_the_bundle(demo_slide, monkeypatch, file_format):
+   gdf = demo_slide[0]
+
+   def no_temporary_files(*args, **kwargs):
+      raise AssertionError("wrote a temporary file")
+
+   monkeypatch.setattr(utils.tempfile, "TemporaryDirectory", no_temporary_files)
+   name = f"processed{utils.PROCESSED_FORMATS[file_format]}"
+   with bundle.BundleWriter() as writer:
+      with writer.open(name) as sink:
+         utils.write_processed(gdf, sink, file_format)
+   with zipfile.ZipFile(io.BytesIO(writer.bundle.read())) as archive:
+      data = io.BytesIO(archive.read(name))
+   written = geopandas.read_parquet(data) if file_format == "geoparquet" else geopandas.read_file(data)
+   assert written["id"].tolist() == gdf["id"].tolist()
+   assert written.geometry.geom_equals(gdf.geometry.reset_index(drop=True)).all()
@@ -0,0 +1,30 @@
+import contextlib
+import io
+from pathlib import Path
+
+import pytest
+
+import qupath_to_lmd.pipeline as pipeline
+import qupath_to_lmd.utils as utils
+import qupath_to_lmd.xml_writer as xml_writer
+
+DEMO = Path(__file__).resolve().parents[1] / "demo_Qupath_project"
+WELLS = utils.create_list_of_acceptable_wells(plate="384", margins=1)
+
+
+@pytest.mark.parametrize("slide", ["Single_cells", "TD_01_verysmall_mIF"])
+def test_xml_is_byte_identical_to_collection_save(tmp_path, slide):
+   gdf, available_points = pipeline.load_geojson(DEMO / f"{slide}.geojson")
+   calib_array = pipeline.calibration_array(available_points)
+   saw = {name: WELLS[i] for i, name in enumerate(gdf["classification_name"].unique())}
+   collection, _ = pipeline.build_collection(gdf, calib_array, saw)
+   # py-lmd prints the calibration points while saving
+   with contextlib.redirect_stdout(io.StringIO()):
+      collection.save(str(tmp_path / "reference.xml"))
+   reference = (tmp_path / "reference.xml").read_bytes()
+
+   streamed = io.BytesIO()
+   assert xml_writer.write_collection_xml(collection, streamed, chunk_shapes=7) == len(reference)
+   assert streamed.getvalue() == reference
+   assert pipeline.export_collection(gdf, calib_array, saw).xml == reference
+   assert pipeline.export_collection(gdf, calib_array, saw, geometry_version=slide).xml == reference